@@ -44,6 +44,19 @@ CREATE TABLE weather_metar
   metar  VARCHAR(300),
   source VARCHAR(10)
 );
+CREATE TABLE weather_metar_decoded
+(
+  stamp        TIMESTAMP PRIMARY KEY NOT NULL,
+  temp         FLOAT,
+  dewpt        FLOAT,
+  wind_speed   FLOAT,
+  vis          FLOAT,
+  press        FLOAT,
+  weather_desc VARCHAR(50),
+  weather_prec VARCHAR(50),
+  weather_obsc VARCHAR(50),
+  weather_othr VARCHAR(50)
+);
 CREATE TABLE charge_cycles
 (
   id             INT(11)                                        NOT NULL AUTO_INCREMENT,
@@ -67,6 +80,67 @@ CREATE TABLE soc
   soc_smooth  FLOAT,
   CONSTRAINT `PRIMARY` PRIMARY KEY (imei, time)
 );
+CREATE TABLE rollup
+(
+  imei              CHAR(4)  NOT NULL,
+  resolution        INT(11)  NOT NULL,
+  bucket            DATETIME NOT NULL,
+  sample_count      INT(11),
+  soc_min           FLOAT,
+  soc_mean          FLOAT,
+  soc_max           FLOAT,
+  charging_min      FLOAT,
+  charging_mean     FLOAT,
+  charging_max      FLOAT,
+  discharge_min     FLOAT,
+  discharge_mean    FLOAT,
+  discharge_max     FLOAT,
+  temp_battery_min  FLOAT,
+  temp_battery_mean FLOAT,
+  temp_battery_max  FLOAT,
+  temp_box_min      FLOAT,
+  temp_box_mean     FLOAT,
+  temp_box_max      FLOAT,
+  atmos_press_min   FLOAT,
+  atmos_press_mean  FLOAT,
+  atmos_press_max   FLOAT,
+  CONSTRAINT `PRIMARY` PRIMARY KEY (imei, resolution, bucket)
+);
+CREATE TABLE sessions
+(
+  imei            CHAR(4)      NOT NULL,
+  start_time      TIMESTAMP(3) NOT NULL,
+  end_time        TIMESTAMP(3) NOT NULL,
+  sample_count    INT(11)      NOT NULL,
+  median_interval FLOAT,
+  CONSTRAINT `PRIMARY` PRIMARY KEY (imei, start_time)
+);
+CREATE TABLE work_queue
+(
+  run         VARCHAR(32)       NOT NULL,
+  stage       VARCHAR(32)       NOT NULL,
+  imei        CHAR(4)           NOT NULL,
+  state       VARCHAR(10)       NOT NULL,
+  owner       VARCHAR(100),
+  lease_until BIGINT,
+  attempts    INT(11) DEFAULT 0 NOT NULL,
+  updated     DATETIME,
+  CONSTRAINT `PRIMARY` PRIMARY KEY (run, stage, imei)
+);
+CREATE TABLE run_journal
+(
+  run          VARCHAR(32) NOT NULL,
+  stage        VARCHAR(32) NOT NULL,
+  imei         CHAR(4)     NOT NULL,
+  state        VARCHAR(10) NOT NULL,
+  watermark    TIMESTAMP(3),
+  rows_read    BIGINT,
+  rows_written BIGINT,
+  started      DATETIME,
+  finished     DATETIME,
+  wall_s       FLOAT,
+  CONSTRAINT `PRIMARY` PRIMARY KEY (run, stage, imei)
+);
 ALTER TABLE trips
   ADD FOREIGN KEY (weather) REFERENCES weather (datetime);
 ALTER TABLE trips
@@ -74,4 +148,6 @@ ALTER TABLE trips
 CREATE INDEX trips_weather
   ON trips (weather);
 CREATE INDEX trips_weather_metar_stamp_fk
-  ON trips (metar);
\ No newline at end of file
+  ON trips (metar);
+CREATE INDEX sessions_end_time
+  ON sessions (imei, end_time);
\ No newline at end of file
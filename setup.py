@@ -33,6 +33,9 @@ setup(
         'tabulate>=0.7.5',
         'wget>=3.2'
     ],
+    extras_require={
+        'export': ['pyarrow>=1.0.0'],
+    },
     include_package_data=True,
     package_data={
         'webike': [
@@ -41,9 +44,13 @@ setup(
     },
     entry_points={
         "console_scripts": [
+            "webike = webike.cli:main",
             "webike-timeline = webike.ui.UI:main",
-            "webike-histogram = webike.Histogram:main",
-            "webike-prepocess = webike.Preprocess:main",
+            "webike-preprocess = webike.preprocess:main",
+            "webike-import-metar = webike.import_metar:main",
+            "webike-render = webike.render:main",
+            "webike-export = webike.export:main",
+            "webike-histogram = webike.histogram:main",
         ]
     },
 )
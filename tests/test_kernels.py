@@ -0,0 +1,108 @@
+"""Parity of webike.util.kernels with the generator implementations from iss4e.util.math"""
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from iss4e.util import math as ref
+
+from webike.util import kernels
+
+__author__ = "Niko Fink"
+
+MAX_GAP = timedelta(minutes=10)
+
+
+def random_series(seed, length=500):
+    """Values with runs of None and 0, and stamps with occasional gaps longer than MAX_GAP"""
+    rand = random.Random(seed)
+    values, stamps = [], []
+    stamp = datetime(2015, 6, 1)
+    for nr in range(length):
+        # missing values come in runs, like outages of a sensor
+        if rand.random() < 0.1 or (values and values[-1] in (None, 0) and rand.random() < 0.6):
+            values.append(rand.choice([None, 0]))
+        else:
+            values.append(rand.uniform(-20, 40))
+        stamp += timedelta(minutes=rand.choice([1, 1, 1, 2, 15, 90]) if rand.random() < 0.1 else 1)
+        stamps.append(stamp)
+    return values, stamps
+
+
+def as_array(values):
+    return np.array([np.nan if v is None else v for v in values], dtype=float)
+
+
+def ref_column(samples, label):
+    return as_array([sample[label] for sample in samples])
+
+
+def ref_smooth(values, stamps, initial=None, **kwargs):
+    samples = [{'Stamp': stamp, 'x': value} for stamp, value in zip(stamps, values)]
+    if initial is not None:
+        # the sample before the first one, whose smoothed value the first run continues from
+        samples.insert(0, {'Stamp': stamps[0] - timedelta(minutes=1), 'x': initial, 'x_smooth': initial})
+    smoothed = ref_column(list(ref.smooth(samples, 'x', **kwargs)), 'x_smooth')
+    return smoothed[1:] if initial is not None else smoothed
+
+
+SEEDS = range(10)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("initial", [None, 25.0])
+def test_smooth(seed, initial):
+    values, stamps = random_series(seed)
+    np.testing.assert_allclose(kernels.smooth(as_array(values), initial=initial),
+                               ref_smooth(values, stamps, initial))
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_smooth_reset_stale(seed):
+    values, stamps = random_series(seed)
+    np.testing.assert_allclose(
+        kernels.smooth_reset_stale(as_array(values), np.array(stamps, dtype='datetime64[us]'), MAX_GAP),
+        ref_smooth(values, stamps, is_valid=ref.smooth_reset_stale(MAX_GAP)))
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("initial", [None, 25.0])
+def test_smooth_ignore_missing(seed, initial):
+    values, stamps = random_series(seed)
+    np.testing.assert_allclose(kernels.smooth_ignore_missing(as_array(values), initial=initial),
+                               ref_smooth(values, stamps, initial, default_value=ref.smooth_ignore_missing))
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_differentiate(seed):
+    values, stamps = random_series(seed)
+    samples = [{'Stamp': stamp, 'x': value} for stamp, value in zip(stamps, values)]
+    np.testing.assert_allclose(
+        kernels.differentiate(as_array(values), np.array(stamps, dtype='datetime64[us]')),
+        ref_column(list(ref.differentiate(samples, 'x')), 'x_diff'))
+
+
+@pytest.mark.parametrize("smooth", [kernels.smooth, kernels.smooth_ignore_missing])
+@pytest.mark.parametrize("initial", [None, 25.0])
+def test_smooth_empty(smooth, initial):
+    assert len(smooth(np.array([]), initial=initial)) == 0
+
+
+def test_smooth_reset_stale_empty():
+    assert len(kernels.smooth_reset_stale(np.array([]), np.array([], dtype='datetime64[us]'), MAX_GAP)) == 0
+
+
+def test_differentiate_empty():
+    assert len(kernels.differentiate(np.array([]), np.array([], dtype='datetime64[us]'))) == 0
+    assert np.isnan(kernels.differentiate(np.array([1.0]), np.array([datetime(2015, 6, 1)], dtype='datetime64[us]')))
+
+
+@pytest.mark.parametrize("values", [[np.nan] * 5, [0.0] * 5, [np.nan, 0.0, np.nan]])
+def test_all_missing(values):
+    stamps = np.array([datetime(2015, 6, 1) + timedelta(minutes=nr) for nr in range(len(values))],
+                      dtype='datetime64[us]')
+    assert np.isnan(kernels.smooth(values)).all()
+    assert np.isnan(kernels.smooth_reset_stale(values, stamps, MAX_GAP)).all()
+    assert np.isnan(kernels.smooth_ignore_missing(values)).all()
+    # without own values, the last smoothed value before them is kept
+    np.testing.assert_allclose(kernels.smooth_ignore_missing(values, initial=25.0), [25.0] * len(values))
@@ -0,0 +1,51 @@
+"""The SoC estimation of webike.data.SoC doesn't depend on how the samples are split into chunks"""
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from webike.data import SoC
+
+__author__ = "Niko Fink"
+
+
+def random_rows(seed, length=300):
+    """(time, volt, volt_smooth, temp, temp_smooth, soc, soc_smooth) rows, some of them already with an estimate"""
+    rand = random.Random(seed)
+    rows = []
+    for nr in range(length):
+        volt = rand.choice([None, 0, rand.uniform(30, 42), rand.uniform(30, 42)])
+        temp = rand.choice([None, 0, rand.uniform(-15, 40), rand.uniform(-15, 40)])
+        if rand.random() < 0.2:
+            # samples with an estimation from an earlier run
+            estimate = [rand.uniform(30, 42), rand.uniform(-15, 40), rand.uniform(0, 1), rand.uniform(0, 1)]
+            rows.append((datetime(2015, 6, 1) + timedelta(minutes=nr), volt, estimate[0], temp, estimate[1],
+                         estimate[2], estimate[3]))
+        else:
+            rows.append((datetime(2015, 6, 1) + timedelta(minutes=nr), volt, None, temp, None, None, None))
+    return rows
+
+
+def estimate(rows, chunk_size):
+    chunks = [rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size)]
+    results = list(SoC.estimate_chunks(chunks))
+    columns = dict((name, np.concatenate([result[0][name] for result in results])) for name in results[0][0])
+    return columns, np.concatenate([result[1] for result in results])
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("chunk_size", [1, 7, 64])
+def test_chunked_estimates(seed, chunk_size):
+    rows = random_rows(seed)
+    whole, whole_todo = estimate(rows, len(rows))
+    chunked, chunked_todo = estimate(rows, chunk_size)
+    np.testing.assert_array_equal(whole_todo, chunked_todo)
+    for name in whole:
+        np.testing.assert_array_equal(whole[name], chunked[name])
+    # the estimated samples got a SoC as soon as there was a valid voltage
+    assert not np.isnan(whole['soc_smooth'][whole_todo][-10:]).all()
+
+
+def test_no_rows():
+    assert list(SoC.estimate_chunks([])) == []
@@ -0,0 +1,5 @@
+from webike.cli import main
+
+__author__ = "Niko Fink"
+
+main()
@@ -0,0 +1,46 @@
+"""The `webike` command, which runs the tools of the toolchain as its subcommands
+
+Each subcommand is the `main()` of a module, which is only imported once the subcommand is run, so that starting one
+tool or showing the help doesn't import the SciPy, matplotlib or GTK code of all the others.
+"""
+import argparse
+import collections
+import importlib
+import logging
+import sys
+
+__author__ = "Niko Fink"
+
+# subcommand -> (module, description)
+COMMANDS = collections.OrderedDict([
+    ("preprocess", ("webike.preprocess", "preprocess newly recorded samples and download weather data")),
+    ("import-metar", ("webike.import_metar", "import METAR weather reports from files")),
+    ("render", ("webike.render", "render the timeline plots without the UI")),
+    ("export", ("webike.export", "export the samples to partitioned Parquet or Arrow files")),
+    ("histogram", ("webike.histogram", "compute histograms of the weather data")),
+    ("timeline", ("webike.ui.UI", "show the interactive timeline")),
+])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="webike", description="WeBike Data Processing Toolchain",
+        epilog="commands:\n" + "\n".join("  {:<14}{}".format(name, description)
+                                         for name, (module, description) in COMMANDS.items()) +
+               "\n\nuse `webike COMMAND --help` to show the options of a command",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-v", "--verbose", action="store_true", help="also log debug messages")
+    parser.add_argument("command", choices=COMMANDS.keys(), metavar="COMMAND")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="arguments of the command")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(threadName)-10.10s %(levelname)-3.3s %(name)-12.12s - %(message)s")
+    module, description = COMMANDS[args.command]
+    # the main functions parse their arguments from sys.argv
+    sys.argv = ["webike " + args.command] + args.args
+    return importlib.import_module(module).main()
+
+
+if __name__ == "__main__":
+    main()
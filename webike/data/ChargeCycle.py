@@ -1,11 +1,19 @@
+import bisect
+import contextlib
+import itertools
 import logging
-from datetime import timedelta
+from datetime import datetime, timedelta
 
-from iss4e.db.mysql import DictCursor, StreamingDictCursor
+import numpy as np
 from iss4e.util import BraceMessage as __
 from tabulate import tabulate
+from webike.util import DB, kernels
+from webike.util.DB import DictCursor, StreamingDictCursor
 from webike.util.activity import ActivityDetection, Cycle
-from webike.util.constants import IMEIS, STUDY_START, TD0
+from webike.util.constants import STUDY_START, TD0
+from webike.util.metrics import measure_each
+from webike.util.prefetch import prefetch_rows
+from webike.util.store import get_store
 
 __author__ = "Niko Fink"
 logger = logging.getLogger(__name__)
@@ -40,6 +48,21 @@ class ChargeCycleDetection(ActivityDetection):
         else:
             return None
 
+    def detect_sessions(self, cycle_samples, sessions):
+        """Detect the cycles in each sampling session on its own, so that no cycle or smoothing spans an outage
+
+        `sessions` are the sessions overlapping the samples as returned by `DB.select_sessions`. Cycles still running
+        at the end of a session end there, except in the last one, which could still be continued by new samples.
+        """
+        starts = [session['start_time'] for session in sessions]
+        cycles, discarded = [], []
+        for nr, session_samples in itertools.groupby(
+                cycle_samples, key=lambda sample: bisect.bisect_right(starts, sample['Stamp']) - 1):
+            session_cycles, session_discarded = self(session_samples, finish=nr < len(sessions) - 1)
+            cycles.extend(session_cycles)
+            discarded.extend(session_discarded)
+        return cycles, discarded
+
     @staticmethod
     def get_duration(first, second):
         dur = second['Stamp'] - first['Stamp']
@@ -47,14 +70,75 @@ class ChargeCycleDetection(ActivityDetection):
         return dur
 
 
-def preprocess_cycles(connection, detector: ChargeCycleDetection, type=None):
+class ChargingCurrCCDetection(ChargeCycleDetection):
+    def __init__(self, *args, **kwargs):
+        super().__init__('ChargingCurr', *args, **kwargs)
+
+    def is_start(self, sample, previous):
+        return sample[self.attr] < 50
+
+    def is_end(self, sample, previous):
+        return sample[self.attr] > 50 or self.get_duration(previous, sample) > timedelta(minutes=10)
+
+
+class DischargeCurrCCDetection(ChargeCycleDetection):
+    def __init__(self, *args, **kwargs):
+        super().__init__('DischargeCurr_smooth', sql_attr='DischargeCurr', *args, **kwargs)
+
+    def is_start(self, sample, previous):
+        return sample[self.attr] < 490
+
+    def is_end(self, sample, previous):
+        return sample[self.attr] > 490 or self.get_duration(previous, sample) > timedelta(minutes=10)
+
+    def __call__(self, cycle_samples, finish=False):
+        cycle_samples, columns = samples_columns(cycle_samples, 'DischargeCurr')
+        smoothed = kernels.smooth_reset_stale(columns['DischargeCurr'], columns['Stamp'], timedelta(minutes=5))
+        for sample, value in zip(cycle_samples, smoothed.tolist()):
+            sample['DischargeCurr_smooth'] = value
+        return super().__call__(cycle_samples, finish)
+
+
+class SoCDerivCCDetection(ChargeCycleDetection):
+    def __init__(self, *args, **kwargs):
+        super().__init__('soc_smooth_diff', sql_attr='soc_smooth', *args, **kwargs)
+
+    def is_start(self, sample, previous):
+        return sample[self.attr] > 8
+
+    def is_end(self, sample, previous):
+        return sample[self.attr] < 2 or self.get_duration(previous, sample) > timedelta(minutes=10)
+
+    def __call__(self, cycle_samples, finish=False):
+        cycle_samples, columns = samples_columns(cycle_samples, 'soc_smooth')
+        # the first sample has no derivative, as NaN it neither starts nor ends a cycle
+        diff = kernels.differentiate(columns['soc_smooth'], columns['Stamp'], delta_time=timedelta(hours=1))
+        for sample, value in zip(cycle_samples, diff.tolist()):
+            sample['soc_smooth_diff'] = value
+        return super().__call__(cycle_samples, finish)
+
+
+def samples_columns(cycle_samples, attr):
+    """Read the samples into a list, returned together with their stamps and values of `attr` as NumPy columns
+
+    As `detect_sessions` calls the detectors once per session, only the samples of one session are read at a time.
+    """
+    cycle_samples = list(cycle_samples)
+    return cycle_samples, {
+        'Stamp': np.array([sample['Stamp'] for sample in cycle_samples], dtype='datetime64[us]'),
+        attr: np.array([sample[attr] for sample in cycle_samples], dtype=float),
+    }
+
+
+def preprocess_cycles(connection, detector: ChargeCycleDetection, type=None, imeis=None):
     if not type:
         type = detector.attr[0]
     logger.debug(__("Preprocessing charging cycles using {}", detector))
 
     cycles = {}
+    store = get_store()
     with connection.cursor(DictCursor) as cursor:
-        for nr, imei in enumerate(IMEIS):
+        for nr, imei in enumerate(measure_each(imeis or DB.discover_imeis(connection))):
             logger.info(__("Preprocessing charging cycles for {}", imei))
 
             # reprocess the last detected cycle, as it could have been cut of by data that wasn't uploaded yet
@@ -64,9 +148,9 @@ def preprocess_cycles(connection, detector: ChargeCycleDetection, type=None):
                 scursor.execute(
                     "SELECT start_time, end_time "
                     "FROM webike_sfink.charge_cycles "
-                    "WHERE imei='{imei}' AND type='{type}' "
-                    "ORDER BY start_time DESC;"
-                        .format(imei=imei, type=type))
+                    "WHERE imei = %s AND type = %s "
+                    "ORDER BY start_time DESC;",
+                    (imei, type))
                 for cycle in scursor.fetchall_unbuffered():
                     # if the latest 2 cycles are close together, go back further just to be sure
                     if not last_cycle or cycle['end_time'] > start_time:
@@ -75,19 +159,24 @@ def preprocess_cycles(connection, detector: ChargeCycleDetection, type=None):
                     else:
                         break
 
-            # use another streaming cursor as the first one wasn't completely consumed
-            with connection.cursor(StreamingDictCursor) as scursor:
-                # fetch the charging sensor data and prepare the raw values
-                scursor.execute(
-                    """SELECT Stamp, ChargingCurr, DischargeCurr, BatteryVoltage, soc_smooth FROM imei{imei}
-                    JOIN webike_sfink.soc ON Stamp = time AND imei = '{imei}'
-                    WHERE {attr} IS NOT NULL AND {attr} != 0 AND Stamp >= '{start_time}'
-                    ORDER BY Stamp ASC"""
-                        .format(imei=imei, attr=detector.sql_attr, start_time=start_time))
-                charge = scursor.fetchall_unbuffered()
-
-                logger.info(__("Detecting charging cycles after {} using {}", start_time, detector))
-                cycles_curr, cycles_curr_disc = detector(charge)
+            # fetch the charging sensor data and prepare the raw values
+            columns = ('Stamp', 'ChargingCurr', 'DischargeCurr', 'BatteryVoltage')
+            if store:
+                store.sync(connection, imei)
+                charge = store.rows(imei, start_time, None, columns, ('soc_smooth',),
+                                    not_null=(detector.sql_attr,), soc_join="INNER")
+            else:
+                # read the next samples ahead while the cycles in the current ones are detected
+                charge = prefetch_rows(
+                    DB.samples_sql(imei, columns, ('soc_smooth',), not_null=(detector.sql_attr,),
+                                   soc_join="INNER", until=False),
+                    (start_time,), cursor_class=StreamingDictCursor)
+
+            with contextlib.closing(charge):
+                sessions = DB.select_sessions(cursor, imei, start_time, datetime.max)
+                logger.info(__("Detecting charging cycles in {} sessions after {} using {}", len(sessions), start_time,
+                               detector))
+                cycles_curr, cycles_curr_disc = detector.detect_sessions(charge, sessions)
                 cycles[imei] = (cycles_curr, cycles_curr_disc)
 
             # delete outdated cycles and write newly detected ones
@@ -95,8 +184,8 @@ def preprocess_cycles(connection, detector: ChargeCycleDetection, type=None):
                            len(cycles_curr), type, len(cycles_curr_disc)))
             cursor.execute(
                 "DELETE FROM webike_sfink.charge_cycles "
-                "WHERE imei='{imei}' AND start_time >= '{start_time}' AND type='{type}';"
-                    .format(imei=imei, start_time=start_time, type=type))
+                "WHERE imei = %s AND start_time >= %s AND type = %s;",
+                (imei, start_time, type))
             cursor.executemany(
                 """INSERT INTO webike_sfink.charge_cycles
                 (imei, start_time, end_time, sample_count, avg_thresh_val, type)
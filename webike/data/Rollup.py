@@ -0,0 +1,143 @@
+import logging
+from datetime import timedelta
+
+from iss4e.util import BraceMessage as __
+from webike.util import DB
+from webike.util.DB import DictCursor
+from webike.util.constants import STUDY_START
+from webike.util.metrics import measure_each
+from webike.util.sqlite import to_datetime
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+# bucket widths of the rollups, from finest to coarsest
+RESOLUTIONS = [timedelta(minutes=1), timedelta(minutes=15), timedelta(hours=1), timedelta(days=1)]
+
+# rollup column prefix -> aggregated sample expression, zero currents are missing values
+COLUMNS = {
+    'soc': "soc.soc_smooth",
+    'charging': "NULLIF(ChargingCurr, 0)",
+    'discharge': "NULLIF(DischargeCurr, 0)",
+    'temp_battery': "TempBattery",
+    'temp_box': "TempBox",
+    'atmos_press': "AtmosPress",
+}
+AGGREGATES = [('min', "MIN"), ('mean', "AVG"), ('max', "MAX")]
+
+
+def preprocess_rollups(connection, imeis=None):
+    """Aggregate the samples from the last bucket of each resolution on into the min/mean/max rollups
+
+    The last bucket is aggregated again, as it could be continued by the new samples. If samples were uploaded late
+    with a stamp before that bucket, the rollup is updated from the first bucket whose sample count changed.
+    Only the samples of the given IMEIs are aggregated, which defaults to all.
+    """
+    logger.info("Preprocessing rollups for new samples")
+    names = ["{}_{}".format(col, agg) for col in COLUMNS for agg, func in AGGREGATES]
+    exprs = ["{}({})".format(func, expr) for col, expr in COLUMNS.items() for agg, func in AGGREGATES]
+
+    with connection.cursor(DictCursor) as cursor:
+        for imei in measure_each(imeis or DB.discover_imeis(connection)):
+            for resolution in RESOLUTIONS:
+                seconds = int(resolution.total_seconds())
+                # the last bucket could be incomplete, so aggregate it again
+                cursor.execute(
+                    "SELECT bucket FROM webike_sfink.rollup "
+                    "WHERE imei = %s AND resolution = %s ORDER BY bucket DESC LIMIT 1",
+                    (imei, seconds))
+                latest = cursor.fetchone()
+                start = latest['bucket'] if latest else STUDY_START
+                if not is_aligned(start, seconds):
+                    # rollups written before the buckets were aligned to local days
+                    logger.warning(__("Rollup of {} for {} isn't aligned to local time, rebuilding it",
+                                      resolution, imei))
+                    cursor.execute("DELETE FROM webike_sfink.rollup WHERE imei = %s AND resolution = %s",
+                                   (imei, seconds))
+                    start = STUDY_START
+                elif start > STUDY_START and not check_unchanged(cursor, imei, seconds, start):
+                    start = first_changed_bucket(cursor, imei, seconds, start)
+                    logger.warning(__("Samples of {} were added before the last bucket of the {} rollup, "
+                                      "updating it since {}", imei, resolution, start))
+
+                res = cursor.execute(
+                    """INSERT INTO webike_sfink.rollup (imei, resolution, bucket, sample_count, {names})
+                    SELECT %(imei)s, %(res)s, {bucket} AS bucket,
+                      COUNT(Stamp), {exprs}
+                    FROM {table} imei
+                      LEFT OUTER JOIN webike_sfink.soc soc ON imei.Stamp = soc.time AND soc.imei = %(imei)s
+                    WHERE Stamp >= %(start)s
+                    GROUP BY bucket
+                    {update}"""
+                        .format(table=DB.sample_table(imei), names=", ".join(names), exprs=", ".join(exprs),
+                                bucket=DB.bucket_start(cursor, "Stamp", seconds),
+                                update=DB.on_duplicate_update(cursor, ('imei', 'resolution', 'bucket'),
+                                                              ['sample_count'] + names)),
+                    {'imei': imei, 'res': seconds, 'start': start})
+                logger.info(__("Rollup of {} for {} since {} affected {} rows", resolution, imei, start, res))
+
+
+def check_unchanged(cursor, imei, seconds, start):
+    """Whether the buckets before `start` still contain all samples recorded until then"""
+    cursor.execute("SELECT COALESCE(SUM(sample_count), 0) AS count FROM webike_sfink.rollup "
+                   "WHERE imei = %s AND resolution = %s AND bucket < %s", (imei, seconds, start))
+    aggregated = cursor.fetchone()['count']
+    cursor.execute("SELECT COUNT(Stamp) AS count FROM {} WHERE Stamp >= %s AND Stamp < %s"
+                   .format(DB.sample_table(imei)), (STUDY_START, start))
+    return cursor.fetchone()['count'] == aggregated
+
+
+def first_changed_bucket(cursor, imei, seconds, start):
+    """The first bucket before `start` whose samples differ from its count, or STUDY_START if none can be found"""
+    cursor.execute(
+        """SELECT samples.bucket
+        FROM (SELECT {bucket} AS bucket, COUNT(Stamp) AS count
+              FROM {table}
+              WHERE Stamp >= %s AND Stamp < %s
+              GROUP BY bucket) samples
+          LEFT OUTER JOIN webike_sfink.rollup rollups
+            ON rollups.imei = %s AND rollups.resolution = %s AND rollups.bucket = samples.bucket
+        WHERE rollups.sample_count IS NULL OR rollups.sample_count <> samples.count
+        ORDER BY samples.bucket ASC
+        LIMIT 1"""
+            .format(table=DB.sample_table(imei), bucket=DB.bucket_start(cursor, "Stamp", seconds)),
+        (STUDY_START, start, imei, seconds))
+    row = cursor.fetchone()
+    # samples that were removed only leave buckets with a too high count, which can't be told apart from here
+    return to_datetime(row['bucket']) if row else STUDY_START
+
+
+def is_aligned(bucket, seconds):
+    """Whether the bucket starts at a multiple of `seconds` after the local midnight"""
+    midnight = bucket.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (bucket - midnight).total_seconds() % seconds == 0
+
+
+def select_resolution(begin, end, min_buckets):
+    """Select the coarsest resolution that still has at least `min_buckets` buckets between begin and end"""
+    for resolution in reversed(RESOLUTIONS):
+        if (end - begin) / resolution >= min_buckets:
+            return resolution
+    return None
+
+
+def select_rollup(cursor, imei, resolution, begin, end):
+    cursor.execute(
+        "SELECT * FROM webike_sfink.rollup "
+        "WHERE imei = %s AND resolution = %s AND bucket >= %s AND bucket <= %s "
+        "ORDER BY bucket ASC",
+        (DB.check_imei(imei), int(resolution.total_seconds()), begin, end))
+    return cursor.fetchall()
+
+
+def select_density(cursor, imeis):
+    """Number of samples per IMEI and month, summed up from the daily rollups"""
+    cursor.execute(
+        """SELECT imei, YEAR(bucket) AS year, MONTH(bucket) AS month, SUM(sample_count) AS count
+        FROM webike_sfink.rollup
+        WHERE resolution = %s AND imei IN ({})
+        GROUP BY imei, year, month
+        ORDER BY imei, year, month ASC"""
+            .format(", ".join(["%s"] * len(imeis))),
+        [int(RESOLUTIONS[-1].total_seconds())] + list(imeis))
+    return cursor.fetchall()
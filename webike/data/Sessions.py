@@ -0,0 +1,124 @@
+"""Index of the sampling sessions of each IMEI, i.e. the contiguous ranges of samples without longer outages
+
+A session ends when no sample was recorded for more than SESSION_GAP, which is the same gap that ends a charge cycle.
+Each session is stored with its first and last stamp, its sample count and the median interval between its samples
+in seconds, so that detectors can process each session on its own and graphers can skip ranges without samples.
+"""
+import collections
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+from iss4e.util import BraceMessage as __
+from tabulate import tabulate
+
+from webike.util import DB
+from webike.util.DB import DictCursor
+from webike.util.constants import STUDY_START
+from webike.util.fetch import fetch_columns, STAMP
+from webike.util.metrics import measure_each
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+SESSION_GAP = timedelta(minutes=10)
+
+
+def find_sessions(stamps, max_gap=SESSION_GAP):
+    """Split the sorted stamps at gaps longer than `max_gap` into (start, end, count, median interval) tuples"""
+    if not len(stamps):
+        return []
+    intervals = np.diff(stamps) / np.timedelta64(1, 's')
+    breaks = np.flatnonzero(intervals > max_gap.total_seconds())
+    sessions = []
+    for first, last in zip(np.r_[0, breaks + 1], np.r_[breaks, len(stamps) - 1]):
+        median = float(np.median(intervals[first:last])) if last > first else None
+        sessions.append((stamps[first].astype(datetime), stamps[last].astype(datetime), int(last - first + 1), median))
+    return sessions
+
+
+def check_unchanged(cursor, imei, since):
+    """Whether the sessions before `since` still contain all samples recorded until then"""
+    cursor.execute("SELECT COALESCE(SUM(sample_count), 0) AS count FROM webike_sfink.sessions "
+                   "WHERE imei = %s AND start_time < %s", (imei, since))
+    indexed = cursor.fetchone()['count']
+    cursor.execute("SELECT COUNT(Stamp) AS count FROM {} WHERE Stamp >= %s AND Stamp < %s"
+                   .format(DB.sample_table(imei)), (STUDY_START, since))
+    return cursor.fetchone()['count'] == indexed
+
+
+def preprocess_sessions(connection, imeis=None):
+    """Update the session index with all samples that arrived since the last run
+
+    The last session of each IMEI is detected again, as it could be continued by the new samples. If samples were
+    uploaded late with a stamp before that session, the index of the IMEI is rebuilt.
+    """
+    results = collections.OrderedDict()
+    with connection.cursor(DictCursor) as cursor:
+        for imei in measure_each(imeis or DB.discover_imeis(connection)):
+            cursor.execute("SELECT start_time FROM webike_sfink.sessions WHERE imei = %s "
+                           "ORDER BY start_time DESC LIMIT 1", (imei,))
+            last = cursor.fetchone()
+            since = last['start_time'] if last else STUDY_START
+            if since > STUDY_START and not check_unchanged(cursor, imei, since):
+                logger.warning(__("Samples of {} were added before the last indexed session, rebuilding the index",
+                                  imei))
+                since = STUDY_START
+
+            stamps = fetch_columns(
+                connection,
+                "SELECT Stamp FROM {} WHERE Stamp >= %s ORDER BY Stamp ASC".format(DB.sample_table(imei)),
+                [('Stamp', STAMP)], args=(since,))['Stamp']
+            sessions = find_sessions(stamps)
+
+            cursor.execute("DELETE FROM webike_sfink.sessions WHERE imei = %s AND start_time >= %s", (imei, since))
+            cursor.executemany(
+                "INSERT INTO webike_sfink.sessions (imei, start_time, end_time, sample_count, median_interval) "
+                "VALUES (%s, %s, %s, %s, %s)",
+                [(imei,) + session for session in sessions])
+            results[imei] = (since, len(stamps), len(sessions))
+            logger.info(__("Indexed {:,} samples of {} since {} as {} sessions", len(stamps), imei, since,
+                           len(sessions)))
+
+    logger.debug(__("Results of indexing sessions:\n{}", tabulate(
+        [(imei,) + result for imei, result in results.items()], headers=("imei", "since", "samples", "sessions"))))
+
+
+def empty_months(cursor, imeis, until=None):
+    """Set of (imei, year, month) tuples of the months up to `until` without samples, as far as the sessions are indexed
+
+    The months after the last indexed session of an IMEI are only considered empty if the index covers its newest
+    sample, otherwise their samples could be missing from the index. `until` defaults to now.
+    """
+    until = until or datetime.now()
+    cursor.execute(
+        "SELECT imei, start_time, end_time FROM webike_sfink.sessions WHERE imei IN ({}) ORDER BY imei, start_time"
+            .format(", ".join(["%s"] * len(imeis))),
+        list(imeis))
+    sessions = collections.defaultdict(list)
+    for session in cursor.fetchall():
+        sessions[session['imei']].append(session)
+
+    months = set()
+    for imei in imeis:
+        month = (STUDY_START.year, STUDY_START.month)
+        for session in sessions[imei]:
+            # the months before the session are empty, those it overlaps not
+            while month < (session['start_time'].year, session['start_time'].month):
+                months.add((imei,) + month)
+                month = next_month(month)
+            month = max(month, next_month((session['end_time'].year, session['end_time'].month)))
+
+        cursor.execute("SELECT Stamp FROM {} ORDER BY Stamp DESC LIMIT 1".format(DB.sample_table(imei)))
+        newest = cursor.fetchone()
+        if newest is None or (sessions[imei] and newest['Stamp'] <= sessions[imei][-1]['end_time']):
+            # the index contains all samples, so there are none after the last session
+            while month <= (until.year, until.month):
+                months.add((imei,) + month)
+                month = next_month(month)
+    return months
+
+
+def next_month(month):
+    year, month = month
+    return (year + 1, 1) if month == 12 else (year, month + 1)
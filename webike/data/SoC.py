@@ -1,13 +1,17 @@
+import contextlib
 import logging
+from datetime import datetime
 
+import numpy as np
 import scipy as sp
-from iss4e.db.mysql import DictCursor, StreamingDictCursor
 from iss4e.util import BraceMessage as __
-from iss4e.util import zip_prev, progress
-from iss4e.util.math import smooth1, smooth_ignore_missing
 from scipy.optimize import curve_fit
 
-from webike.util.constants import IMEIS
+from webike.util import DB, kernels
+from webike.util.DB import DictCursor
+from webike.util.fetch import to_columns, STAMP
+from webike.util.metrics import measure_each
+from webike.util.prefetch import prefetch_chunks
 
 __author__ = "Tommy Carpenter, Niko Fink"
 logger = logging.getLogger(__name__)
@@ -233,62 +237,98 @@ def generate_estimate(connection, imei, start, end):
     logger.info(__("Fetching raw SoC data for {} from {} to {}", imei, start, end))
     assert start is not None and end is not None
 
-    with connection.cursor(StreamingDictCursor) as scursor:
-        # Select relevant data points
-        # This selects one sample from soc before the actual date range,
-        # so that the smoothed values are deterministic for further runs
-        scursor.execute(
-            """(SELECT *
-             FROM webike_sfink.soc
-             WHERE time < '{start}' AND imei = '{imei}'
-             ORDER BY time DESC
-             LIMIT 1)
-            UNION
-            (SELECT
-               '{imei}'              AS imei,
-               imei.Stamp          AS time,
-               imei.BatteryVoltage AS volt,
-               soc.volt_smooth,
-               imei.TempBattery    AS temp,
-               soc.temp_smooth,
-               soc.soc,
-               soc.soc_smooth
-             FROM imei{imei} imei
-               LEFT OUTER JOIN webike_sfink.soc soc ON imei.Stamp = soc.time AND soc.imei = '{imei}'
-             WHERE Stamp >= '{start}' AND Stamp <= '{end}' AND BatteryVoltage IS NOT NULL AND BatteryVoltage != 0
-             ORDER BY Stamp ASC);"""
-                .format(imei=imei, start=start, end=end))
-
-        logger.debug("Calculating SoC values")
-        insert = []
-        rows = progress(scursor.fetchall_unbuffered(), logger=logger, verb="Calculated", objects="samples")
-        for nr, (prev, cur) in enumerate(zip_prev(rows)):
-            if cur['soc_smooth'] is None:
-                cur['imei'] = imei
-                # Smooth voltage and temperature by 95%
-                smooth1(cur, prev, 'volt', default_value=smooth_ignore_missing)
-                smooth1(cur, prev, 'temp', default_value=smooth_ignore_missing)
-                # Run get_SOC_val on the smoothed values and re-add it to each dictionary
-                cur['soc'] = calc_soc(choose_temp(cur['temp_smooth']), cur['volt_smooth'])
-                # Smooth SoCs by 95%
-                smooth1(cur, prev, 'soc', default_value=smooth_ignore_missing)
-                # Queue insert
-                insert.append(cur)
-
-        if len(insert) > 0:
-            logger.info(__("Inserting {:,} newly calculated samples", len(insert)))
-            sql = "INSERT INTO webike_sfink.soc ({}) VALUES ({})" \
-                .format(", ".join(cur.keys()), ", ".join(["%s"] * len(cur)))
-            rows = [[float(val) if isinstance(val, sp.float64) else val for val in row.values()] for row in insert]
-            inserted = scursor.executemany(sql, rows)
-            logger.info(__("Inserted {:,} new samples", inserted))
-
-
-def preprocess_estimates(connection):
-    """Make sure that the DB contains SoC information for each recorded sample"""
+    # Select relevant data points
+    # This selects one sample from soc before the actual date range,
+    # so that the smoothed values are deterministic for further runs
+    # The rows are read ahead chunk by chunk, so that the next chunk is streamed while the current one is calculated
+    chunks = prefetch_chunks(
+        """SELECT *
+        FROM (SELECT time, volt, volt_smooth, temp, temp_smooth, soc, soc_smooth
+              FROM webike_sfink.soc
+              WHERE time < %(start)s AND imei = %(imei)s
+              ORDER BY time DESC
+              LIMIT 1) prev
+        UNION ALL
+        SELECT
+          imei.Stamp          AS time,
+          imei.BatteryVoltage AS volt,
+          soc.volt_smooth,
+          imei.TempBattery    AS temp,
+          soc.temp_smooth,
+          soc.soc,
+          soc.soc_smooth
+        FROM {table} imei
+          LEFT OUTER JOIN webike_sfink.soc soc ON imei.Stamp = soc.time AND soc.imei = %(imei)s
+        WHERE Stamp >= %(start)s AND Stamp <= %(end)s AND BatteryVoltage IS NOT NULL AND BatteryVoltage != 0
+        ORDER BY time ASC;"""
+            .format(table=DB.sample_table(imei)),
+        {'imei': imei, 'start': start, 'end': end})
+
+    count, inserted = 0, 0
+    with contextlib.closing(chunks):
+        for rows, todo in estimate_chunks(chunks):
+            count += len(todo)
+            inserted += insert_estimates(connection, imei, rows, todo)
+    logger.info(__("Inserted {:,} newly calculated of {:,} samples", inserted, count))
+
+
+def estimate_chunks(chunks):
+    """Convert each chunk of (time, SOC_COLUMNS...) rows to columns and calculate the SoC of its samples without one
+
+    Yields the columns of each chunk together with the mask of the calculated samples. The smoothing continues from
+    the last row of the previous chunk, so the result doesn't depend on how the rows are split into chunks.
+    """
+    columns = [('time', STAMP)] + [(c, float) for c in DB.SOC_COLUMNS]
+    previous = dict((label, None) for label in ('volt', 'temp', 'soc'))
+    for chunk in chunks:
+        rows = to_columns(chunk, columns)
+        todo = calculate_estimates(rows, previous)
+        previous = dict((label, rows[label + '_smooth'][-1]) for label in previous)
+        yield rows, todo
+
+
+def calculate_estimates(rows, previous):
+    """Calculate the SoC of the samples without estimation in the columns, continuing from the `previous` row
+
+    Returns the mask of the calculated samples.
+    """
+    # only samples without estimation are calculated, each run of them continues from the sample before it
+    todo = np.isnan(rows['soc_smooth'])
+    bounds = np.flatnonzero(np.diff(np.r_[0, todo.astype(int), 0]))
+    for first, last in zip(bounds[::2], bounds[1::2]):
+        run = slice(first, last)
+        initial = dict((label, rows[label + '_smooth'][first - 1] if first > 0 else previous[label])
+                       for label in ('volt', 'temp', 'soc'))
+        # Smooth voltage and temperature by 95%
+        for label in ('volt', 'temp'):
+            rows[label + '_smooth'][run] = kernels.smooth_ignore_missing(rows[label][run], initial=initial[label])
+        # Run get_SOC_val on the smoothed values
+        rows['soc'][run] = [calc_soc(choose_temp(temp), volt) for temp, volt in
+                            zip(rows['temp_smooth'][run].tolist(), rows['volt_smooth'][run].tolist())]
+        # Smooth SoCs by 95%
+        rows['soc_smooth'][run] = kernels.smooth_ignore_missing(rows['soc'][run], initial=initial['soc'])
+    return todo
+
+
+def insert_estimates(connection, imei, rows, todo):
+    """Insert the SoC of the samples calculated by `calculate_estimates` and return the number of inserted rows"""
+    if not todo.any():
+        return 0
+    insert = [[imei, time] + [None if val != val else val for val in values] for time, values in
+              zip(rows['time'][todo].astype(datetime).tolist(),
+                  np.column_stack([rows[label][todo] for label in DB.SOC_COLUMNS]).tolist())]
+    with connection.cursor() as cursor:
+        return cursor.executemany(
+            "INSERT INTO webike_sfink.soc (imei, time, {}) VALUES ({})"
+                .format(", ".join(DB.SOC_COLUMNS), ", ".join(["%s"] * (len(DB.SOC_COLUMNS) + 2))),
+            insert)
+
+
+def preprocess_estimates(connection, imeis=None):
+    """Make sure that the DB contains SoC information for each recorded sample of the IMEIs, defaults to all"""
     logger.info("Preprocessing SoC information for new samples")
     with connection.cursor(DictCursor) as cursor:
-        for imei in IMEIS:
+        for imei in measure_each(imeis or DB.discover_imeis(connection)):
             logger.info(__("Checking {} for missing samples", imei))
             # Check if the min/max/count in the samples and soc estimations tables differ
             cursor.execute(
@@ -296,7 +336,7 @@ def preprocess_estimates(connection):
                   MIN(Stamp)   AS min,
                   MAX(Stamp)   AS max,
                   COUNT(Stamp) AS count
-                FROM imei{imei}
+                FROM {table}
                 WHERE BatteryVoltage IS NOT NULL AND BatteryVoltage != 0
                 UNION ALL
                 SELECT
@@ -304,8 +344,8 @@ def preprocess_estimates(connection):
                   MAX(time)   AS max,
                   COUNT(time) AS count
                 FROM webike_sfink.soc
-                WHERE imei = '{imei}'""".format(imei=imei)
-            )
+                WHERE imei = %s""".format(table=DB.sample_table(imei)),
+                (imei,))
             vals = cursor.fetchall()
             # If they are the same, we can assume that each sample has a matching SoC estimation
             if vals[0] == vals[1]:
@@ -319,11 +359,11 @@ def preprocess_estimates(connection):
             # This query finds the first and the last unprocessed sample.
             cursor.execute(
                 """SELECT MIN(imei.Stamp) AS min, MAX(imei.Stamp) AS max, COUNT(imei.Stamp) AS count
-                FROM imei{imei} imei
-                  LEFT OUTER JOIN webike_sfink.soc soc ON imei.Stamp = soc.time AND soc.imei = '{imei}'
+                FROM {table} imei
+                  LEFT OUTER JOIN webike_sfink.soc soc ON imei.Stamp = soc.time AND soc.imei = %s
                 WHERE soc.time IS NULL AND imei.BatteryVoltage IS NOT NULL AND imei.BatteryVoltage != 0"""
-                    .format(imei=imei)
-            )
+                    .format(table=DB.sample_table(imei)),
+                (imei,))
             vals = cursor.fetchone()
             assert vals['count'] > 0
             logger.info(__("Missing {:,} samples from {} to {}", vals['count'], vals['min'], vals['max']))
@@ -1,47 +1,56 @@
 import logging
+from datetime import datetime, timedelta
 
-from iss4e.db.mysql import DictCursor
+import numpy as np
 from iss4e.util import BraceMessage as __
-from webike.util.constants import IMEIS
+from webike.util import DB
+from webike.util.DB import DictCursor
+from webike.util.asof import asof_index
+from webike.util.fetch import fetch_columns, STAMP
+from webike.util.metrics import measure_each
 
 __author__ = "Niko Fink"
 logger = logging.getLogger(__name__)
 
 
-def preprocess_trips(connection):
+def preprocess_trips(connection, imeis=None):
     logger.info("Preprocessing JOIN information for new trips")
+    # the observation nearest to the start of each trip is found in the stamps of all observations
+    weather_times = fetch_columns(connection, "SELECT datetime FROM webike_sfink.weather ORDER BY datetime ASC",
+                                  [('time', STAMP)])['time']
+    metar_times = fetch_columns(connection, "SELECT stamp FROM webike_sfink.weather_metar ORDER BY stamp ASC",
+                                [('time', STAMP)])['time']
     with connection.cursor(DictCursor) as cursor:
-        for imei in IMEIS:
-            cursor.execute("SELECT trip{imei}.* FROM trip{imei} LEFT JOIN webike_sfink.trips ON "
-                           "trip{imei}.id = trips.trip AND trips.imei='{imei}' WHERE trips.trip IS NULL;"
-                           .format(imei=imei))
+        for imei in measure_each(imeis or DB.discover_imeis(connection)):
+            cursor.execute("SELECT {table}.* FROM {table} LEFT JOIN webike_sfink.trips ON "
+                           "{table}.id = trips.trip AND trips.imei = %s WHERE trips.trip IS NULL;"
+                           .format(table=DB.trip_table(imei)),
+                           (imei,))
             unprocessed_trips = cursor.fetchall()
             logger.info(__("Processing {} new entries for IMEI {}", len(unprocessed_trips), imei))
+            starts = np.array([trip['start_time'] for trip in unprocessed_trips], dtype=STAMP)
+            weather_idx = asof_index(starts, weather_times, direction='nearest')
+            metar_idx = asof_index(starts, metar_times, direction='nearest')
             for nr, trip in enumerate(unprocessed_trips):
                 logger.info(__("{} of {}: processing new trip {}#{}",
                                nr + 1, len(unprocessed_trips), imei, trip['id']))
 
                 cursor.execute(
-                    "SELECT datetime, ABS(TIMESTAMPDIFF(SECOND, datetime, '{}')) AS diff "
-                    "FROM webike_sfink.weather ORDER BY diff LIMIT 1"
-                        .format(trip['start_time']))
-                weather_sample = cursor.fetchone()
-                cursor.execute(
-                    "SELECT stamp, ABS(TIMESTAMPDIFF(SECOND, stamp, '{}')) AS diff "
-                    "FROM webike_sfink.weather_metar ORDER BY diff LIMIT 1"
-                        .format(trip['start_time']))
-                metar_sample = cursor.fetchone()
-
-                cursor.execute(
-                    "SELECT AVG(TempBox) AS avg_temp FROM imei{} "
-                    "WHERE Stamp >= '{}' + INTERVAL 5 MINUTE AND Stamp <= '{}' AND BatteryVoltage > 0"
-                        .format(imei, trip['start_time'], trip['end_time']))
+                    "SELECT AVG(TempBox) AS avg_temp FROM {} "
+                    "WHERE Stamp >= %s AND Stamp <= %s AND BatteryVoltage > 0"
+                        .format(DB.sample_table(imei)),
+                    (trip['start_time'] + timedelta(minutes=5), trip['end_time']))
                 avg_temp = cursor.fetchone()
 
                 res = cursor.execute(
                     "INSERT INTO webike_sfink.trips(imei, trip, start_time, end_time, distance, weather, metar, avg_temp) VALUES "
                     "(%s,%s,%s,%s,%s,%s,%s,%s)",
                     (imei, trip['id'], trip['start_time'], trip['end_time'], trip['distance'],
-                     weather_sample['datetime'], metar_sample['stamp'], avg_temp['avg_temp']))
+                     stamp_at(weather_times, weather_idx[nr]), stamp_at(metar_times, metar_idx[nr]),
+                     avg_temp['avg_temp']))
                 if res != 1:
                     raise AssertionError("Illegal result {} for row #{}: {}".format(res, nr, trip))
+
+
+def stamp_at(times, idx):
+    return times[idx].astype(datetime) if idx >= 0 else None
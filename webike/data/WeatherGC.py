@@ -1,16 +1,15 @@
-import copy
 import csv
 import logging
 import os
 from datetime import datetime
-from decimal import Decimal
 
 import wget
 from dateutil.relativedelta import relativedelta
-from iss4e.db.mysql import DictCursor
 from iss4e.util import BraceMessage as __
 
+from webike.util.DB import DictCursor
 from webike.util.constants import STUDY_START
+from webike.util.histogram import stream_histograms
 
 __author__ = "Niko Fink"
 logger = logging.getLogger(__name__)
@@ -28,7 +27,12 @@ SQL_MAPPING = {'Date/Time': 'datetime', 'Data Quality': 'quality', 'Temp (°C)':
                'Hmdx': 'hmdx', 'Hmdx Flag': 'hmdx_flag', 'Wind Chill': 'wind_chill',
                'Wind Chill Flag': 'wind_chill_flag', 'Weather': 'weather'}
 DOWNLOAD_DIR = "tmp/weather.gc.ca/"
-HIST_DATA = dict([(v, []) for k, v in SQL_MAPPING.items()])
+# (lo, hi, width) of the histogram bins of the numeric columns of webike_sfink.weather
+HIST_BINS = {'temp': (-40, 40, 1), 'dew_point': (-40, 30, 1), 'rel_hum': (0, 100, 5), 'wind_dir': (0, 36, 1),
+             'wind_speed': (0, 100, 5), 'visibility': (0, 50, 1), 'stn_press': (95, 105, 0.1), 'hmdx': (20, 50, 1),
+             'wind_chill': (-50, 0, 1)}
+# categorical columns and the separator between their values
+HIST_CATEGORIES = {'weather': ","}
 
 
 def download_data():
@@ -195,19 +199,6 @@ def read_data_db(connection):
         return data
 
 
-def extract_hist(data):
-    hist_data = copy.deepcopy(HIST_DATA)
-    for k, v in SQL_MAPPING.items():
-        hist_data[v] = []
-    for row in data:
-        for key, val in row.items():
-            append_hist(hist_data, key, val)
-    return hist_data
-
-
-def append_hist(hist_data, key, val):
-    if val is not None and key in hist_data:
-        if isinstance(val, Decimal):
-            hist_data[key].append(float(val))
-        else:
-            hist_data[key].append(val)
+def extract_hist(rows, group=None):
+    """Histograms of the webike_sfink.weather rows per `group(row)`, which can be a generator of any length"""
+    return stream_histograms(rows, HIST_BINS, HIST_CATEGORIES, group)
@@ -1,40 +1,142 @@
-import copy
 import csv
 import logging
 import os
 import shutil
+import time as timer
 from datetime import datetime, timedelta, timezone, time
 
 import requests
-from iss4e.db.mysql import DictCursor
 from iss4e.util import BraceMessage as __
 from metar import Metar
 
+from webike.util import DB
+from webike.util.DB import DictCursor
+from webike.util.histogram import stream_histograms
+
 __author__ = "Niko Fink"
 logger = logging.getLogger(__name__)
 
-HIST_DATA = {'temp': [], 'dewpt': [], 'wind_speed': [], 'vis': [], 'press': [], 'weather_desc': [], 'weather_prec': [],
-             'weather_obsc': [], 'weather_othr': []}
+# (lo, hi, width) of the histogram bins of the numeric columns of webike_sfink.weather_metar_decoded
+HIST_BINS = {'temp': (-40, 40, 1), 'dewpt': (-40, 30, 1), 'wind_speed': (0, 100, 5), 'vis': (0, 20, 1),
+             'press': (950, 1050, 2)}
+# the weather code columns contain one code per weather group of the report, separated by spaces
+HIST_CATEGORIES = {'weather_desc': " ", 'weather_prec': " ", 'weather_obsc': " ", 'weather_othr': " "}
 
 DOWNLOAD_DIR = "tmp/wunderground/"
+DECODED_COLUMNS = ['stamp', 'temp', 'dewpt', 'wind_speed', 'vis', 'press', 'weather_desc', 'weather_prec',
+                   'weather_obsc', 'weather_othr']
+
 URL = "https://www.wunderground.com/history/airport/CYKF/{year}/{month}/{day}/DailyHistory.html?format=1"
 
 
-def insert_navlost(connection):
+def insert_decoded(cursor, rows):
+    """Write the `DECODED_COLUMNS` of each row to weather_metar_decoded, replacing existing rows with the same stamp"""
+    return cursor.executemany(
+        "REPLACE INTO webike_sfink.weather_metar_decoded ({}) VALUES ({})"
+            .format(", ".join(DECODED_COLUMNS), ", ".join(["%s"] * len(DECODED_COLUMNS))),
+        rows)
+
+
+def decode_row(metar, stamp):
+    """The `DECODED_COLUMNS` of the METAR report, or None if it can't be parsed"""
+    try:
+        decoded = decode_metar(metar, stamp)
+    except Metar.ParserError as e:
+        logger.debug(__("Could not decode METAR from {}: {}", stamp, e))
+        return None
+    return [decoded[c] for c in DECODED_COLUMNS]
+
+
+def insert_navlost(connection, file="tmp/f0b74520-f7df-45e4-a596-f4392296296a.csv"):
     """Function for the one-time import of METAR data from navlost.eu"""
     logger.info("Loading navlost data")
+    with open(file, 'rt') as f:
+        return import_metar(connection, f, source='navlost')
+
+
+def parse_utc_stamp(value):
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+
+
+def read_metar_rows(f, delimiter='\t', stamp_col=2, metar_col=3, stats=None):
+    """Lazily read (stamp, metar) tuples from a delimited METAR archive, e.g. the TSV files from navlost.eu
+
+    Reports that are not prefixed with their type are assumed to be METARs. Lines that are too short or whose stamp
+    can't be parsed are skipped and counted as `skipped` in `stats`, if given.
+    """
+    for row in csv.reader(f, delimiter=delimiter):
+        try:
+            if len(row) <= max(stamp_col, metar_col):
+                raise ValueError("Line has only {} columns".format(len(row)))
+            stamp = parse_utc_stamp(row[stamp_col])
+        except ValueError as e:
+            # header or otherwise malformed line
+            logger.debug(__("Skipping line {!r}: {}", row, e))
+            if stats is not None:
+                stats['skipped'] += 1
+            continue
+        metar = row[metar_col].strip()
+        if not (metar.startswith('METAR') or metar.startswith('SPECI')):
+            metar = "METAR " + metar
+        yield stamp, metar
+
+
+def import_metar(connection, f, source, batch_size=10000, decode=False, **kwargs):
+    """Stream the METAR archive from file object `f` into the DB, inserting `batch_size` rows per query
+
+    Rows whose stamp is already stored are counted as duplicates and left untouched, lines without a stamp and
+    report in the given columns are counted as skipped.
+    If `decode` is set, the reports are also parsed and written to `weather_metar_decoded`.
+    """
+    stats = {'read': 0, 'skipped': 0, 'inserted': 0, 'duplicate': 0, 'decoded': 0, 'undecodable': 0}
+    start = timer.perf_counter()
+
+    def flush(batch, decoded_batch):
+        inserted = cursor.executemany(
+            "INSERT INTO webike_sfink.weather_metar (stamp, metar, source) "
+            "VALUES (%s, %s, %s) " + DB.on_duplicate_update(cursor, ('stamp',)),
+            batch)
+        stats['inserted'] += inserted
+        stats['duplicate'] += len(batch) - inserted
+        if decoded_batch:
+            insert_decoded(cursor, decoded_batch)
+            stats['decoded'] += len(decoded_batch)
+        connection.commit()
+
+        duration = timer.perf_counter() - start
+        logger.info(__("{:,} rows read, {:,} inserted, {:,} duplicates ({:,.0f} rows/s)",
+                       stats['read'], stats['inserted'], stats['duplicate'], stats['read'] / duration))
+
     with connection.cursor(DictCursor) as cursor:
-        with open("tmp/f0b74520-f7df-45e4-a596-f4392296296a.csv", 'rt') as f:
-            reader = csv.reader(f, delimiter='\t')
-            count = 0
-            for row in reader:
-                stamp = datetime.strptime(row[2], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
-                count += cursor.execute(
-                    "REPLACE INTO webike_sfink.weather_metar (stamp, metar, source) VALUES (%s, %s, 'navlost')",
-                    [stamp, "METAR " + row[3]])
-                if count % 1000 == 0:
-                    logger.info(__("{} rows inserted", count))
-            logger.info(__("{} rows inserted", count))
+        batch = []
+        decoded_batch = []
+        for stamp, metar in read_metar_rows(f, stats=stats, **kwargs):
+            stats['read'] += 1
+            batch.append([stamp, metar, source])
+            if decode:
+                decoded = decode_row(metar, stamp)
+                if decoded:
+                    decoded_batch.append(decoded)
+                else:
+                    stats['undecodable'] += 1
+
+            if len(batch) >= batch_size:
+                flush(batch, decoded_batch)
+                batch = []
+                decoded_batch = []
+        if batch:
+            flush(batch, decoded_batch)
+
+    duration = timer.perf_counter() - start
+    logger.info(__("Imported {:,} rows from {} in {:.1f}s: {:,} inserted, {:,} duplicates, "
+                   "{:,} decoded, {:,} undecodable, {:,} lines skipped",
+                   stats['read'], source, duration, stats['inserted'], stats['duplicate'],
+                   stats['decoded'], stats['undecodable'], stats['skipped']))
+    if stats['skipped']:
+        logger.warning(__("Skipped {:,} lines that are too short or have no valid stamp, check the --delimiter, "
+                          "--stamp-column and --metar-column if there are more than the header lines",
+                          stats['skipped']))
+    return stats
 
 
 def select_missing_dates(connection):
@@ -103,16 +205,52 @@ def __download_wunderg_metar(cursor, date):
         reader = csv.DictReader(text, )
         count = 0
         for row in reader:
-            time = datetime.strptime(row['DateUTC'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+            time = parse_utc_stamp(row['DateUTC'])
             metar = row['FullMetar']
             if metar.startswith('METAR') or metar.startswith('SPECI'):
-                count += cursor.execute(
+                inserted = cursor.execute(
                     "INSERT INTO webike_sfink.weather_metar (stamp, metar, source) "
-                    "VALUES (%s, %s, 'wunderg') ON DUPLICATE KEY UPDATE stamp=stamp",
+                    "VALUES (%s, %s, 'wunderg') " + DB.on_duplicate_update(cursor, ('stamp',)),
                     [time, metar])
+                count += inserted
+                decoded = decode_row(metar, time) if inserted else None
+                if decoded:
+                    insert_decoded(cursor, [decoded])
         logger.info(__("{} rows inserted", count))
 
 
+def decode_missing(connection, batch_size=10000):
+    """Decode the reports in weather_metar that have no row in weather_metar_decoded yet, e.g. the downloaded ones
+
+    The reports are read in batches of `batch_size` ordered by their stamp, reports that can't be parsed are skipped.
+    """
+    stats = {'read': 0, 'decoded': 0, 'undecodable': 0}
+    last = datetime.min
+    with connection.cursor(DictCursor) as cursor:
+        while True:
+            cursor.execute(
+                "SELECT m.stamp, m.metar FROM webike_sfink.weather_metar m "
+                "LEFT OUTER JOIN webike_sfink.weather_metar_decoded d ON d.stamp = m.stamp "
+                "WHERE d.stamp IS NULL AND m.stamp > %s ORDER BY m.stamp ASC LIMIT %s",
+                (last, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last = rows[-1]['stamp']
+            decoded = [decode_row(row['metar'], row['stamp']) for row in rows]
+            decoded = [row for row in decoded if row]
+            if decoded:
+                insert_decoded(cursor, decoded)
+            connection.commit()
+            stats['read'] += len(rows)
+            stats['decoded'] += len(decoded)
+            stats['undecodable'] += len(rows) - len(decoded)
+
+    logger.info(__("Decoded {:,} of {:,} reports without decoded values, {:,} undecodable",
+                   stats['decoded'], stats['read'], stats['undecodable']))
+    return stats
+
+
 def read_data_db(connection):
     logger.info("Reading weather underground data from DB")
 
@@ -123,41 +261,35 @@ def read_data_db(connection):
         return data
 
 
-def extract_hist(rows):
-    hist_data = copy.deepcopy(HIST_DATA)
-    for row in rows:
-        append_hist(hist_data, row['metar'], row['stamp'])
-    return hist_data
+def extract_hist(rows, group=None):
+    """Histograms of the weather_metar_decoded rows per `group(row)`, which can be a generator of any length
+
+    Reports without weather groups and groups without a code of the column are counted with the empty code "".
+    """
+    return stream_histograms(rows, HIST_BINS, HIST_CATEGORIES, group)
 
 
-def append_hist(hist_data, metar, stamp):
+def decode_metar(metar, stamp):
+    """Parse a METAR report into the numeric values and weather codes stored in `weather_metar_decoded`"""
     if isinstance(metar, str):
         metar = Metar.Metar(metar, month=stamp.month, year=stamp.year)
     assert isinstance(metar, Metar.Metar)
 
-    if metar.temp:
-        hist_data['temp'].append(metar.temp.value("C"))
-    if metar.dewpt:
-        hist_data['dewpt'].append(metar.dewpt.value("C"))
-    if metar.wind_speed:
-        hist_data['wind_speed'].append(metar.wind_speed.value("KMH"))
-    if metar.vis:
-        hist_data['vis'].append(metar.vis.value("KM"))
-    if metar.press:
-        hist_data['press'].append(metar.press.value("MB"))
-
-    if len(metar.weather) < 1:
-        hist_data['weather_desc'].append("")
-        hist_data['weather_prec'].append("")
-        hist_data['weather_obsc'].append("")
-        hist_data['weather_othr'].append("")
-    else:
-        for weather in metar.weather:
-            (inten, desc, prec, obsc, othr) = weather
-            hist_data['weather_desc'].append(desc)
-            if len(prec) > 2:
-                hist_data['weather_prec'].extend([prec[i:i + 2] for i in range(0, len(prec), 2)])
-            else:
-                hist_data['weather_prec'].append(prec)
-            hist_data['weather_obsc'].append(obsc)
-            hist_data['weather_othr'].append(othr)
+    decoded = {
+        'stamp': stamp,
+        'temp': metar.temp.value("C") if metar.temp else None,
+        'dewpt': metar.dewpt.value("C") if metar.dewpt else None,
+        'wind_speed': metar.wind_speed.value("KMH") if metar.wind_speed else None,
+        'vis': metar.vis.value("KM") if metar.vis else None,
+        'press': metar.press.value("MB") if metar.press else None,
+    }
+    codes = {'weather_desc': [], 'weather_prec': [], 'weather_obsc': [], 'weather_othr': []}
+    for weather in metar.weather:
+        (inten, desc, prec, obsc, othr) = weather
+        codes['weather_desc'].append(desc or "")
+        codes['weather_prec'].extend([prec[i:i + 2] for i in range(0, len(prec), 2)] if prec else [""])
+        codes['weather_obsc'].append(obsc or "")
+        codes['weather_othr'].append(othr or "")
+    for key, val in codes.items():
+        decoded[key] = " ".join(val)
+    return decoded
@@ -0,0 +1,229 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from iss4e.util import BraceMessage as __
+from tabulate import tabulate
+
+from webike.util import DB
+from webike.util.DB import DictCursor
+from webike.util.constants import STUDY_START
+from webike.util.fetch import fetch_columns, STAMP
+from webike.util.weather import DEFAULT_TOLERANCE, join_weather, SOURCES as WEATHER_SOURCES
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:  # only needed for exporting, install using `pip install webike-toolchain[export]`
+    pa = None
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+CYCLE_TYPES = ['C', 'D', 's']
+FORMATS = {'parquet': "parquet", 'feather': "arrow"}
+
+
+def parse_month(value):
+    return datetime.strptime(value, '%Y-%m')
+
+
+def list_months(since, until):
+    month = since
+    while month <= until:
+        yield month, month + relativedelta(months=1) - timedelta(microseconds=1)
+        month += relativedelta(months=1)
+
+
+def get_fingerprint(cursor, imei, begin, end, weather=()):
+    """Summarize all inputs of the partition of `imei` from `begin` to `end`, which only changes with the partition"""
+    fingerprint = [list(weather)]
+    queries = [("SELECT COUNT({time}) AS count, MAX({time}) AS max FROM {table} "
+                "WHERE {time} >= %s AND {time} <= %s".format(table=table, time=time),
+                (begin - DEFAULT_TOLERANCE, end + DEFAULT_TOLERANCE))
+               for table, time, columns in (WEATHER_SOURCES[source] for source in weather)]
+    for sql, args in queries + [
+        ("SELECT COUNT(Stamp) AS count, MIN(Stamp) AS min, MAX(Stamp) AS max FROM {} "
+         "WHERE Stamp >= %s AND Stamp <= %s".format(DB.sample_table(imei)), (begin, end)),
+        ("SELECT COUNT(time) AS count, MAX(time) AS max FROM webike_sfink.soc "
+         "WHERE imei = %s AND time >= %s AND time <= %s", (imei, begin, end)),
+        ("SELECT id, start_time, end_time, type FROM webike_sfink.charge_cycles "
+         "WHERE imei = %s AND end_time >= %s AND start_time <= %s ORDER BY id", (imei, begin, end)),
+        ("SELECT id, start_time, end_time FROM {} "
+         "WHERE end_time >= %s AND start_time <= %s ORDER BY id".format(DB.trip_table(imei)), (begin, end)),
+    ]:
+        cursor.execute(sql, args)
+        fingerprint.append(cursor.fetchall())
+    return fingerprint[len(queries) + 1][0]['count'], hashlib.sha1(repr(fingerprint).encode()).hexdigest()
+
+
+def membership(stamps, intervals):
+    """ID of the interval each stamp lies in, with a mask of the stamps that are not in any interval"""
+    if not intervals:
+        return np.zeros(len(stamps), dtype=np.int64), np.ones(len(stamps), dtype=bool)
+    intervals = sorted(intervals, key=lambda i: i['start_time'])
+    starts = np.array([i['start_time'] for i in intervals], dtype=STAMP)
+    ends = np.array([i['end_time'] for i in intervals], dtype=STAMP)
+    ids = np.array([i['id'] for i in intervals], dtype=np.int64)
+    idx = np.searchsorted(starts, stamps, side='right') - 1
+    valid = idx >= 0
+    valid[valid] = stamps[valid] <= ends[idx[valid]]
+    return np.where(valid, ids[np.maximum(idx, 0)], 0), ~valid
+
+
+def read_samples(connection, imei, begin, end, weather=()):
+    """Table of all samples in the range joined with their SoC estimation and annotated with cycle and trip IDs
+
+    For each source in `weather`, the samples are also annotated with the last observation up to an hour before them.
+    """
+    sample_cols = [c for c in DB.SAMPLE_COLUMNS if c != 'Stamp']
+    columns = fetch_columns(
+        connection,
+        DB.samples_sql(imei, tuple(['Stamp'] + sample_cols), tuple(DB.SOC_COLUMNS)),
+        [('Stamp', STAMP)] + [(c, float) for c in sample_cols + DB.SOC_COLUMNS],
+        args=(begin, end))
+    stamps = columns['Stamp']
+    # missing values are NaN in the fetched columns, but null in the exported ones
+    for source in weather:
+        columns.update(join_weather(connection, stamps, source))
+    arrays = dict((name, pa.array(values, from_pandas=True)) for name, values in columns.items())
+
+    with connection.cursor(DictCursor) as cursor:
+        cycles = DB.select_cycles(cursor, imei, begin, end)
+        trips = DB.select_trips(cursor, imei, begin, end)
+    for type in CYCLE_TYPES:
+        ids, mask = membership(stamps, [c for c in cycles if c['type'] == type])
+        arrays['cycle_' + type] = pa.array(ids, mask=mask, type=pa.int64())
+    ids, mask = membership(stamps, trips)
+    arrays['trip'] = pa.array(ids, mask=mask, type=pa.int64())
+    return pa.table(arrays)
+
+
+def read_rows(rows):
+    if not rows:
+        return None
+    return pa.table(dict((key, [row[key] for row in rows]) for key in rows[0].keys()))
+
+
+def write_table(table, path, fmt):
+    # write to a temporary file first, so that readers never see half-written partitions
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    if fmt == 'parquet':
+        pa.parquet.write_table(table, tmp, compression='zstd')
+    else:
+        pa.feather.write_feather(table, tmp)
+    os.replace(tmp, path)
+
+
+def remove_partition(out, manifest, name):
+    """Remove the file and manifest entry of a partition whose rows are gone, returns whether it was exported before"""
+    last = manifest.pop(name, None)
+    if not last:
+        return False
+    path = os.path.join(out, last['file'])
+    if os.path.exists(path):
+        os.remove(path)
+        if not os.listdir(os.path.dirname(path)):
+            os.rmdir(os.path.dirname(path))
+    logger.info(__("Removed {}, as its rows are gone", last['file']))
+    return True
+
+
+def export_unit(connection, out, fmt, imei, months, manifest, force=False, weather=()):
+    """Export all changed partitions of one IMEI, returns the number of exported, unchanged and removed partitions"""
+    exported = unchanged = removed = 0
+    with connection.cursor(DictCursor) as cursor:
+        for begin, end in months:
+            name = "samples/imei={}/month={:%Y-%m}".format(imei, begin)
+            count, fingerprint = get_fingerprint(cursor, imei, begin, end, weather)
+            file = "{}/part.{}".format(name, FORMATS[fmt])
+            last = manifest.get(name)
+            if count == 0:
+                removed += remove_partition(out, manifest, name)
+                continue
+            if (not force and last and last['fingerprint'] == fingerprint and
+                    last['file'] == file and os.path.exists(os.path.join(out, file))):
+                unchanged += 1
+                continue
+
+            table = read_samples(connection, imei, begin, end, weather)
+            write_table(table, os.path.join(out, file), fmt)
+            # the samples are ordered by their stamp
+            stamps = table.column('Stamp').to_numpy()
+            manifest[name] = {
+                'file': file, 'fingerprint': fingerprint, 'rows': table.num_rows,
+                'min_stamp': stamps[0].astype(datetime).isoformat(),
+                'max_stamp': stamps[-1].astype(datetime).isoformat(),
+                'exported': datetime.now().isoformat()}
+            exported += 1
+            logger.info(__("Exported {:,} samples to {}", table.num_rows, file))
+
+        # the cycles and trips of a unit are small enough to always be exported as a whole
+        for name, rows in [
+            ("cycles/imei={}".format(imei), DB.select_cycles(cursor, imei, STUDY_START, datetime.now())),
+            ("trips/imei={}".format(imei), DB.select_trips(cursor, imei, STUDY_START, datetime.now()))]:
+            table = read_rows(rows)
+            if table is None:
+                removed += remove_partition(out, manifest, name)
+                continue
+            file = "{}/part.{}".format(name, FORMATS[fmt])
+            write_table(table, os.path.join(out, file), fmt)
+            manifest[name] = {
+                'file': file, 'rows': table.num_rows,
+                'min_stamp': min(row['start_time'] for row in rows).isoformat(),
+                'max_stamp': max(row['end_time'] for row in rows).isoformat(),
+                'exported': datetime.now().isoformat()}
+    return exported, unchanged, removed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export samples with their SoC, cycle and trip membership to files partitioned by IMEI and month")
+    parser.add_argument("--out", default="tmp/export", help="output directory (default: %(default)s)")
+    parser.add_argument("--format", default="parquet", choices=sorted(FORMATS.keys()))
+    parser.add_argument("--imei", action="append", type=DB.check_imei,
+                        help="IMEI to export, can be given multiple times (default: all in the DB)")
+    parser.add_argument("--since", type=parse_month, default=STUDY_START, help="first month as YYYY-MM")
+    parser.add_argument("--until", type=parse_month, default=None, help="last month as YYYY-MM (default: now)")
+    parser.add_argument("--weather", action="append", choices=sorted(WEATHER_SOURCES.keys()), default=[],
+                        help="annotate the samples with the weather.gc.ca (gc) or decoded METAR (metar) observations, "
+                             "can be given multiple times")
+    parser.add_argument("--force", action="store_true", help="also export partitions whose inputs did not change")
+    args = parser.parse_args()
+    if pa is None:
+        parser.error("pyarrow is required for exporting, install it using `pip install webike-toolchain[export]`")
+
+    until = args.until or datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    months = list(list_months(args.since, until))
+    manifest_file = os.path.join(args.out, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    results = []
+    os.makedirs(args.out, exist_ok=True)
+    try:
+        with DB.connect() as connection:
+            for imei in args.imei or DB.discover_imeis(connection):
+                logger.info(__("Exporting {} months of {}", len(months), imei))
+                results.append((imei,) + export_unit(connection, args.out, args.format, imei, months, manifest,
+                                                     args.force, args.weather))
+    finally:
+        # also keep the partitions exported before a failure
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    logger.info(__("Results of exporting:\n{}", tabulate(
+        results, headers=("imei", "exported", "unchanged", "removed"))))
+
+
+if __name__ == "__main__":
+    main()
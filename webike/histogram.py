@@ -0,0 +1,113 @@
+import argparse
+import json
+import logging
+import os
+
+from iss4e.util import BraceMessage as __
+from tabulate import tabulate
+
+from webike.util import DB
+from webike.util.DB import DictCursor, StreamingDictCursor
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+# rows of each weather source, with the number of trips the row is the weather of
+SOURCES = {
+    'gc': ("SELECT w.*, COALESCE(t.trips, 0) AS trips FROM webike_sfink.weather w "
+           "LEFT OUTER JOIN (SELECT weather, COUNT(*) AS trips FROM webike_sfink.trips GROUP BY weather) t "
+           "ON t.weather = w.datetime"),
+    'wu': ("SELECT w.*, COALESCE(t.trips, 0) AS trips FROM webike_sfink.weather_metar_decoded w "
+           "LEFT OUTER JOIN (SELECT metar, COUNT(*) AS trips FROM webike_sfink.trips GROUP BY metar) t "
+           "ON t.metar = w.stamp"),
+}
+TOP_CODES = 10
+
+
+def trip_group(row):
+    return "trip" if row['trips'] else "no trip"
+
+
+def extract_hist(source, rows, group=None):
+    # the data modules import wget and metar, so only the one of the selected source is imported
+    if source == 'gc':
+        from webike.data import WeatherGC
+        return WeatherGC.extract_hist(rows, group)
+    else:
+        from webike.data import WeatherWU
+        return WeatherWU.extract_hist(rows, group)
+
+
+def log_summary(hists):
+    for group, hist in hists.items():
+        numeric = [(field, h.counts.sum() - h.counts[0] - h.counts[-1], h.missing, h.counts[0], h.counts[-1],
+                    h.mode()) for field, h in hist.histograms.items()]
+        logger.info(__("Histograms of {:,} rows{}:\n{}", hist.rows, " with " + group if group else "", tabulate(
+            numeric, headers=("field", "binned", "missing", "below", "above", "mode"))))
+        for field, counter in hist.counters.items():
+            if not counter:
+                continue
+            logger.info(__("Most common codes of {}: {}", field, ", ".join(
+                "{!r} ({:,})".format(code, count) for code, count in counter.most_common(TOP_CODES))))
+
+
+def plot_hists(hists, out_dir):
+    # matplotlib is only needed for plotting, so it isn't imported when just writing the histograms
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    os.makedirs(out_dir, exist_ok=True)
+    fields = next(iter(hists.values())).histograms.keys()
+    for field in fields:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        for group, hist in hists.items():
+            h = hist.histograms[field]
+            counts = h.counts[1:-1]
+            # compare the distributions of the groups, which can have very different numbers of rows
+            ax.step(h.edges[:-1], counts / max(counts.sum(), 1), where='post', label=group or "all")
+        ax.set_xlabel(field)
+        ax.set_ylabel("share of rows")
+        ax.legend()
+        fig.savefig(os.path.join(out_dir, field + ".png"))
+        logger.info(__("Plotted {} to {}", field, os.path.join(out_dir, field + ".png")))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compute fixed-bin histograms of the weather data using constant memory")
+    parser.add_argument("--source", default="gc", choices=sorted(SOURCES.keys()),
+                        help="hourly weather.gc.ca data or decoded METAR reports (default: %(default)s)")
+    parser.add_argument("--by-trip", action="store_true",
+                        help="separate the weather during trips from the weather without trips")
+    parser.add_argument("--out", default="tmp/histogram.json", help="output file (default: %(default)s)")
+    parser.add_argument("--plot", metavar="DIR", help="also plot the numeric histograms to DIR")
+    args = parser.parse_args()
+
+    with DB.connect() as connection:
+        if args.source == 'wu':
+            with connection.cursor(DictCursor) as cursor:
+                cursor.execute("SELECT COUNT(*) AS count FROM webike_sfink.weather_metar_decoded")
+                if not cursor.fetchone()['count']:
+                    logger.warning("No decoded METAR reports found, run the weather_wu stage of `webike preprocess` "
+                                   "or import them using `webike import-metar --decode`")
+                    return
+        with connection.cursor(StreamingDictCursor) as cursor:
+            cursor.execute(SOURCES[args.source])
+            hists = extract_hist(args.source, cursor.fetchall_unbuffered(), trip_group if args.by_trip else None)
+
+    if not hists:
+        logger.warning(__("No weather data found for source {}", args.source))
+        return
+    log_summary(hists)
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(dict((group or "all", hist.to_dict()) for group, hist in hists.items()), f, indent=2, sort_keys=True)
+    logger.info(__("Histograms written to {}", args.out))
+    if args.plot:
+        plot_hists(hists, args.plot)
+
+
+if __name__ == "__main__":
+    main()
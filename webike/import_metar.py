@@ -0,0 +1,47 @@
+import argparse
+import gzip
+import io
+import logging
+import sys
+
+from webike.data import WeatherWU
+from webike.util import DB
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+
+def open_archive(path, use_gzip=None):
+    """Open the METAR archive at `path` (or stdin for '-') as text, transparently decompressing gzip files"""
+    if use_gzip is None:
+        use_gzip = path.endswith(".gz")
+    if path == "-":
+        raw = sys.stdin.buffer
+    else:
+        raw = open(path, 'rb')
+    if use_gzip:
+        raw = gzip.open(raw, 'rb')
+    return io.TextIOWrapper(raw, encoding='utf8', newline='')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import a METAR archive into webike_sfink.weather_metar")
+    parser.add_argument("file", help="archive to import, '-' reads from stdin")
+    parser.add_argument("--source", default="navlost", help="value for the source column (default: %(default)s)")
+    parser.add_argument("--gzip", action="store_true", default=None,
+                        help="decompress the input (default: only if the file name ends with .gz)")
+    parser.add_argument("--decode", action="store_true", help="also write parsed values to weather_metar_decoded")
+    parser.add_argument("--batch-size", type=int, default=10000, help="rows per INSERT (default: %(default)s)")
+    parser.add_argument("--delimiter", default="\t", help="column delimiter (default: tab)")
+    parser.add_argument("--stamp-column", type=int, default=2, help="index of the UTC stamp column")
+    parser.add_argument("--metar-column", type=int, default=3, help="index of the METAR report column")
+    args = parser.parse_args()
+
+    with DB.connect() as connection, open_archive(args.file, args.gzip) as f:
+        WeatherWU.import_metar(
+            connection, f, source=args.source, batch_size=args.batch_size, decode=args.decode,
+            delimiter=args.delimiter, stamp_col=args.stamp_column, metar_col=args.metar_column)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,79 +1,178 @@
-from datetime import timedelta
-
-from iss4e.db import mysql
-from iss4e.util.config import load_config
-from iss4e.util.math import differentiate, smooth, smooth_reset_stale
-from webike.data import SoC, Trips, WeatherGC, WeatherWU
-from webike.data.ChargeCycle import ChargeCycleDetection, preprocess_cycles
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime
+
+from iss4e.util import BraceMessage as __
+from tabulate import tabulate
+
+from webike.util import DB, journal
+from webike.util.DB import DictCursor
+from webike.util.journal import RunJournal
+from webike.util.metrics import MetricsRecorder
+from webike.util.profiling import PROFILERS
+from webike.util.stages import Stage, StageScheduler, DONE
+from webike.util.workqueue import WorkQueue
 
 __author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+
+########################################################################################################################
+# Stages
+# The data modules import SciPy, metar, wget and requests, so they are only imported once one of their stages runs.
+
+def preprocess_soc(connection, imeis=None):
+    from webike.data import SoC
+    SoC.preprocess_estimates(connection, imeis)
+
+
+def preprocess_rollups(connection, imeis=None):
+    from webike.data import Rollup
+    Rollup.preprocess_rollups(connection, imeis)
+
+
+def preprocess_sessions(connection, imeis=None):
+    from webike.data import Sessions
+    Sessions.preprocess_sessions(connection, imeis)
 
 
-class ChargingCurrCCDetection(ChargeCycleDetection):
-    def __init__(self, *args, **kwargs):
-        super().__init__('ChargingCurr', *args, **kwargs)
+def preprocess_cycles_charging(connection, imeis=None):
+    from webike.data.ChargeCycle import ChargingCurrCCDetection, preprocess_cycles
+    preprocess_cycles(connection, ChargingCurrCCDetection(), imeis=imeis)
 
-    def is_start(self, sample, previous):
-        return sample[self.attr] < 50
 
-    def is_end(self, sample, previous):
-        return sample[self.attr] > 50 or self.get_duration(previous, sample) > timedelta(minutes=10)
+def preprocess_cycles_discharge(connection, imeis=None):
+    from webike.data.ChargeCycle import DischargeCurrCCDetection, preprocess_cycles
+    preprocess_cycles(connection, DischargeCurrCCDetection(), imeis=imeis)
 
 
-class DischargeCurrCCDetection(ChargeCycleDetection):
-    def __init__(self, *args, **kwargs):
-        super().__init__('DischargeCurr_smooth', sql_attr='DischargeCurr', *args, **kwargs)
+def preprocess_cycles_soc(connection, imeis=None):
+    from webike.data.ChargeCycle import SoCDerivCCDetection, preprocess_cycles
+    preprocess_cycles(connection, SoCDerivCCDetection(), imeis=imeis)
 
-    def is_start(self, sample, previous):
-        return sample[self.attr] < 490
 
-    def is_end(self, sample, previous):
-        return sample[self.attr] > 490 or self.get_duration(previous, sample) > timedelta(minutes=10)
+def preprocess_weather_gc(connection):
+    from webike.data import WeatherGC
+    gc_files = WeatherGC.download_data()
+    gc_csv_data = WeatherGC.parse_data(gc_files)
+    WeatherGC.write_data_csv(gc_csv_data)
+    WeatherGC.write_data_db(connection, gc_csv_data)
 
-    def __call__(self, cycle_samples):
-        cycle_samples = smooth(cycle_samples, 'DischargeCurr', is_valid=smooth_reset_stale(timedelta(minutes=5)))
-        return super().__call__(cycle_samples)
 
+def preprocess_weather_wu(connection):
+    from webike.data import WeatherWU
+    wu_missing_data = WeatherWU.select_missing_dates(connection)
+    WeatherWU.download_wunderg(connection, wu_missing_data)
+    WeatherWU.decode_missing(connection)
 
-class SoCDerivCCDetection(ChargeCycleDetection):
-    def __init__(self, *args, **kwargs):
-        super().__init__('soc_smooth_diff', sql_attr='soc_smooth', *args, **kwargs)
 
-    def is_start(self, sample, previous):
-        return sample[self.attr] > 8
+def preprocess_trips(connection, imeis=None):
+    from webike.data import Trips
+    Trips.preprocess_trips(connection, imeis)
 
-    def is_end(self, sample, previous):
-        return sample[self.attr] < 2 or self.get_duration(previous, sample) > timedelta(minutes=10)
 
-    def __call__(self, cycle_samples):
-        cycle_samples = differentiate(cycle_samples, 'soc_smooth', delta_time=timedelta(hours=1))
-        return super().__call__(cycle_samples)
+# TODO merge detected cycles or only use one method
+STAGES = [
+    Stage('soc', preprocess_soc, [], True),
+    Stage('rollup', preprocess_rollups, ['soc'], True),
+    Stage('sessions', preprocess_sessions, [], True),
+    Stage('cycles_charging', preprocess_cycles_charging, ['soc', 'sessions'], True),
+    Stage('cycles_discharge', preprocess_cycles_discharge, ['soc', 'sessions'], True),
+    Stage('cycles_soc', preprocess_cycles_soc, ['soc', 'sessions'], True),
+    Stage('weather_gc', preprocess_weather_gc, [], False),
+    Stage('weather_wu', preprocess_weather_wu, [], False),
+    Stage('trips', preprocess_trips, ['weather_gc', 'weather_wu'], True),
+]
 
 
 def main():
-    config = load_config()
-    with mysql.connect(**config['webike.mysql']) as connection:
-        SoC.preprocess_estimates(connection)
-        connection.commit()
-
-        preprocess_cycles(connection, ChargingCurrCCDetection())
-        preprocess_cycles(connection, DischargeCurrCCDetection())
-        preprocess_cycles(connection, SoCDerivCCDetection())
-        connection.commit()
-        # TODO merge detected cycles or only use one method
-
-        Trips.preprocess_trips(connection)
-        connection.commit()
-
-        gc_files = WeatherGC.download_data()
-        gc_csv_data = WeatherGC.parse_data(gc_files)
-        WeatherGC.write_data_csv(gc_csv_data)
-        WeatherGC.write_data_db(connection, gc_csv_data)
-        connection.commit()
-
-        wu_missing_data = WeatherWU.select_missing_dates(connection)
-        WeatherWU.download_wunderg(connection, wu_missing_data)
-        connection.commit()
+    parser = argparse.ArgumentParser(description="Preprocess newly recorded samples and download weather data")
+    parser.add_argument("--stage", action="append", choices=[stage.name for stage in STAGES],
+                        help="stage to run, can be given multiple times (default: all)")
+    parser.add_argument("--with-requirements", action="store_true",
+                        help="also run the stages required by the selected ones")
+    parser.add_argument("--jobs", type=int, default=4, help="number of stages to run concurrently")
+    parser.add_argument("--metrics", default="tmp/preprocess-metrics.jsonl",
+                        help="JSON lines file the metrics of each stage and IMEI are appended to "
+                             "(default: %(default)s)")
+    parser.add_argument("--profile", type=lambda value: value.split(","), default=[], metavar="STAGE[,STAGE]",
+                        help="profile the given stages")
+    parser.add_argument("--profiler", choices=PROFILERS, default="sampler",
+                        help="use the stack sampler, which also writes flame graph input, or cProfile "
+                             "(default: %(default)s)")
+    parser.add_argument("--profile-dir", default="tmp/profile",
+                        help="directory for the profiles, each run writes to a new subdirectory (default: %(default)s)")
+    parser.add_argument("--queue", metavar="RUN",
+                        help="share the work per stage and IMEI with all other workers started with the same RUN, "
+                             "e.g. the date of a nightly run, using the work queue in the DB")
+    parser.add_argument("--run", help="journal each stage and IMEI as unit of RUN and commit it on its own, running "
+                                      "again with the same RUN skips the units that are done and resumes the others "
+                                      "(default: a new run named after the current time)")
+    parser.add_argument("--history", action="store_true",
+                        help="show the journal of the last runs, or of the stages of RUN if given, and exit")
+    parser.add_argument("--list", action="store_true", help="list the stages and their requirements and exit")
+    args = parser.parse_args()
+    for name in args.profile:
+        if name not in [stage.name for stage in STAGES]:
+            parser.error("unknown stage {} to profile".format(name))
+    if args.profile and args.queue:
+        parser.error("stages can't be profiled when using the work queue")
+    if args.run and args.queue:
+        parser.error("the work queue already records the units of its run, use --queue RUN to resume it")
+
+    if args.list:
+        print(tabulate([(stage.name, ", ".join(stage.requires)) for stage in STAGES], headers=("stage", "requires")))
+        return
+    if args.history:
+        show_history(args.run)
+        return
+
+    if os.path.dirname(args.metrics):
+        os.makedirs(os.path.dirname(args.metrics), exist_ok=True)
+    metrics = MetricsRecorder(args.metrics)
+    started = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    profile_dir = os.path.join(args.profile_dir, started)
+    run_journal = RunJournal(args.run or started)
+    scheduler = StageScheduler(STAGES, DB.connect, max_workers=args.jobs, metrics=metrics,
+                               profile=args.profile, profile_dir=profile_dir, profiler=args.profiler,
+                               journal=run_journal)
+    if args.queue:
+        with DB.connect() as connection:
+            imeis = DB.discover_imeis(connection)
+        queue = WorkQueue(STAGES, DB.connect, args.queue, metrics=metrics)
+        units = queue.run_workers(scheduler.select(args.stage, args.with_requirements), imeis, max_workers=args.jobs)
+        logger.info(__("Results of preprocessing run {}:\n{}", args.queue, tabulate(
+            [(unit['stage'], unit['imei'], unit['state'], unit['attempts']) for unit in units.values()],
+            headers=("stage", "imei", "state", "attempts"))))
+        states = [unit['state'] for unit in units.values()]
+    else:
+        logger.info(__("Journaling preprocessing run {}", run_journal.run))
+        states = scheduler.run(args.stage, args.with_requirements)
+        logger.info(__("Results of preprocessing run {}:\n{}", run_journal.run,
+                       tabulate(states.items(), headers=("stage", "state"))))
+        states = list(states.values())
+    logger.info(__("Metrics of preprocessing, also written to {}:\n{}", args.metrics, metrics.summary()))
+    if any(state != DONE for state in states):
+        if not args.queue:
+            logger.info(__("Resume the run using --run {}", run_journal.run))
+        sys.exit(1)
+
+
+def show_history(run=None):
+    with DB.connect() as connection, connection.cursor(DictCursor) as cursor:
+        if run:
+            summaries = RunJournal(run).stages(cursor)
+            headers = "stage"
+        else:
+            summaries = journal.runs(cursor)
+            headers = "run"
+    if not summaries:
+        print("No journaled runs found" if not run else "Run {} not found in the journal".format(run))
+        return
+    print(tabulate([list(summary.values()) for summary in summaries],
+                   headers=[headers] + list(summaries[0].keys())[1:]))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+from datetime import datetime, timedelta
+
+from dateutil.relativedelta import relativedelta
+from iss4e.util import BraceMessage as __
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from tabulate import tabulate
+
+from webike.data import Sessions
+from webike.ui.grapher.ChargeGrapher import ChargeGrapher
+from webike.ui.grapher.DensityGrapher import DensityGrapher, FleetDensityGrapher
+from webike.ui.grapher.TempGrapher import TempGrapher
+from webike.util import DB
+from webike.util.DB import DictCursor
+from webike.util.constants import STUDY_START
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+GRAPHERS = {
+    'charge': ChargeGrapher,
+    'temp': TempGrapher,
+    'density': DensityGrapher,
+    'fleet': FleetDensityGrapher,
+}
+MANIFEST = "manifest.json"
+
+# outcomes of rendering a view
+RENDERED = "rendered"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+# state of each worker process, set up by init_worker
+worker = {}
+
+
+def parse_month(value):
+    return datetime.strptime(value, '%Y-%m')
+
+
+def list_units(grapher_names, imeis, since, until, empty=()):
+    """List (grapher name, imei, begin, end) of all views to render, skipping the `empty` (imei, year, month)s"""
+    units = []
+    for name in grapher_names:
+        grapher = GRAPHERS[name]
+        if grapher is FleetDensityGrapher:
+            units.append((name, None, since, until))
+        elif not grapher.requires_month():
+            units.extend((name, imei, since, until) for imei in imeis)
+        else:
+            month = since
+            while month <= until:
+                end = month + relativedelta(months=1) - timedelta(seconds=1)
+                units.extend((name, imei, month, end) for imei in imeis
+                             if (imei, month.year, month.month) not in empty)
+                month += relativedelta(months=1)
+    return units
+
+
+def get_file_name(unit, fmt):
+    name, imei, begin, end = unit
+    if GRAPHERS[name].requires_month():
+        return os.path.join(name, imei, "{}-{:02}.{}".format(begin.year, begin.month, fmt))
+    else:
+        return os.path.join(name, "{}.{}".format(imei or "all", fmt))
+
+
+def init_worker(size, dpi, fmt):
+    # each worker process uses its own connection and figure
+    worker['connection'] = DB.connect()
+    worker['options'] = (tuple(size), dpi, fmt)
+    worker['fig'] = Figure(figsize=size, dpi=dpi)
+    FigureCanvasAgg(worker['fig'])
+    worker['graphers'] = {}
+
+
+def render_unit(args):
+    """Render the view if its fingerprint changed and return (file, fingerprint, FAILED, RENDERED or UNCHANGED)
+
+    A view that fails is logged and skipped, so that the other views are still rendered.
+    """
+    unit, file, out_dir, last_fingerprint = args
+    try:
+        return (file,) + draw_unit(unit, file, out_dir, last_fingerprint)
+    except Exception:
+        logger.error(__("Rendering {} failed", file), exc_info=True)
+        # keep the previous fingerprint, so that the view is only skipped once it rendered successfully
+        return file, last_fingerprint, FAILED
+
+
+def draw_unit(unit, file, out_dir, last_fingerprint):
+    name, imei, begin, end = unit
+    with worker['connection'].cursor(DictCursor) as cursor:
+        grapher = worker['graphers'].get(name)
+        if not grapher:
+            grapher = worker['graphers'][name] = GRAPHERS[name](None, cursor, worker['fig'])
+        grapher.cursor = cursor
+
+        # the image also changes with the render options, not only with the data
+        fingerprint = hashlib.sha1(repr((grapher.get_fingerprint(imei, begin, end), worker['options']))
+                                   .encode()).hexdigest()
+        path = os.path.join(out_dir, file)
+        if fingerprint == last_fingerprint and os.path.exists(path):
+            return fingerprint, UNCHANGED
+
+        data = grapher.get_data_async(imei, begin, end)
+        grapher.draw_figure_async(imei, begin, end, *data)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        worker['fig'].savefig(path)
+        return fingerprint, RENDERED
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render the timeline plots without the UI")
+    parser.add_argument("--out", default="tmp/render", help="output directory (default: %(default)s)")
+    parser.add_argument("--grapher", action="append", choices=sorted(GRAPHERS.keys()),
+                        help="grapher to render, can be given multiple times (default: all)")
+    parser.add_argument("--imei", action="append", type=DB.check_imei,
+                        help="IMEI to render, can be given multiple times (default: all in the DB)")
+    parser.add_argument("--since", type=parse_month, default=STUDY_START, help="first month as YYYY-MM")
+    parser.add_argument("--until", type=parse_month, default=None, help="last month as YYYY-MM (default: now)")
+    parser.add_argument("--format", default="png", choices=["png", "svg"])
+    parser.add_argument("--size", type=float, nargs=2, default=[16, 9], help="figure size in inches")
+    parser.add_argument("--dpi", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--force", action="store_true", help="also render views whose inputs did not change")
+    args = parser.parse_args()
+
+    until = args.until or datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    with DB.connect() as connection, connection.cursor(DictCursor) as cursor:
+        imeis = args.imei or DB.discover_imeis(connection)
+        empty = Sessions.empty_months(cursor, imeis, until)
+    units = list_units(args.grapher or sorted(GRAPHERS.keys()), imeis, args.since, until, empty)
+
+    manifest_file = os.path.join(args.out, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    tasks = []
+    for unit in units:
+        file = get_file_name(unit, args.format)
+        tasks.append((unit, file, args.out, None if args.force else manifest.get(file)))
+    logger.info(__("Rendering {} views to {} using {} processes", len(tasks), args.out, args.processes))
+
+    results = collections.Counter()
+    os.makedirs(args.out, exist_ok=True)
+    try:
+        with multiprocessing.Pool(args.processes, initializer=init_worker,
+                                  initargs=(args.size, args.dpi, args.format)) as pool:
+            for nr, (file, fingerprint, result) in enumerate(pool.imap_unordered(render_unit, tasks)):
+                if fingerprint:
+                    manifest[file] = fingerprint
+                results[result] += 1
+                if result != UNCHANGED:
+                    logger.info(__("{} of {}: {} {}", nr + 1, len(tasks), result, file))
+    finally:
+        # also keep the fingerprints of the views rendered before a failure
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    logger.info(__("Results of rendering:\n{}", tabulate(
+        [(result, results[result]) for result in (RENDERED, UNCHANGED, FAILED)], headers=("views", "count"))))
+    if results[FAILED]:
+        logger.warning(__("{} views failed to render, see the errors above", results[FAILED]))
+
+
+if __name__ == "__main__":
+    main()
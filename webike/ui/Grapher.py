@@ -1,31 +1,257 @@
+import hashlib
 import logging
+from datetime import timedelta
+
+import numpy as np
+from iss4e.util import BraceMessage as __
+from matplotlib import dates as mdates
+from matplotlib.collections import PolyCollection
+
+from webike.data import Rollup
+from webike.util import DB
+from webike.util.downsample import downsample
 
 
 class Grapher():
     logger = logging.getLogger(__name__)
+    # names of the series returned by get_series, next to their 'Stamp'
+    SERIES = ()
 
-    def __init__(self, callback, cursor, fig):
+    def __init__(self, callback, cursor, fig, raw=False, cache=None):
         self.callback = callback
         self.cursor = cursor
         self.fig = fig
+        self.raw = raw
+        self.cache = cache
+        self.ax = None
+        self.lines = {}
+        self.collections = {}
+        # called with the new (begin, end) when the user changes the visible range
+        self.zoom_callback = None
+        self.drawing = False
 
     def __call__(self, imei, begin, end):
         self.logger.debug("enter get_data_async")
-        data = self.get_data_async(imei, begin, end)
+        data = self.get_data(imei, begin, end)
         self.logger.debug("leave get_data_async")
 
         self.logger.debug("enter draw_figure_async")
-        self.draw_figure_async(imei, begin, end, *data)
+        self.draw(self.draw_figure_async, imei, begin, end, *data)
         self.logger.debug("leave draw_figure_async")
 
         self.callback(imei, end, begin)
 
+    def draw(self, func, imei, begin, end, *data):
+        """Call one of the draw functions, ignoring the limit changes it makes to the axes"""
+        self.drawing = True
+        try:
+            func(imei, begin, end, *data)
+        finally:
+            self.drawing = False
+
+    def get_data(self, imei, begin, end):
+        """Fetch the data for the given range, reusing the result of a previous call if it is still cached"""
+        return self.cached(self.get_cache_key(imei, begin, end), self.get_data_async, imei, begin, end)
+
+    def get_detail(self, imei, begin, end):
+        """Fetch only the series of a zoomed-in range at the resolution fitting to it, caching it like get_data"""
+        return self.cached(('detail',) + self.get_cache_key(imei, begin, end), self.get_series, imei, begin, end)
+
+    def cached(self, key, func, *args):
+        if self.cache is None:
+            return func(*args)
+        data = self.cache.get(key)
+        if data is None:
+            data = func(*args)
+            self.cache.put(key, data)
+        else:
+            self.logger.debug("using cached data")
+        return data
+
+    def prefetch(self, imei, begin, end):
+        """Make sure the data for the given range is cached, without drawing it"""
+        if self.get_cache_key(imei, begin, end) not in self.cache:
+            self.logger.debug(__("prefetching {} from {} to {}", imei, begin, end))
+            self.get_data(imei, begin, end)
+
+    def get_cache_key(self, imei, begin, end):
+        # the resolution depends on the width of the figure, so resizing it requires fetching the data again
+        return type(self), imei, begin, end, self.select_resolution(begin, end)
+
     def get_data_async(self, imei, begin, end):
         raise NotImplementedError()
 
+    def get_fingerprint(self, imei, begin, end):
+        """Summarize the inputs of the given range, the summary changes whenever the drawn data would change"""
+        fingerprint = []
+        for sql, args in self.get_fingerprint_queries(imei, begin, end):
+            self.cursor.execute(sql, args)
+            fingerprint.append(self.cursor.fetchall())
+        return hashlib.sha1(repr(fingerprint).encode()).hexdigest()
+
+    def get_fingerprint_queries(self, imei, begin, end):
+        """List of (sql, args) tuples whose results are summarized by get_fingerprint"""
+        return [
+            ("SELECT COUNT(Stamp) AS count, MIN(Stamp) AS min, MAX(Stamp) AS max FROM {} "
+             "WHERE Stamp >= %s AND Stamp <= %s".format(DB.sample_table(imei)), (begin, end)),
+            # the sessions used by get_session_series, whose growth after the range doesn't change the drawing
+            ("SELECT start_time, CASE WHEN end_time > %s THEN %s ELSE end_time END AS end_time "
+             "FROM webike_sfink.sessions WHERE imei = %s AND start_time <= %s AND end_time >= %s "
+             "ORDER BY start_time ASC", (end, end, imei, end, begin)),
+            ("SELECT COUNT(*) > 0 AS later FROM webike_sfink.sessions WHERE imei = %s AND start_time > %s",
+             (imei, end)),
+        ]
+
     def draw_figure_async(self, imei, begin, end, *data):
         raise NotImplementedError()
 
+    def get_series(self, imei, begin, end):
+        """Fetch the data of the lines for the given range, graphers that implement this support zoom reloading"""
+        raise NotImplementedError()
+
+    def update_series(self, series):
+        raise NotImplementedError()
+
+    def draw_detail_async(self, imei, begin, end, series):
+        self.update_series(series)
+
+    @classmethod
+    def supports_detail(cls):
+        return cls.get_series is not Grapher.get_series
+
+    def on_xlim_changed(self, ax):
+        if self.drawing or not self.zoom_callback:
+            return
+        begin, end = [d.replace(tzinfo=None) for d in mdates.num2date(ax.get_xlim())]
+        self.zoom_callback(begin, end)
+
+    def get_session_series(self, imei, begin, end):
+        """Fetch the series like `get_series` from `get_rollup_data` or `get_raw_data`, using the session index
+
+        Ranges without sessions are neither queried nor drawn, lines are broken at the gaps between sessions.
+        """
+        sessions = self.get_sessions(imei, begin, end)
+        if sessions == []:
+            return dict((key, np.empty(0)) for key in ('Stamp',) + self.SERIES)
+        resolution = self.select_resolution(begin, end)
+        if resolution:
+            series = self.get_rollup_data(imei, begin, end, resolution)
+        else:
+            series = self.get_raw_data(imei, begin, end)
+        if sessions:
+            series = self.break_gaps(series, sessions, resolution or timedelta(0))
+        return series
+
+    def get_sessions(self, imei, begin, end):
+        """Sampling sessions overlapping the range, or None if the range lies after the last indexed session"""
+        sessions = DB.select_sessions(self.cursor, imei, begin, end)
+        if sessions:
+            return sessions
+        # the range is only known to be empty if it lies before a session, later samples may not be indexed yet
+        self.cursor.execute("SELECT start_time FROM webike_sfink.sessions WHERE imei = %s AND start_time > %s LIMIT 1",
+                            (DB.check_imei(imei), end))
+        return [] if self.cursor.fetchone() else None
+
+    @staticmethod
+    def break_gaps(series, sessions, min_gap=timedelta(0)):
+        """Insert a missing value in the middle of each gap between two sessions, so that lines don't cross outages
+
+        Only gaps longer than `min_gap` are broken. For series read from rollups, this has to be the bucket width,
+        as the middle of longer gaps always lies between the centers of the buckets before and after them.
+        """
+        gaps = [prev['end_time'] + (session['start_time'] - prev['end_time']) / 2
+                for prev, session in zip(sessions, sessions[1:]) if session['start_time'] - prev['end_time'] > min_gap]
+        if not gaps:
+            return series
+        gaps = mdates.date2num(gaps)
+        idx = np.searchsorted(series['Stamp'], gaps)
+        broken = {}
+        for key, values in series.items():
+            if key == 'Stamp':
+                broken[key] = np.insert(values, idx, gaps)
+            elif isinstance(values, tuple):
+                broken[key] = tuple(np.insert(np.asarray(v, dtype=float), idx, np.nan) for v in values)
+            else:
+                broken[key] = np.insert(np.asarray(values, dtype=float), idx, np.nan)
+        return broken
+
+    def get_width(self):
+        """Width of the figure in pixels"""
+        return self.fig.get_figwidth() * self.fig.dpi
+
+    def select_resolution(self, begin, end):
+        """Select the coarsest rollup that still fills the plot or None if raw samples should be shown"""
+        if self.raw:
+            return None
+        return Rollup.select_resolution(begin, end, self.get_width())
+
+    def get_axes(self):
+        """Get the axes of this grapher, which are recreated if the figure was cleared or used by another grapher
+
+        The axes, their lines and legend are only set up once by `setup_axes`, later redraws only update the data
+        of the artists.
+        """
+        if self.ax is None or self.ax not in self.fig.axes:
+            self.fig.clear()
+            self.ax = self.fig.add_subplot(111)
+            self.lines = {}
+            self.collections = {}
+            self.setup_axes(self.ax)
+            if self.supports_detail():
+                self.ax.callbacks.connect('xlim_changed', self.on_xlim_changed)
+            # reserve space for the title, which is set on each redraw
+            self.ax.set_title(" ")
+            self.fig.tight_layout()
+        return self.ax
+
+    def setup_axes(self, ax):
+        pass
+
+    def add_line(self, name, *args, **kwargs):
+        self.lines[name], = self.ax.plot([], [], *args, **kwargs)
+
+    def update_line(self, name, x, y, envelope=None):
+        """Update the data of a line, reduced to the min/max samples per pixel column of the figure unless `raw` is set
+
+        Series with an `envelope` of (min, max) values come from rollups and are already reduced,
+        the range between min and max is shaded in the color of the line.
+        """
+        if envelope is None and not self.raw:
+            x, y = downsample(x, y, self.get_width())
+        line = self.lines[name]
+        line.set_data(x, y)
+        if envelope is not None:
+            self.set_collection(name, self.ax.fill_between(
+                x, envelope[0], envelope[1], color=line.get_color(), alpha=0.2, lw=0))
+        else:
+            self.set_collection(name, None)
+
+    def update_spans(self, name, starts, ends, **kwargs):
+        """Replace the vertical spans of one category by a single collection covering the full height of the axes"""
+        starts = mdates.date2num(starts)
+        ends = mdates.date2num(ends)
+        verts = [[(s, 0), (s, 1), (e, 1), (e, 0)] for s, e in zip(starts, ends)]
+        collection = PolyCollection(verts, transform=self.ax.get_xaxis_transform(), **kwargs)
+        self.ax.add_collection(collection, autolim=False)
+        self.set_collection(name, collection)
+
+    def set_collection(self, name, collection):
+        old = self.collections.pop(name, None)
+        if old:
+            old.remove()
+        if collection:
+            self.collections[name] = collection
+
+    @staticmethod
+    def column(rows, key, valid=None):
+        """Extract the values of `key` from all rows as float array, using NaN for missing values
+
+        If `valid` is given, values are also treated as missing if the row has no value for `valid`.
+        """
+        if not valid:
+            valid = key
+        return np.array([row[key] if row[key] and row[valid] else np.nan for row in rows], dtype=float)
+
     @classmethod
     def requires_month(cls):
         return True
@@ -3,22 +3,23 @@ import gi
 gi.require_version('Gtk', '3.0')
 
 import logging
-import threading
 from datetime import timedelta, datetime
 
 from dateutil.relativedelta import relativedelta
 from gi.repository import Gtk, GLib, GObject
+from iss4e.util import BraceMessage as __
 from matplotlib.backends.backend_gtk3cairo import FigureCanvasGTK3Cairo as FigureCanvas
 from matplotlib.figure import Figure
 from pymysql import MySQLError
 
 from webike.ui.Toolbar import PlotToolbar
+from webike.ui.Worker import GrapherWorker, View
 from webike.ui.grapher.ChargeGrapher import ChargeGrapher
 from webike.ui.grapher.TempGrapher import TempGrapher
-from webike.ui.grapher.DensityGrapher import DensityGrapher
+from webike.ui.grapher.DensityGrapher import DensityGrapher, FleetDensityGrapher
 from webike.util import DB
-from webike.util.DB import DictCursor, Connection
-from webike.util.Logging import BraceMessage as __
+from webike.util.DB import ConnectionPool
+from webike.util.cache import LRUCache
 
 __author__ = "Niko Fink"
 logger = logging.getLogger(__name__)
@@ -33,20 +34,28 @@ entries = {
     'entryPassword': 'passwd'
 }
 
+# time to wait after the last change of the visible range before reloading it
+ZOOM_DELAY_MS = 300
+
 graphers = {
     "State of Charge": ChargeGrapher,
     "Temperature": TempGrapher,
-    "Data Density": DensityGrapher
+    "Data Density": DensityGrapher,
+    "Fleet Data Density": FleetDensityGrapher
 }
 
 
 class UI:
     def __init__(self):
-        self.connection = None
-        self.cursor = None
+        self.pool = None
+        self.worker = None
         self.builder = None
         self.cred = DB.default_credentials()
         self.fig = Figure()
+        self.raw_button = None
+        self.cache = LRUCache(maxsize=12)
+        self.view = None
+        self.zoom_timeout = None
 
     def __enter__(self):
         self.builder = Gtk.Builder()
@@ -62,10 +71,10 @@ class UI:
         return self
 
     def __exit__(self, type, value, traceback):
-        if self.cursor:
-            self.cursor.close()
-        if self.connection:
-            self.connection.close()
+        if self.worker:
+            self.worker.stop()
+        if self.pool:
+            self.pool.close()
         if self.fig:
             self.fig.clear()
 
@@ -76,25 +85,55 @@ class UI:
 
         self.builder.get_object('connectDialog').show_all()
 
-    def draw_figure(self):
-        logger.debug("enter draw_figure")
+    def get_view(self):
         imei = self.builder.get_object('imeiCombo').get_active_text()
         grapher_name = self.builder.get_object('grapherCombo').get_active_text()
-        callback = lambda i, b, e: GLib.idle_add(self.display_figure, i, b, e)
-        grapher = graphers[grapher_name](callback, self.cursor, self.fig)
         year = int(self.builder.get_object('yearButton').get_text())
         month = int(self.builder.get_object('monthButton').get_text())
         begin = datetime(year=year, month=month, day=1)
-        end = begin + relativedelta(months=1) - timedelta(seconds=1)
+        return graphers[grapher_name], imei, begin, self.raw_button.get_active()
+
+    @staticmethod
+    def get_month_end(begin):
+        return begin + relativedelta(months=1) - timedelta(seconds=1)
+
+    def draw_figure(self):
+        logger.debug("enter draw_figure")
+        grapher_cls, imei, begin, raw = self.get_view()
+        callback = lambda i, b, e: GLib.idle_add(self.display_figure, i, b, e)
+        end = self.get_month_end(begin)
 
         self.set_processing(True)
 
-        logger.info(__("Plotting {} -- {}-{} from {} to {}", imei, year, month, begin, end))
-        threading.Thread(target=grapher, args=(imei, begin, end), daemon=True).start()
+        logger.info(__("Plotting {} -- {}-{} from {} to {}", imei, begin.year, begin.month, begin, end))
+        self.view = View(grapher_cls, imei, begin, end, raw)
+        self.worker.submit(self.view, callback)
+
+    def on_zoom(self, begin, end):
+        """Reload the visible range once the user stopped panning or zooming for ZOOM_DELAY_MS"""
+        if self.zoom_timeout:
+            GLib.source_remove(self.zoom_timeout)
+        self.zoom_timeout = GLib.timeout_add(ZOOM_DELAY_MS, self.do_zoom, begin, end)
+
+    def do_zoom(self, begin, end):
+        self.zoom_timeout = None
+        view = self.view
+        if begin <= view.begin + timedelta(seconds=1) and end >= view.end - timedelta(seconds=1):
+            # back to the whole view, which is probably still cached
+            detail = None
+        else:
+            # also load half of the visible range on either side, so that panning doesn't immediately show gaps
+            margin = (end - begin) / 2
+            detail = (begin - margin, end + margin)
+        logger.info(__("Reloading {} -- {} from {} to {}", view.imei, view.grapher.__name__, begin, end))
+        self.set_processing(True)
+        callback = lambda i, b, e: GLib.idle_add(self.display_figure, i, b, e)
+        self.worker.submit(view._replace(detail=detail), callback)
+        return False
 
     def display_figure(self, imei, begin, end):
-        logger.info(__("Finished plotting {} -- {}-{} from {} to {}", imei, end.year, end.month, end, begin))
-        self.fig.canvas.draw()
+        logger.info(__("Finished plotting {} -- {}-{} from {} to {}", imei, begin.year, begin.month, begin, end))
+        self.fig.canvas.draw_idle()
         self.set_processing(False)
         logger.debug("leave display_figure")
 
@@ -102,7 +141,7 @@ class UI:
         self.builder.get_object('redrawSpinner').set_visible(processing)
         self.builder.get_object('redrawButton').set_visible(not processing)
 
-        self.builder.get_object('topbarContainer').set_sensitive(not processing)
+        # the topbar stays usable, newer requests supersede the one that is currently processed
         self.builder.get_object('toolbarContainer').set_sensitive(not processing)
 
         self.on_grapher_changed(None)
@@ -121,6 +160,8 @@ class UI:
         self.builder.get_object('monthButton').set_sensitive(requires_month)
 
     def do_redraw(self, widget):
+        # explicit redraws should show newly uploaded data
+        self.cache.clear()
         self.draw_figure()
 
     def do_previous(self, widget):
@@ -144,8 +185,9 @@ class UI:
         self.cred['port'] = int(self.cred['port'])
 
         try:
-            self.connection = Connection(connect_timeout=2, **self.cred)
-            self.cursor = self.connection.cursor(DictCursor)
+            self.pool = ConnectionPool(size=2, connect_timeout=2, **self.cred)
+            # check the credentials by opening the first connection
+            self.pool.put(self.pool.get())
         except MySQLError as e:
             logger.error("Could not connect to MySQL server", exc_info=e)
             label = self.builder.get_object('labelConnMsg')
@@ -166,6 +208,13 @@ class UI:
         self.builder.get_object('plotContainer').add(canvas)
         toolbar = PlotToolbar(canvas, window)
         self.builder.get_object('toolbarContainer').add(toolbar)
+        self.raw_button = toolbar.insert_widget(Gtk.CheckButton(label="Raw data"),
+                                                "Plot all samples instead of the min/max of each pixel column")
+        self.raw_button.connect('toggled', lambda widget: self.draw_figure())
+
+        self.worker = GrapherWorker(self.pool, self.fig, self.cache,
+                                    zoom_callback=lambda b, e: GLib.idle_add(self.on_zoom, b, e))
+        self.worker.start()
 
         connectDialog.hide()
         window.show_all()
@@ -0,0 +1,146 @@
+import collections
+import contextlib
+import logging
+import threading
+from datetime import timedelta
+
+from dateutil.relativedelta import relativedelta
+from iss4e.util import BraceMessage as __
+from pymysql import MySQLError
+
+from webike.util.DB import DictCursor, Connection
+
+View = collections.namedtuple('View', ['grapher', 'imei', 'begin', 'end', 'raw', 'detail'])
+# (begin, end) of the zoomed-in range that should be reloaded at a finer resolution, None for the whole view
+View.__new__.__defaults__ = (None,)
+
+
+class GrapherWorker(threading.Thread):
+    """Background thread that computes and draws only the most recently requested view
+
+    Requests that were superseded before they were started are dropped and the queries of a request that is
+    superseded while running are killed from a separate connection. When idle, the worker prefetches the
+    months neighboring the last drawn view into the cache.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, pool, fig, cache, zoom_callback=None):
+        super().__init__(name="GrapherWorker", daemon=True)
+        self.pool = pool
+        self.fig = fig
+        self.cache = cache
+        self.zoom_callback = zoom_callback
+        self.condition = threading.Condition()
+        self.pending = None
+        self.generation = 0
+        self.active_connection = None
+        self.kill_connection = None
+        self.stopped = False
+        self.graphers = {}
+
+    def submit(self, view, callback):
+        """Request drawing `view`, calling `callback(imei, begin, end)` once it has been drawn"""
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, view, callback)
+            self.cancel_active()
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.pending = None
+            self.cancel_active()
+            self.condition.notify()
+        if self.kill_connection:
+            self.kill_connection.close()
+
+    def cancel_active(self):
+        # must be called while holding self.condition
+        if not self.active_connection:
+            return
+        thread_id = self.active_connection.thread_id()
+        self.logger.debug(__("killing superseded query on connection {}", thread_id))
+        try:
+            if not self.kill_connection:
+                self.kill_connection = Connection(**self.pool.cred)
+            with self.kill_connection.cursor() as cursor:
+                cursor.execute("KILL QUERY %s", (thread_id,))
+        except MySQLError as e:
+            self.logger.warning("Could not kill superseded query", exc_info=e)
+
+    def is_superseded(self, generation):
+        return self.stopped or self.generation != generation
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                generation, view, callback = self.pending
+                self.pending = None
+
+            try:
+                if self.compute(generation, view, callback):
+                    self.prefetch(generation, view)
+            except Exception as e:
+                if self.is_superseded(generation):
+                    self.logger.debug(__("superseded request {} failed: {}", view, e))
+                else:
+                    self.logger.error(__("Could not draw {}", view), exc_info=e)
+                    callback(view.imei, view.begin, view.end)
+
+    @contextlib.contextmanager
+    def cursor(self, generation):
+        """Cursor on a pooled connection that can be cancelled by newer requests"""
+        with self.pool.connection() as connection:
+            with self.condition:
+                if self.is_superseded(generation):
+                    raise InterruptedError("request was superseded")
+                self.active_connection = connection
+            try:
+                with connection.cursor(DictCursor) as cursor:
+                    yield cursor
+            finally:
+                with self.condition:
+                    self.active_connection = None
+
+    def get_grapher(self, view, cursor):
+        """Get the grapher drawing `view`, which is kept between requests so that it can reuse its artists"""
+        grapher = self.graphers.get(view.grapher)
+        if not grapher:
+            grapher = self.graphers[view.grapher] = view.grapher(None, cursor, self.fig, cache=self.cache)
+            grapher.zoom_callback = self.zoom_callback
+        grapher.cursor = cursor
+        grapher.raw = view.raw
+        return grapher
+
+    def compute(self, generation, view, callback):
+        with self.cursor(generation) as cursor:
+            grapher = self.get_grapher(view, cursor)
+            if view.detail:
+                data = (grapher.get_detail(view.imei, *view.detail),)
+            else:
+                data = grapher.get_data(view.imei, view.begin, view.end)
+        if self.is_superseded(generation):
+            self.logger.debug(__("dropping superseded request {}", view))
+            return False
+
+        if view.detail:
+            grapher.draw(grapher.draw_detail_async, view.imei, view.detail[0], view.detail[1], *data)
+        else:
+            grapher.draw(grapher.draw_figure_async, view.imei, view.begin, view.end, *data)
+        callback(view.imei, view.begin, view.end)
+        # neighboring months are only prefetched for whole views
+        return not view.detail
+
+    def prefetch(self, generation, view):
+        if not view.grapher.requires_month():
+            return
+        for begin in [view.begin - relativedelta(months=1), view.begin + relativedelta(months=1)]:
+            end = begin + relativedelta(months=1) - timedelta(seconds=1)
+            with self.cursor(generation) as cursor:
+                grapher = view.grapher(None, cursor, self.fig, raw=view.raw, cache=self.cache)
+                grapher.prefetch(view.imei, begin, end)
@@ -1,96 +1,116 @@
 from datetime import timedelta
 
 import numpy as np
-from iss4e.util.math import smooth, differentiate
 from matplotlib import dates as mdates
 from matplotlib import patches as mpatches
 
+from webike.data import Rollup
 from webike.ui.Grapher import Grapher
+from webike.util import DB, kernels
 from webike.util.constants import discharge_curr_to_ampere
+from webike.util.store import read_samples
 
 CYCLE_TYPE_COLORS = {'D': 'r', 'C': 'g', 's': 'm'}
 
 
 class ChargeGrapher(Grapher):
+    SERIES = ('soc', 'soc_diff', 'charging', 'discharge')
+
     def get_data_async(self, imei, begin, end):
-        self.cursor.execute(
-            """SELECT Stamp, ChargingCurr, DischargeCurr, soc.soc_smooth AS soc_smooth
-            FROM imei{imei} imei
-            LEFT OUTER JOIN webike_sfink.soc ON Stamp = soc.time AND soc.imei = '{imei}'
-            WHERE Stamp >= '{min}' AND Stamp <= '{max}' AND
-              (ChargingCurr IS NOT NULL OR DischargeCurr IS NOT NULL OR soc.soc_smooth IS NOT NULL)
-            ORDER BY Stamp ASC"""
-                .format(imei=imei, min=begin, max=end))
-        charge_values = self.cursor.fetchall()
-        charge_values = smooth(charge_values, 'ChargingCurr')
-        charge_values = smooth(charge_values, 'DischargeCurr')
-        charge_values = differentiate(charge_values, 'soc_smooth', delta_time=timedelta(hours=1))
-        charge_values = smooth(charge_values, 'soc_smooth_diff')
-        charge_values = list(charge_values)  # smooth returns an iterator, this forces generation of all elements
-
-        self.cursor.execute(
-            "SELECT * FROM webike_sfink.charge_cycles "
-            "WHERE imei='{imei}' AND end_time >= '{min}' AND start_time <= '{max}' "
-            "ORDER BY start_time".format(imei=imei, min=begin, max=end))
-        charge_cycles = self.cursor.fetchall()
-
-        self.cursor.execute(
-            "SELECT * FROM trip{imei} "
-            "WHERE end_time >= '{min}' AND start_time <= '{max}' "
-            "ORDER BY start_time ASC"
-                .format(imei=imei, min=begin, max=end))
-        trips = self.cursor.fetchall()
+        charge_values = self.get_series(imei, begin, end)
+
+        charge_cycles = DB.select_cycles(self.cursor, imei, begin, end)
+        trips = DB.select_trips(self.cursor, imei, begin, end)
 
         return charge_values, charge_cycles, trips
 
-    def draw_figure_async(self, imei, begin, end, *data):
-        charge_values, charge_cycles, trips = data
+    def get_series(self, imei, begin, end):
+        return self.get_session_series(imei, begin, end)
+
+    def get_fingerprint_queries(self, imei, begin, end):
+        return super().get_fingerprint_queries(imei, begin, end) + [
+            ("SELECT COUNT(time) AS count, MAX(time) AS max FROM webike_sfink.soc "
+             "WHERE imei = %s AND time >= %s AND time <= %s", (imei, begin, end)),
+            ("SELECT id, start_time, end_time, type FROM webike_sfink.charge_cycles "
+             "WHERE imei = %s AND end_time >= %s AND start_time <= %s", (imei, begin, end)),
+            ("SELECT id, start_time, end_time FROM {} "
+             "WHERE end_time >= %s AND start_time <= %s".format(DB.trip_table(imei)), (begin, end))
+        ]
 
-        legend = self.fig.add_subplot(111).legend_
-        legend_visible = not legend or legend.get_visible()
-        self.fig.clear()
-        ax = self.fig.add_subplot(111)
-
-        ax.plot(
-            list([x['Stamp'] for x in charge_values]),
-            list([x['soc_smooth'] or np.nan for x in charge_values]),
-            'b-', label="State of Charge", alpha=0.9
-        )
-        ax.plot(
-            list([x['Stamp'] for x in charge_values]),
-            list([x['soc_smooth_diff_smooth'] or np.nan for x in charge_values]),
-            'm-', label="delta State of Charge", alpha=0.9
-        )
-        ax.plot(
-            list([x['Stamp'] for x in charge_values]),
-            list([x['ChargingCurr_smooth'] / 200 if x['ChargingCurr'] else np.nan for x in charge_values]),
-            'g-', label="Charging Current", alpha=0.9
-        )
-        ax.plot(
-            list([x['Stamp'] for x in charge_values]),
-            list([-discharge_curr_to_ampere(x['DischargeCurr_smooth']) if x['DischargeCurr'] else np.nan
-                  for x in charge_values]),
-            'r-', label="Discharging Current", alpha=0.9
-        )
-
-        for trip in trips:
-            ax.axvspan(trip['start_time'], trip['end_time'], color='y', alpha=0.5, lw=0)
-        for cycle in charge_cycles:
-            ax.axvspan(cycle['start_time'], cycle['end_time'], color=(CYCLE_TYPE_COLORS[cycle['type']]),
-                       alpha=0.5, lw=0)
+    def get_raw_data(self, imei, begin, end):
+        charge_values = read_samples(
+            self.cursor.connection, imei, begin, end, ('Stamp', 'ChargingCurr', 'DischargeCurr'), ('soc_smooth',),
+            any_not_null=('ChargingCurr', 'DischargeCurr', 'soc_smooth'))
+
+        # the columns may be read-only maps of the sample store, so don't modify them in place
+        soc = charge_values['soc_smooth']
+        soc_diff = kernels.differentiate(soc, charge_values['Stamp'], delta_time=timedelta(hours=1))
+        soc = np.where(kernels.missing(soc), np.nan, soc)
+        return {
+            'Stamp': mdates.date2num(charge_values['Stamp']),
+            'soc': soc,
+            'soc_diff': kernels.smooth(soc_diff),
+            'charging': kernels.smooth(charge_values['ChargingCurr']) / 200,
+            'discharge': -discharge_curr_to_ampere(kernels.smooth(charge_values['DischargeCurr'])),
+        }
+
+    def get_rollup_data(self, imei, begin, end, resolution):
+        rollup = Rollup.select_rollup(self.cursor, imei, resolution, begin, end)
+        stamps = mdates.date2num([x['bucket'] + resolution / 2 for x in rollup])
+        soc = self.column(rollup, 'soc_mean')
+        return {
+            'Stamp': stamps,
+            'soc': soc,
+            'soc_envelope': (self.column(rollup, 'soc_min'), self.column(rollup, 'soc_max')),
+            # stamps are in days, the delta is shown per hour
+            'soc_diff': np.gradient(soc, stamps) / 24 if len(soc) > 1 else np.full_like(soc, np.nan),
+            'charging': self.column(rollup, 'charging_mean') / 200,
+            'charging_envelope': (self.column(rollup, 'charging_min') / 200,
+                                  self.column(rollup, 'charging_max') / 200),
+            'discharge': -discharge_curr_to_ampere(self.column(rollup, 'discharge_mean')),
+            'discharge_envelope': (-discharge_curr_to_ampere(self.column(rollup, 'discharge_max')),
+                                   -discharge_curr_to_ampere(self.column(rollup, 'discharge_min'))),
+        }
+
+    def setup_axes(self, ax):
+        self.add_line('soc', 'b-', label="State of Charge", alpha=0.9)
+        self.add_line('soc_diff', 'm-', label="delta State of Charge", alpha=0.9)
+        self.add_line('charging', 'g-', label="Charging Current", alpha=0.9)
+        self.add_line('discharge', 'r-', label="Discharging Current", alpha=0.9)
 
         handles = list(ax.get_legend_handles_labels()[0])
         handles.append(mpatches.Patch(color='y', label='Trips'))
         handles.append(mpatches.Patch(color=CYCLE_TYPE_COLORS['C'], label='Charging Cycles [ChargingCurr]'))
         handles.append(mpatches.Patch(color=CYCLE_TYPE_COLORS['D'], label='Charging Cycles [DischargeCurr]'))
         handles.append(mpatches.Patch(color=CYCLE_TYPE_COLORS['s'], label='Charging Cycles [soc_smooth]'))
-        legend = ax.legend(handles=handles, loc='upper right')
-        legend.set_visible(legend_visible)
+        ax.legend(handles=handles, loc='upper right')
 
-        ax.set_title("{} -- {}-{}".format(imei, begin.year, begin.month))
-        ax.set_xlim(begin, end)
         ax.set_ylim(-3, 5)
         ax.xaxis.set_major_locator(mdates.DayLocator())
         ax.xaxis.set_major_formatter(mdates.DateFormatter('%d'))
         ax.fmt_xdata = mdates.DateFormatter('%d. %H:%M.%S')
-        self.fig.tight_layout()
+
+    def draw_figure_async(self, imei, begin, end, *data):
+        charge_values, charge_cycles, trips = data
+        ax = self.get_axes()
+
+        self.update_series(charge_values)
+
+        self.update_spans('trips', [trip['start_time'] for trip in trips], [trip['end_time'] for trip in trips],
+                          color='y', alpha=0.5, lw=0)
+        for type, color in CYCLE_TYPE_COLORS.items():
+            cycles = [cycle for cycle in charge_cycles if cycle['type'] == type]
+            self.update_spans('cycles_' + type, [cycle['start_time'] for cycle in cycles],
+                              [cycle['end_time'] for cycle in cycles], color=color, alpha=0.5, lw=0)
+
+        ax.set_title("{} -- {}-{}".format(imei, begin.year, begin.month))
+        ax.set_xlim(begin, end)
+
+    def update_series(self, charge_values):
+        stamps = charge_values['Stamp']
+        self.update_line('soc', stamps, charge_values['soc'], envelope=charge_values.get('soc_envelope'))
+        self.update_line('soc_diff', stamps, charge_values['soc_diff'])
+        self.update_line('charging', stamps, charge_values['charging'],
+                         envelope=charge_values.get('charging_envelope'))
+        self.update_line('discharge', stamps, charge_values['discharge'],
+                         envelope=charge_values.get('discharge_envelope'))
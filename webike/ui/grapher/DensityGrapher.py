@@ -1,44 +1,101 @@
+import hashlib
+
+import numpy as np
 from iss4e.util import BraceMessage as __
 from matplotlib.ticker import FuncFormatter, MultipleLocator
 
+from webike.data import Rollup
 from webike.ui.Grapher import Grapher
+from webike.util import DB
 
 
 class DensityGrapher(Grapher):
     def get_data_async(self, imei, begin, end):
-        self.cursor.execute(
-            """SELECT YEAR(Stamp) AS year, MONTH(Stamp) AS month, COUNT(Stamp) AS count
-            FROM imei{imei} imei
-            GROUP BY year, month
-            ORDER BY year, month ASC"""
-                .format(imei=imei))
-        return self.cursor.fetchall()
+        return Rollup.select_density(self.cursor, [imei])
+
+    def get_fingerprint_queries(self, imei, begin, end):
+        return [self.get_density_fingerprint_query([imei])]
+
+    @staticmethod
+    def get_density_fingerprint_query(imeis):
+        return ("SELECT imei, SUM(sample_count) AS count, MAX(bucket) AS max FROM webike_sfink.rollup "
+                "WHERE resolution = %s AND imei IN ({}) GROUP BY imei".format(", ".join(["%s"] * len(imeis))),
+                [int(Rollup.RESOLUTIONS[-1].total_seconds())] + list(imeis))
 
     def draw_figure_async(self, imei, begin, end, *data):
         if len(data) >= 1 and (data[0]['year'] < 2000 or data[0]['month'] < 1):
             self.logger.warning(__("IMEI {} has NULL row: {}", imei, data[0]))
-        counts = [r for r in data if r['year'] > 0 and r['month'] > 0]
+        counts = [r for r in data if r['year'] > 2000 and r['month'] > 0]
 
         self.fig.clear()
         ax = self.fig.add_subplot(111)
 
         ax.bar(
-            left=[r['year'] * 12 + r['month'] - 1 for r in counts],
-            height=[r['count'] for r in counts],
+            [r['year'] * 12 + r['month'] - 1 for r in counts],
+            [r['count'] for r in counts],
             width=1, align='center'
         )
 
         ax.set_title("Data Density for {}".format(imei))
-        ax.xaxis.set_major_formatter(FuncFormatter(lambda x, pos: str(int(x // 12))))
-        ax.xaxis.set_major_locator(MultipleLocator(12))
-        ax.xaxis.set_minor_formatter(FuncFormatter(lambda x, pos: str(int(x % 12 + 1))))
-        ax.xaxis.set_minor_locator(MultipleLocator(1))
-        for tick in ax.xaxis.get_major_ticks():
-            tick.label.set_ha('right')
-            tick.label.set_rotation(45)
-            tick.label.set_rotation_mode('default')
+        self.format_month_axis(ax.xaxis)
         self.fig.tight_layout()
 
+    @staticmethod
+    def format_month_axis(axis):
+        axis.set_major_formatter(FuncFormatter(lambda x, pos: str(int(x // 12))))
+        axis.set_major_locator(MultipleLocator(12))
+        axis.set_minor_formatter(FuncFormatter(lambda x, pos: str(int(x % 12 + 1))))
+        axis.set_minor_locator(MultipleLocator(1))
+        for tick in axis.get_major_ticks():
+            tick.label1.set_ha('right')
+            tick.label1.set_rotation(45)
+            tick.label1.set_rotation_mode('default')
+
     @classmethod
     def requires_month(cls):
         return False
+
+
+class FleetDensityGrapher(DensityGrapher):
+    """Number of samples per month for all IMEIs in the DB as one heatmap, the selected IMEI is ignored"""
+
+    def get_imeis(self):
+        return DB.discover_imeis(self.cursor.connection)
+
+    def get_data_async(self, imei, begin, end):
+        imeis = self.get_imeis()
+        return imeis, Rollup.select_density(self.cursor, imeis)
+
+    def get_cache_key(self, imei, begin, end):
+        return type(self), None, begin, end, self.raw
+
+    def get_fingerprint(self, imei, begin, end):
+        # the grid also gets a row for new devices that don't have any rollups yet
+        return hashlib.sha1(repr((self.get_imeis(), super().get_fingerprint(imei, begin, end))).encode()).hexdigest()
+
+    def get_fingerprint_queries(self, imei, begin, end):
+        return [self.get_density_fingerprint_query(self.get_imeis())]
+
+    def draw_figure_async(self, imei, begin, end, imeis, rows):
+        counts = [r for r in rows if r['year'] > 2000 and r['month'] > 0]
+        self.fig.clear()
+        ax = self.fig.add_subplot(111)
+        if not counts:
+            ax.set_title("No data")
+            return
+
+        months = [r['year'] * 12 + r['month'] - 1 for r in counts]
+        first = min(months)
+        grid = np.full((len(imeis), max(months) - first + 1), np.nan)
+        for r, month in zip(counts, months):
+            grid[imeis.index(r['imei']), month - first] = r['count']
+
+        mesh = ax.pcolormesh(np.arange(first, max(months) + 2) - 0.5, np.arange(len(imeis) + 1) - 0.5,
+                             np.ma.masked_invalid(grid))
+        self.fig.colorbar(mesh, ax=ax, label="Samples")
+
+        ax.set_title("Data Density for all IMEIs")
+        ax.set_yticks(range(len(imeis)))
+        ax.set_yticklabels(imeis)
+        self.format_month_axis(ax.xaxis)
+        self.fig.tight_layout()
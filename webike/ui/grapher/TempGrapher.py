@@ -1,55 +1,84 @@
 import numpy as np
-from iss4e.util.math import smooth
 from matplotlib import dates as mdates
 
+from webike.data import Rollup
 from webike.ui.Grapher import Grapher
+from webike.util import kernels
+from webike.util.store import read_samples
+from webike.util.weather import DEFAULT_TOLERANCE, join_weather
 
 
 class TempGrapher(Grapher):
+    SERIES = ('temp_battery', 'temp_box', 'press', 'ambient')
+
     def get_data_async(self, imei, begin, end):
-        self.cursor.execute(
-            """SELECT Stamp, TempBattery, TempBox, AtmosPress
-            FROM imei{imei} imei
-            WHERE Stamp >= '{min}' AND Stamp <= '{max}'
-            ORDER BY Stamp ASC"""
-                .format(imei=imei, min=begin, max=end))
-        charge_values = self.cursor.fetchall()
-        charge_values = smooth(charge_values, 'TempBattery', alpha=0.75)
-        charge_values = smooth(charge_values, 'TempBox', alpha=0.75)
-        charge_values = list(charge_values)  # smooth returns an iterator, this forces generation of all elements
-        return charge_values
+        return (self.get_series(imei, begin, end),)
 
-    def draw_figure_async(self, imei, begin, end, *data):
-        temp = data
-
-        legend = self.fig.add_subplot(111).legend_
-        legend_visible = not legend or legend.get_visible()
-        self.fig.clear()
-        ax = self.fig.add_subplot(111)
-
-        ax.plot(
-            list([x['Stamp'] for x in temp]),
-            list([x['TempBattery_smooth'] or np.nan for x in temp]),
-            'b-', label="Battery Temperature °C", alpha=0.9
-        )
-        ax.plot(
-            list([x['Stamp'] for x in temp]),
-            list([x['TempBox_smooth'] or np.nan for x in temp]),
-            'g-', label="Box Temperature °C", alpha=0.9
-        )
-        ax.plot(
-            list([x['Stamp'] for x in temp]),
-            list([x['AtmosPress'] / 1000 * 30 if x['AtmosPress'] else np.nan for x in temp]),
-            'r-', label="Pressure", alpha=0.9
-        )
-
-        legend = ax.legend(loc='upper right')
-        legend.set_visible(legend_visible)
+    def get_series(self, imei, begin, end):
+        return self.get_session_series(imei, begin, end)
+
+    def get_fingerprint_queries(self, imei, begin, end):
+        return super().get_fingerprint_queries(imei, begin, end) + [
+            ("SELECT COUNT(datetime) AS count, MAX(datetime) AS max FROM webike_sfink.weather "
+             "WHERE datetime >= %s AND datetime <= %s", (begin - DEFAULT_TOLERANCE, end))
+        ]
+
+    def get_ambient(self, stamps):
+        """Temperature of the last weather.gc.ca observation before each stamp"""
+        return join_weather(self.cursor.connection, stamps, 'gc', columns=['temp'])['gc_temp']
+
+    def get_raw_data(self, imei, begin, end):
+        temp = read_samples(self.cursor.connection, imei, begin, end, ('Stamp', 'TempBattery', 'TempBox', 'AtmosPress'))
+
+        # the columns may be read-only maps of the sample store, so don't modify them in place
+        press = temp['AtmosPress']
+        press = np.where(kernels.missing(press), np.nan, press)
+        return {
+            'Stamp': mdates.date2num(temp['Stamp']),
+            'temp_battery': kernels.smooth(temp['TempBattery'], alpha=0.75),
+            'temp_box': kernels.smooth(temp['TempBox'], alpha=0.75),
+            'press': press / 1000 * 30,
+            'ambient': self.get_ambient(temp['Stamp']),
+        }
+
+    def get_rollup_data(self, imei, begin, end, resolution):
+        rollup = Rollup.select_rollup(self.cursor, imei, resolution, begin, end)
+        stamps = [x['bucket'] + resolution / 2 for x in rollup]
+        return {
+            'Stamp': mdates.date2num(stamps),
+            'temp_battery': self.column(rollup, 'temp_battery_mean'),
+            'temp_battery_envelope': (self.column(rollup, 'temp_battery_min'),
+                                      self.column(rollup, 'temp_battery_max')),
+            'temp_box': self.column(rollup, 'temp_box_mean'),
+            'temp_box_envelope': (self.column(rollup, 'temp_box_min'), self.column(rollup, 'temp_box_max')),
+            'press': self.column(rollup, 'atmos_press_mean') / 1000 * 30,
+            'ambient': self.get_ambient(stamps),
+        }
+
+    def setup_axes(self, ax):
+        self.add_line('temp_battery', 'b-', label="Battery Temperature °C", alpha=0.9)
+        self.add_line('temp_box', 'g-', label="Box Temperature °C", alpha=0.9)
+        self.add_line('press', 'r-', label="Pressure", alpha=0.9)
+        self.add_line('ambient', 'c-', label="Ambient Temperature °C", alpha=0.9)
+        ax.legend(loc='upper right')
 
-        ax.set_title("{} -- {}-{}".format(imei, begin.year, begin.month))
-        ax.set_xlim(begin, end)
         ax.set_ylim(-10, 30)
         ax.xaxis.set_major_locator(mdates.DayLocator())
         ax.xaxis.set_major_formatter(mdates.DateFormatter('%d'))
         ax.fmt_xdata = mdates.DateFormatter('%d. %H:%M.%S')
-        self.fig.tight_layout()
+
+    def draw_figure_async(self, imei, begin, end, *data):
+        temp, = data
+        ax = self.get_axes()
+
+        self.update_series(temp)
+
+        ax.set_title("{} -- {}-{}".format(imei, begin.year, begin.month))
+        ax.set_xlim(begin, end)
+
+    def update_series(self, temp):
+        stamps = temp['Stamp']
+        self.update_line('temp_battery', stamps, temp['temp_battery'], envelope=temp.get('temp_battery_envelope'))
+        self.update_line('temp_box', stamps, temp['temp_box'], envelope=temp.get('temp_box_envelope'))
+        self.update_line('press', stamps, temp['press'])
+        self.update_line('ambient', stamps, temp['ambient'])
@@ -0,0 +1,267 @@
+"""Database access shared by the UI and the preprocess stages
+
+Values are always passed as query parameters. Only table and column names are inserted into the SQL text,
+and only after being checked against the format of IMEIs and the known columns. The SQL of the recurring lookups is
+built once per IMEI and reused afterwards.
+
+Besides the MySQL server, the data can also be stored in local SQLite files (see webike.util.sqlite), which is
+selected by setting `webike.backend = sqlite` in the config. The few queries that can't be written portably get
+their dialect-specific parts from the functions at the end of this module.
+"""
+import contextlib
+import queue
+import re
+import threading
+from functools import lru_cache
+
+from iss4e.db import mysql
+from iss4e.db.mysql import DictCursor, StreamingDictCursor
+from iss4e.util.config import load_config
+from pymysql.connections import Connection
+
+from webike.util import sqlite
+
+__author__ = "Niko Fink"
+
+MYSQL = "mysql"
+SQLITE = "sqlite"
+
+# devices are identified by the last 4 digits of their IMEI, which also name their imei{imei} and trip{imei} tables
+IMEI_RE = re.compile(r"^[0-9]{4}$")
+# columns of the imei{imei} tables that may be used in generated queries
+SAMPLE_COLUMNS = ['Stamp', 'BatteryVoltage', 'ChargingCurr', 'DischargeCurr', 'TempBattery', 'TempBox', 'AtmosPress']
+# columns of webike_sfink.soc that may be used in generated queries
+SOC_COLUMNS = ['volt', 'volt_smooth', 'temp', 'temp_smooth', 'soc', 'soc_smooth']
+
+
+def default_credentials():
+    """Connection parameters from the webike.mysql config, named like the arguments of pymysql's Connection"""
+    config = load_config()['webike.mysql']
+    cred = {'host': 'localhost', 'port': 3306, 'db': 'webike', 'user': '', 'passwd': ''}
+    aliases = {'db': 'database', 'passwd': 'password'}
+    for key in cred:
+        for name in (aliases.get(key), key):
+            if name and name in config:
+                cred[key] = config[name]
+    return cred
+
+
+def connect(backend=None):
+    """Open a connection using the webike.mysql or webike.sqlite config, depending on the configured backend"""
+    config = load_config()
+    backend = backend or config.get('webike.backend', MYSQL)
+    if backend == SQLITE:
+        return sqlite.connect(**config['webike.sqlite'])
+    elif backend == MYSQL:
+        return mysql.connect(**config['webike.mysql'])
+    else:
+        raise ValueError("Unknown backend {!r}".format(backend))
+
+
+class ConnectionPool(object):
+    """Thread-safe pool handing out up to `size` connections, which are reused after they are returned
+
+    The connections are opened using `connect()` if given, otherwise as MySQL connections using the credentials.
+    """
+
+    def __init__(self, size=2, connect=None, **cred):
+        self.size = size
+        self.cred = cred
+        self.connect = connect or (lambda: Connection(**self.cred))
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                break
+            try:
+                # check again from time to time, as a discarded connection allows opening a new one
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                pass
+        try:
+            return self.connect()
+        except:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def put(self, connection):
+        self.idle.put(connection)
+
+    def discard(self, connection):
+        """Close a connection that can't be reused instead of returning it, so that a new one can be opened"""
+        try:
+            connection.close()
+        finally:
+            with self.lock:
+                self.created -= 1
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.get()
+        try:
+            yield connection
+        finally:
+            self.put(connection)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+########################################################################################################################
+# Table and column names
+
+def check_imei(imei):
+    if not isinstance(imei, str) or not IMEI_RE.match(imei):
+        raise ValueError("Invalid IMEI {!r}".format(imei))
+    return imei
+
+
+def discover_imeis(connection):
+    """IMEIs of all devices that have a sample table in the DB, which also includes devices not listed in IMEIS"""
+    with connection.cursor() as cursor:
+        if dialect(connection) == SQLITE:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'imei%'")
+        else:
+            cursor.execute("SHOW TABLES LIKE 'imei%'")
+        tables = [row[0] for row in cursor.fetchall()]
+    return sorted(table[4:] for table in tables if IMEI_RE.match(table[4:]))
+
+
+def sample_table(imei):
+    return "imei" + check_imei(imei)
+
+
+def trip_table(imei):
+    return "trip" + check_imei(imei)
+
+
+def check_columns(columns, allowed):
+    for column in columns:
+        if column not in allowed:
+            raise ValueError("Unknown column {!r}".format(column))
+    return columns
+
+
+########################################################################################################################
+# Recurring lookups
+
+def qualify(column):
+    return ("soc." if column in SOC_COLUMNS else "imei.") + column
+
+
+@lru_cache(maxsize=None)
+def samples_sql(imei, columns, soc_columns=(), not_null=(), any_not_null=(), soc_join="LEFT OUTER", until=True):
+    """SELECT the given columns of all samples since %s (and until %s), optionally joined with their SoC estimation
+
+    Samples are skipped if any of the `not_null` columns is NULL or 0 or if all of the `any_not_null` columns are NULL.
+    Use `soc_join="INNER"` to also skip samples without SoC estimation.
+    """
+    check_columns(columns, SAMPLE_COLUMNS)
+    check_columns(soc_columns, SOC_COLUMNS)
+    check_columns(not_null + any_not_null, SAMPLE_COLUMNS + SOC_COLUMNS)
+    if soc_join not in ("LEFT OUTER", "INNER"):
+        raise ValueError("Unknown join {!r}".format(soc_join))
+
+    select = ["imei.{}".format(c) for c in columns] + ["soc.{0} AS {0}".format(c) for c in soc_columns]
+    sql = "SELECT {} FROM {} imei ".format(", ".join(select), sample_table(imei))
+    if soc_columns or any(c in SOC_COLUMNS for c in not_null + any_not_null):
+        sql += "{} JOIN webike_sfink.soc soc ON imei.Stamp = soc.time AND soc.imei = '{}' ".format(soc_join, imei)
+    sql += "WHERE imei.Stamp >= %s"
+    if until:
+        sql += " AND imei.Stamp <= %s"
+    for column in not_null:
+        sql += " AND {0} IS NOT NULL AND {0} != 0".format(qualify(column))
+    if any_not_null:
+        sql += " AND ({})".format(" OR ".join("{} IS NOT NULL".format(qualify(c)) for c in any_not_null))
+    return sql + " ORDER BY imei.Stamp ASC"
+
+
+def select_cycles(cursor, imei, begin, end, type=None):
+    """Charge cycles of the IMEI overlapping [begin, end], optionally only those of the given type"""
+    if type:
+        cursor.execute(
+            "SELECT * FROM webike_sfink.charge_cycles "
+            "WHERE imei = %s AND end_time >= %s AND start_time <= %s AND type = %s "
+            "ORDER BY start_time ASC",
+            (check_imei(imei), begin, end, type))
+    else:
+        cursor.execute(
+            "SELECT * FROM webike_sfink.charge_cycles "
+            "WHERE imei = %s AND end_time >= %s AND start_time <= %s "
+            "ORDER BY start_time ASC",
+            (check_imei(imei), begin, end))
+    return cursor.fetchall()
+
+
+def select_trips(cursor, imei, begin, end):
+    """Trips of the IMEI overlapping [begin, end]"""
+    cursor.execute(
+        "SELECT * FROM {} WHERE end_time >= %s AND start_time <= %s ORDER BY start_time ASC"
+            .format(trip_table(imei)),
+        (begin, end))
+    return cursor.fetchall()
+
+
+def select_sessions(cursor, imei, begin, end):
+    """Sampling sessions of the IMEI overlapping [begin, end], see webike.data.Sessions"""
+    cursor.execute(
+        "SELECT * FROM webike_sfink.sessions "
+        "WHERE imei = %s AND end_time >= %s AND start_time <= %s "
+        "ORDER BY start_time ASC",
+        (check_imei(imei), begin, end))
+    return cursor.fetchall()
+
+
+########################################################################################################################
+# SQL dialects
+
+def dialect(connection):
+    """Backend of the connection or cursor, either MYSQL or SQLITE"""
+    return getattr(connection, "dialect", MYSQL)
+
+
+def on_duplicate_update(connection, key, columns=()):
+    """Clause for an INSERT to update `columns` of the existing row instead of failing if the `key` already exists
+
+    Without `columns`, the existing row is kept and the new one is ignored.
+    """
+    if dialect(connection) == SQLITE:
+        if not columns:
+            return "ON CONFLICT ({}) DO NOTHING".format(", ".join(key))
+        return "ON CONFLICT ({}) DO UPDATE SET {}".format(
+            ", ".join(key), ", ".join("{0} = excluded.{0}".format(c) for c in columns))
+    else:
+        if not columns:
+            return "ON DUPLICATE KEY UPDATE {0} = {0}".format(key[0])
+        return "ON DUPLICATE KEY UPDATE " + ", ".join("{0} = VALUES({0})".format(c) for c in columns)
+
+
+def bucket_start(connection, stamp, seconds):
+    """Expression for the start of the bucket of `seconds` width containing the `stamp` column
+
+    The buckets are aligned to the midnight of the local day of the stamp instead of the UNIX epoch, so that daily
+    buckets contain the local days, independent of the time zone of the DB session. `seconds` has to divide a day.
+    As the expression contains a literal percent sign, the query has to be executed with arguments.
+    """
+    if dialect(connection) == SQLITE:
+        # STRFTIME('%s') treats the stamp as UTC, so its remainder of a day are the seconds since the local midnight
+        return ("DATETIME(DATE({0}), '+' || (CAST(STRFTIME('%%s', {0}) AS INTEGER) %% 86400 / {1} * {1}) || ' seconds')"
+                .format(stamp, int(seconds)))
+    else:
+        return "DATE({0}) + INTERVAL FLOOR(TIME_TO_SEC({0}) / {1}) * {1} SECOND".format(stamp, int(seconds))
@@ -27,11 +27,13 @@ class ActivityDetection(object):
     def accumulate_samples(self, sample, accumulator):
         return None
 
-    def __call__(self, cycle_samples) -> (List[Cycle], List[Cycle]):
+    def __call__(self, cycle_samples, finish=False) -> (List[Cycle], List[Cycle]):
+        """Detect the cycles in the samples, a cycle still running after the last sample is only stored if `finish`"""
         self.cycles = []
         self.discarded_cycles = []
         self.cycle_start = None
         self.cycle_acc = None
+        sample = None
         for previous, sample in zip_prev(cycle_samples):
             # did cycle start?
             if not self.cycle_start:
@@ -53,6 +55,10 @@ class ActivityDetection(object):
                     self.cycle_start = None
                     self.cycle_acc = None
 
+        if finish and self.cycle_start:
+            self.store_cycle(Cycle(
+                start=self.cycle_start, end=sample,
+                stats=self.cycle_acc, reject_reason=None))
         return self.cycles, self.discarded_cycles
 
     def store_cycle(self, cycle: Cycle):
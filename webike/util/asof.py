@@ -0,0 +1,67 @@
+"""As-of joins, which match each stamp of a sorted sample column to the row of a sorted time series closest to it
+
+Matching works by binary search of all stamps at once, so that millions of samples are aligned without a query per
+sample. `backward` matches the last row at or before each stamp, i.e. the last known value, `forward` the first row at
+or after it and `nearest` the closer one of both, preferring the earlier row on ties.
+"""
+import numpy as np
+
+from webike.util.fetch import STAMP
+
+__author__ = "Niko Fink"
+
+DIRECTIONS = ['backward', 'forward', 'nearest']
+
+
+def asof_index(stamps, times, tolerance=None, direction='backward'):
+    """Index of the row of `times` matched to each stamp, or -1 if there is none within `tolerance`"""
+    stamps = np.asarray(stamps, dtype=STAMP)
+    times = np.asarray(times, dtype=STAMP)
+    if not len(times):
+        return np.full(len(stamps), -1)
+    before = np.searchsorted(times, stamps, side='right') - 1
+    after = np.searchsorted(times, stamps, side='left')
+    after[after >= len(times)] = -1
+
+    if direction == 'backward':
+        idx = before
+    elif direction == 'forward':
+        idx = after
+    elif direction == 'nearest':
+        idx = before.copy()
+        # take the row after the stamp if there is none before it or it is closer
+        closer = (after >= 0) & ((before < 0) | (times[after] - stamps < stamps - times[np.maximum(before, 0)]))
+        idx[closer] = after[closer]
+    else:
+        raise ValueError("Unknown direction {!r}".format(direction))
+
+    if tolerance is not None:
+        distance = np.abs(times[np.maximum(idx, 0)] - stamps)
+        idx[distance > np.timedelta64(tolerance)] = -1
+    return idx
+
+
+def asof_join(stamps, series, on='time', tolerance=None, direction='backward', prefix=""):
+    """Align the columns of `series`, which is sorted by its column `on`, to the stamps
+
+    Returns one column per column of `series` with the same length as `stamps`, named with the given `prefix`.
+    Values of stamps without a match are NaN, NaT or None, depending on the type of the column.
+    """
+    idx = asof_index(stamps, series[on], tolerance, direction)
+    unmatched = idx < 0
+    joined = {}
+    for name, column in series.items():
+        column = np.asarray(column)
+        if len(column):
+            values = column[np.maximum(idx, 0)]
+        else:
+            values = np.empty(len(idx), dtype=column.dtype)
+        if values.dtype.kind == 'f':
+            values[unmatched] = np.nan
+        elif values.dtype.kind == 'M':
+            values[unmatched] = np.datetime64('NaT')
+        else:
+            values = values.astype(object)
+            values[unmatched] = None
+        joined[prefix + name] = values
+    return joined
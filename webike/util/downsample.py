@@ -0,0 +1,75 @@
+import numpy as np
+
+__author__ = "Niko Fink"
+
+
+def minmax(x, y, buckets):
+    """Reduce the series to the min and max sample of `buckets` equally wide x intervals, e.g. one per pixel column
+
+    As the extreme values of each interval are retained, short spikes stay visible after the reduction.
+    Intervals that contain missing (NaN) values keep one of them, so that gaps in the line are preserved.
+    The returned samples keep their original order.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) <= 2 * buckets:
+        return x, y
+
+    edges = np.linspace(x[0], x[-1], buckets + 1)
+    bucket = np.searchsorted(edges[1:-1], x, side='right')
+    missing = np.isnan(y)
+
+    # sort valid samples by bucket, then by value: first sample of each bucket is its min, last one its max
+    valid_idx = np.flatnonzero(~missing)
+    order = valid_idx[np.lexsort((y[valid_idx], bucket[valid_idx]))]
+    sorted_bucket = bucket[order]
+    _, first = np.unique(sorted_bucket, return_index=True)
+    _, last = np.unique(sorted_bucket[::-1], return_index=True)
+    last = len(order) - 1 - last
+
+    missing_idx = np.flatnonzero(missing)
+    _, first_missing = np.unique(bucket[missing_idx], return_index=True)
+
+    keep = np.unique(np.concatenate((order[first], order[last], missing_idx[first_missing])))
+    return x[keep], y[keep]
+
+
+def lttb(x, y, threshold):
+    """Reduce the series to `threshold` samples using the Largest-Triangle-Three-Buckets algorithm
+
+    See Sveinn Steinarsson, "Downsampling Time Series for Visual Representation", 2013.
+    Missing (NaN) values are dropped before the reduction.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = ~np.isnan(y)
+    x, y = x[valid], y[valid]
+    if threshold < 3 or len(x) <= threshold:
+        return x, y
+
+    edges = np.linspace(1, len(x) - 1, threshold - 1).astype(int)
+    keep = np.empty(threshold, dtype=int)
+    keep[0] = 0
+    keep[-1] = len(x) - 1
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        # the average of the next bucket is the third point of the triangle, the last bucket uses the last sample
+        if i + 2 < len(edges):
+            avg_x = x[stop:edges[i + 2]].mean()
+            avg_y = y[stop:edges[i + 2]].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+        prev_x, prev_y = x[keep[i]], y[keep[i]]
+        area = np.abs((prev_x - avg_x) * (y[start:stop] - prev_y) - (prev_x - x[start:stop]) * (avg_y - prev_y))
+        keep[i + 1] = start + np.argmax(area)
+    return x[keep], y[keep]
+
+
+def downsample(x, y, width, method='minmax'):
+    """Reduce the series to about as many samples as needed to draw it `width` pixels wide"""
+    if method == 'minmax':
+        return minmax(x, y, int(width))
+    elif method == 'lttb':
+        return lttb(x, y, 2 * int(width))
+    else:
+        raise ValueError("Unknown downsampling method {}".format(method))
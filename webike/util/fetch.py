@@ -0,0 +1,38 @@
+import numpy as np
+from pymysql.cursors import SSCursor
+
+__author__ = "Niko Fink"
+
+STAMP = 'datetime64[us]'
+
+
+def fetch_columns(connection, sql, columns, args=None, size_hint=2 ** 16, chunk_size=10000):
+    """Stream the result of `sql` from an unbuffered cursor into one typed NumPy array per column
+
+    `columns` is a list of (name, dtype) tuples in the order of the selected columns, e.g.
+    `[('Stamp', STAMP), ('ChargingCurr', float)]`. NULL values become NaN or NaT.
+    The arrays are preallocated with `size_hint` entries and grow by doubling, so that only `chunk_size` rows
+    exist as Python objects at any time.
+    """
+    capacity = size_hint
+    arrays = [np.empty(capacity, dtype=dtype) for name, dtype in columns]
+    count = 0
+    with connection.cursor(SSCursor) as cursor:
+        cursor.execute(sql, args)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            if count + len(rows) > capacity:
+                while count + len(rows) > capacity:
+                    capacity *= 2
+                arrays = [np.resize(array, capacity) for array in arrays]
+            for nr, array in enumerate(arrays):
+                array[count:count + len(rows)] = [row[nr] for row in rows]
+            count += len(rows)
+    return dict((name, array[:count]) for (name, dtype), array in zip(columns, arrays))
+
+
+def to_columns(rows, columns):
+    """Convert a chunk of row tuples into one typed NumPy array per column like `fetch_columns`"""
+    return dict((name, np.array([row[nr] for row in rows], dtype=dtype)) for nr, (name, dtype) in enumerate(columns))
@@ -0,0 +1,87 @@
+"""Histograms with fixed bins, which are updated chunk by chunk so that their memory use doesn't grow with the data"""
+import collections
+import itertools
+
+import numpy as np
+
+__author__ = "Niko Fink"
+
+
+class FixedHistogram(object):
+    """Counts of values in the bins of `width` from `lo` to `hi`, plus the values below and above them"""
+
+    def __init__(self, lo, hi, width):
+        self.edges = np.linspace(lo, hi, int(round((hi - lo) / width)) + 1)
+        # counts[0] are the values below lo, counts[-1] those at or above hi
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.missing = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        self.missing += int(np.count_nonzero(~valid))
+        self.counts += np.bincount(np.searchsorted(self.edges, values[valid], side='right'),
+                                   minlength=len(self.counts))
+
+    def mode(self):
+        """Lower edge of the bin containing the most values, or None if no value lies within the bins"""
+        bins = self.counts[1:-1]
+        return float(self.edges[np.argmax(bins)]) if bins.any() else None
+
+    def to_dict(self):
+        return {
+            'edges': self.edges.tolist(),
+            'counts': self.counts[1:-1].tolist(),
+            'below': int(self.counts[0]),
+            'above': int(self.counts[-1]),
+            'missing': self.missing,
+        }
+
+
+class Histograms(object):
+    """Fixed histograms of numeric fields and counters of categorical fields, both updated from chunks of dict rows
+
+    `bins` maps each numeric field to the (lo, hi, width) of its histogram, `categories` maps each categorical field
+    to the separator between the multiple values it may contain, or None if it only contains a single value.
+    """
+
+    def __init__(self, bins, categories=None):
+        self.histograms = collections.OrderedDict((field, FixedHistogram(*b)) for field, b in sorted(bins.items()))
+        self.categories = categories or {}
+        self.counters = collections.OrderedDict((field, collections.Counter()) for field in sorted(self.categories))
+        self.rows = 0
+
+    def update(self, rows):
+        self.rows += len(rows)
+        for field, hist in self.histograms.items():
+            hist.update([row[field] for row in rows])
+        for field, counter in self.counters.items():
+            sep = self.categories[field]
+            for row in rows:
+                value = row[field]
+                if value is None:
+                    continue
+                counter.update(value.split(sep) if sep else [value])
+
+    def to_dict(self):
+        data = dict((field, hist.to_dict()) for field, hist in self.histograms.items())
+        data.update((field, dict(counter)) for field, counter in self.counters.items())
+        data['rows'] = self.rows
+        return data
+
+
+def stream_histograms(rows, bins, categories=None, group=None, chunk_size=10000):
+    """Consume the rows chunk by chunk into one Histograms per group, as returned by `group(row)`"""
+    hists = collections.OrderedDict()
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return hists
+        groups = collections.defaultdict(list)
+        for row in chunk:
+            groups[group(row) if group else None].append(row)
+        for key, group_rows in groups.items():
+            if key not in hists:
+                hists[key] = Histograms(bins, categories)
+            hists[key].update(group_rows)
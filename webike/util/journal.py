@@ -0,0 +1,158 @@
+"""Journal of the units of each preprocessing run, so that a crashed or failed run can be resumed where it stopped
+
+A unit is one stage for one IMEI, or for all of them if the stage is not `per_imei`, in which case its IMEI is
+GLOBAL, like for the work queue. Each unit is committed on its own and recorded in webike_sfink.run_journal with its
+state, the stamp of the last sample of its IMEI when it was started as input watermark, the rows it read and wrote
+and its duration. Running a stage again with the same run skips the units that are already done, so that only the
+failed units and those that were running when the process crashed are repeated.
+"""
+import collections
+import itertools
+import logging
+import time
+from datetime import datetime
+
+from iss4e.util import BraceMessage as __
+
+from webike.util import DB
+from webike.util.DB import DictCursor, on_duplicate_update
+from webike.util.sqlite import to_datetime
+from webike.util.stages import DONE, FAILED
+from webike.util.workqueue import RUNNING, GLOBAL
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+
+class RunJournal(object):
+    """Runs the stages of `run` unit by unit, skipping the units the journal already records as done"""
+
+    def __init__(self, run):
+        self.run = run
+
+    def run_stage(self, stage, connection, step=None):
+        """Run all units of the stage that are not done yet, committing each one on its own
+
+        The units of the other IMEIs are still run if one of them fails, afterwards the whole stage fails.
+        The rows read and written by each unit are taken from the measured `step` of the stage, if given.
+        """
+        with connection.cursor(DictCursor) as cursor:
+            done = set(imei for (name, imei), unit in self.load(cursor).items() if name == stage.name and
+                       unit['state'] == DONE)
+        imeis = DB.discover_imeis(connection) if stage.per_imei else [GLOBAL]
+        if done:
+            logger.info(__("Skipping {} of {} units of stage {} that are already done in run {}",
+                           len(done & set(imeis)), len(imeis), stage.name, self.run))
+
+        failed = [imei for imei in imeis if imei not in done and not self.run_unit(stage, connection, imei, step)]
+        if failed:
+            raise RuntimeError("Stage {} failed for {}, rerun it with run {} to resume".format(
+                stage.name, ", ".join(imei or "all IMEIs" for imei in failed), self.run))
+
+    def run_unit(self, stage, connection, imei, step=None):
+        """Run the stage for the IMEI, or for all of them if it is GLOBAL, and return whether it succeeded"""
+        watermark = self.watermark(connection, imei)
+        self.update(connection, stage.name, imei, RUNNING, watermark, started=datetime.now())
+
+        before = (step.rows_read, step.rows_written) if step else None
+        start = time.perf_counter()
+        try:
+            if imei == GLOBAL:
+                stage.func(connection)
+            else:
+                stage.func(connection, imeis=[imei])
+            connection.commit()
+            state = DONE
+        except Exception:
+            connection.rollback()
+            logger.error(__("{} of {} failed", stage.name, imei or "all IMEIs"), exc_info=True)
+            state = FAILED
+        wall_s = time.perf_counter() - start
+        rows = (step.rows_read - before[0], step.rows_written - before[1]) if step else (None, None)
+
+        self.update(connection, stage.name, imei, state, watermark, rows, datetime.now(), wall_s)
+        return state == DONE
+
+    @staticmethod
+    def watermark(connection, imei):
+        """Stamp of the last sample of the IMEI, i.e. the input the unit processes at most"""
+        if imei == GLOBAL:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT Stamp FROM {} ORDER BY Stamp DESC LIMIT 1".format(DB.sample_table(imei)))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def update(self, connection, stage, imei, state, watermark, rows=(None, None), finished=None, wall_s=None,
+               started=None):
+        """Record the state of the unit and commit it, keeping the start of units that already started"""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO webike_sfink.run_journal "
+                "(run, stage, imei, state, watermark, rows_read, rows_written, started, finished, wall_s) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) " +
+                on_duplicate_update(connection, ('run', 'stage', 'imei'),
+                                    ['state', 'watermark', 'rows_read', 'rows_written', 'finished', 'wall_s'] +
+                                    (['started'] if started else [])),
+                (self.run, stage, imei, state, watermark) + tuple(rows) + (started, finished, wall_s))
+        connection.commit()
+
+    def load(self, cursor):
+        cursor.execute("SELECT * FROM webike_sfink.run_journal WHERE run = %s ORDER BY started ASC", (self.run,))
+        return collections.OrderedDict(((unit['stage'], unit['imei']), unit) for unit in cursor.fetchall())
+
+    def stages(self, cursor):
+        """Summary of the units of each stage of the run, with the time from the first start to the last finish"""
+        return [summarize(stage, units) for stage, units in
+                itertools.groupby(sorted(self.load(cursor).values(), key=lambda unit: unit['stage']),
+                                  key=lambda unit: unit['stage'])]
+
+
+def runs(cursor, limit=10):
+    """Summary of the units of each of the last `limit` runs, most recent first"""
+    cursor.execute(
+        "SELECT run, COUNT(*) AS units, "
+        "SUM(CASE WHEN state = %s THEN 1 ELSE 0 END) AS done, "
+        "SUM(CASE WHEN state = %s THEN 1 ELSE 0 END) AS failed, "
+        "SUM(CASE WHEN state = %s THEN 1 ELSE 0 END) AS running, "
+        "MIN(started) AS started, MAX(finished) AS finished, SUM(wall_s) AS wall_s, "
+        "SUM(rows_read) AS rows_read, SUM(rows_written) AS rows_written "
+        "FROM webike_sfink.run_journal GROUP BY run ORDER BY MIN(started) DESC LIMIT %s",
+        (DONE, FAILED, RUNNING, limit))
+    summaries = []
+    for row in cursor.fetchall():
+        # SQLite only converts columns, not the result of aggregates, to datetimes
+        started, finished = to_datetime(row['started']), to_datetime(row['finished'])
+        summaries.append(collections.OrderedDict([
+            ('key', row['run']),
+            ('units', row['units']),
+            (DONE, int(row['done'])),
+            (FAILED, int(row['failed'])),
+            (RUNNING, int(row['running'])),
+            ('started', started),
+            ('finished', finished),
+            ('duration', finished - started if started and finished else None),
+            ('wall_s', round(float(row['wall_s'] or 0), 3)),
+            ('rows_read', int(row['rows_read'] or 0)),
+            ('rows_written', int(row['rows_written'] or 0)),
+        ]))
+    return summaries
+
+
+def summarize(key, units):
+    units = list(units)
+    started = [unit['started'] for unit in units if unit['started']]
+    finished = [unit['finished'] for unit in units if unit['finished']]
+    return collections.OrderedDict([
+        ('key', key),
+        ('units', len(units)),
+        (DONE, sum(1 for unit in units if unit['state'] == DONE)),
+        (FAILED, sum(1 for unit in units if unit['state'] == FAILED)),
+        (RUNNING, sum(1 for unit in units if unit['state'] == RUNNING)),
+        ('started', min(started) if started else None),
+        ('finished', max(finished) if finished else None),
+        ('duration', max(finished) - min(started) if started and finished else None),
+        ('wall_s', round(sum(unit['wall_s'] or 0 for unit in units), 3)),
+        ('rows_read', sum(unit['rows_read'] or 0 for unit in units)),
+        ('rows_written', sum(unit['rows_written'] or 0 for unit in units)),
+    ])
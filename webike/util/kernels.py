@@ -0,0 +1,108 @@
+"""Array versions of the smoothing and differentiation functions from iss4e.util.math
+
+The functions from iss4e.util.math work on generators of sample dicts, the ones here on NumPy columns as returned by
+webike.util.fetch.fetch_columns. In the same way as there, a value of 0 is considered missing, in addition to NaN.
+"""
+from datetime import timedelta
+
+import numpy as np
+from scipy.signal import lfilter
+
+__author__ = "Niko Fink"
+
+
+def missing(values):
+    """Mask of the values that iss4e.util.math treats as missing, i.e. NaN or 0"""
+    values = np.asarray(values, dtype=float)
+    return np.isnan(values) | (values == 0)
+
+
+def smooth(values, alpha=.95, initial=None):
+    """Exponentially smooth the values using `y[n] = alpha * y[n-1] + (1 - alpha) * x[n]`
+
+    Missing values stay missing (NaN) and the first value after them starts a new smoothing run with its raw value,
+    like `smooth(samples, label)` from iss4e.util.math does. If the smoothed value `initial` of the sample before the
+    first one is given, the first run continues from it.
+    """
+    values, first = _with_initial(values, initial)
+    miss = missing(values)
+    return _smooth_runs(values, miss, ~miss & np.r_[True, miss[:-1]], alpha)[first:]
+
+
+def smooth_reset_stale(values, stamps, max_gap, alpha=.95):
+    """Smooth the values like `smooth`, but also start a new run after each gap between two samples above `max_gap`
+
+    This is `smooth(samples, label, is_valid=smooth_reset_stale(max_gap))` from iss4e.util.math.
+    """
+    values = np.asarray(values, dtype=float)
+    stamps = np.asarray(stamps, dtype='datetime64[us]')
+    miss = missing(values)
+    stale = np.r_[True, np.diff(stamps) > np.timedelta64(max_gap)]
+    return _smooth_runs(values, miss, ~miss & (np.r_[True, miss[:-1]] | stale), alpha)
+
+
+def smooth_ignore_missing(values, alpha=.95, initial=None):
+    """Smooth the values like `smooth`, but keep the last smoothed value for missing values instead of starting anew
+
+    This is `smooth(samples, label, default_value=smooth_ignore_missing)` from iss4e.util.math, so only the values
+    before the first valid one (or `initial`) are NaN.
+    """
+    values, first = _with_initial(values, initial)
+    miss = missing(values)
+    valid_idx = np.flatnonzero(~miss)
+    smoothed = np.full(len(values), np.nan)
+    if len(valid_idx):
+        # smooth the valid values as one run and fill each missing value with the last smoothed one before it
+        starts = np.zeros(len(valid_idx), dtype=bool)
+        starts[0] = True
+        smoothed[valid_idx] = _smooth_runs(values[valid_idx], np.zeros(len(valid_idx), dtype=bool), starts, alpha)
+        last = np.maximum.accumulate(np.where(miss, -1, np.arange(len(values))))
+        smoothed = np.where(last >= 0, smoothed[np.maximum(last, 0)], np.nan)
+    return smoothed[first:]
+
+
+def _with_initial(values, initial):
+    """Prepend `initial` to the values unless it is missing, returns them and the index of the first original value"""
+    values = np.asarray(values, dtype=float)
+    if initial is None or missing(initial):
+        return values, 0
+    return np.r_[initial, values], 1
+
+
+def _smooth_runs(values, miss, starts, alpha):
+    """Smooth all runs of valid values, where each run begins at one of the `starts` with its raw value
+
+    The whole array is filtered at once by an IIR filter, whose input at the start of each run is the raw value
+    instead of the weighted one. The output there still contains `alpha * y[s-1]` left over from the previous run,
+    which then decays with `alpha ** (n - s + 1)` for all values `n` of the run starting at `s` and is subtracted.
+    """
+    if not starts.any():
+        return np.full(len(values), np.nan)
+    inpt = np.where(miss, 0, values * (1 - alpha))
+    inpt[starts] = values[starts]
+    filtered = lfilter([1], [1, -alpha], inpt)
+
+    start_idx = np.flatnonzero(starts)
+    run = np.cumsum(starts) - 1
+    run_start = start_idx[np.maximum(run, 0)]
+    idx = np.arange(len(values))
+    carry = np.where(run_start > 0, filtered[np.maximum(run_start - 1, 0)], 0)
+    with np.errstate(under='ignore'):
+        filtered -= carry * alpha ** (idx - run_start + 1)
+
+    filtered[miss | (run < 0)] = np.nan
+    return filtered
+
+
+def differentiate(values, stamps, delta_time=timedelta(seconds=1)):
+    """Change of the values between two consecutive samples per `delta_time`
+
+    The first value and those where the current or the previous value is missing are NaN.
+    """
+    values = np.asarray(values, dtype=float)
+    stamps = np.asarray(stamps, dtype='datetime64[us]')
+    diff = np.full(len(values), np.nan)
+    if len(values) > 1:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            diff[1:] = np.diff(values) / (np.diff(stamps) / np.timedelta64(delta_time))
+    return diff
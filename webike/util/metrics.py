@@ -0,0 +1,255 @@
+"""Performance metrics of the preprocessing stages and their per-IMEI steps
+
+A step is measured from entering until leaving `measure()` and records its wall time, the CPU time of its thread,
+the statements sent to the DB, the rows read and written by them, the time spent waiting for the DB to execute them
+and the peak RSS of the process. Steps nest within
+the same thread and the DB counters of a step also include those of its sub-steps. Outside of a measured stage,
+`measure()` and `measure_each()` do nothing, so that the data modules can also be used on their own.
+"""
+import contextlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+
+from tabulate import tabulate
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+# stack of the steps currently measured by each thread
+local = threading.local()
+
+
+def thread_cpu_time():
+    if resource and hasattr(resource, "RUSAGE_THREAD"):
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return time.process_time()
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+
+
+class Step(object):
+    def __init__(self, recorder, stage, imei=None):
+        self.recorder = recorder
+        self.stage = stage
+        self.imei = imei
+        self.rows_read = 0
+        self.rows_written = 0
+        self.round_trips = 0
+        self.db_wait = 0.0
+        self.started = datetime.now()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = thread_cpu_time()
+
+    def finish(self, failed=False):
+        return {
+            'run': self.recorder.run,
+            'stage': self.stage,
+            'imei': self.imei,
+            'started': self.started.isoformat(),
+            'failed': failed,
+            'wall_s': round(time.perf_counter() - self.wall_start, 3),
+            'cpu_s': round(thread_cpu_time() - self.cpu_start, 3),
+            'db_wait_s': round(self.db_wait, 3),
+            'round_trips': self.round_trips,
+            'rows_read': self.rows_read,
+            'rows_written': self.rows_written,
+            'peak_rss_kb': peak_rss_kb(),
+        }
+
+
+class MetricsRecorder(object):
+    """Collects the records of all finished steps and appends each one as JSON line to `file`, if given"""
+
+    def __init__(self, file=None):
+        self.run = datetime.now().isoformat()
+        self.file = file
+        self.records = []
+        self.lock = threading.Lock()
+
+    def record(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.file:
+                with open(self.file, "a") as f:
+                    f.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def summary(self, top=10):
+        columns = ('wall_s', 'cpu_s', 'db_wait_s', 'round_trips', 'rows_read', 'rows_written', 'peak_rss_kb')
+        stages = [r for r in self.records if not r['imei']]
+        imeis = sorted((r for r in self.records if r['imei']), key=lambda r: r['wall_s'], reverse=True)[:top]
+        return "{}\n\nSlowest steps:\n{}".format(
+            tabulate([[r['stage']] + [r[c] for c in columns] for r in stages], headers=('stage',) + columns),
+            tabulate([[r['stage'], r['imei']] + [r[c] for c in columns] for r in imeis],
+                     headers=('stage', 'imei') + columns))
+
+
+def current_step():
+    stack = getattr(local, "stack", None)
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def measure(stage=None, imei=None, recorder=None):
+    """Measure the enclosed code as step of `stage`, which defaults to the stage of the enclosing step
+
+    A new stage can only be started with a `recorder`, otherwise nothing is measured if there is no enclosing step.
+    """
+    parent = current_step()
+    if not recorder:
+        if not parent:
+            yield None
+            return
+        recorder = parent.recorder
+    step = Step(recorder, stage or parent.stage, imei)
+    if not hasattr(local, "stack"):
+        local.stack = []
+    local.stack.append(step)
+    failed = True
+    try:
+        yield step
+        failed = False
+    finally:
+        local.stack.pop()
+        if parent:
+            parent.round_trips += step.round_trips
+            parent.rows_read += step.rows_read
+            parent.rows_written += step.rows_written
+            parent.db_wait += step.db_wait
+        recorder.record(step.finish(failed))
+
+
+@contextlib.contextmanager
+def counting(step):
+    """Count the DB statements the current thread executes in the enclosed code for `step`, without recording it
+
+    This allows background threads to count their statements separately for a step measured in another thread, which
+    can add them to its own counters once the thread is done. Does nothing if `step` is None.
+    """
+    if step is None:
+        yield
+        return
+    if not hasattr(local, "stack"):
+        local.stack = []
+    local.stack.append(step)
+    try:
+        yield
+    finally:
+        local.stack.pop()
+
+
+def measure_each(imeis):
+    """Yield the IMEIs one after another, each one measured as separate step of the current stage"""
+    for imei in imeis:
+        with measure(imei=imei):
+            yield imei
+
+
+########################################################################################################################
+# DB counters
+
+def is_query(sql):
+    return sql.lstrip(" \t\n(").upper().startswith(("SELECT", "SHOW", "WITH"))
+
+
+class MeteredCursor(object):
+    """Wraps a cursor and counts its statements, rows and DB wait time for the step measured when they are executed"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def count(self, attr, value):
+        step = current_step()
+        if step and isinstance(value, (int, float)) and value > 0:
+            setattr(step, attr, getattr(step, attr) + value)
+
+    def timed(self, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.count('db_wait', time.perf_counter() - start)
+
+    def execute(self, sql, args=None):
+        res = self.timed(self.cursor.execute, sql, args)
+        self.count('round_trips', 1)
+        if not is_query(sql):
+            self.count('rows_written', res)
+        return res
+
+    def executemany(self, sql, args):
+        res = self.timed(self.cursor.executemany, sql, args)
+        self.count('round_trips', 1)
+        self.count('rows_written', res)
+        return res
+
+    def fetchone(self):
+        row = self.timed(self.cursor.fetchone)
+        self.count('rows_read', 1 if row is not None else 0)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.timed(self.cursor.fetchmany, *args)
+        self.count('rows_read', len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.timed(self.cursor.fetchall)
+        self.count('rows_read', len(rows))
+        return rows
+
+    def fetchall_unbuffered(self):
+        return self.count_rows(self.cursor.fetchall_unbuffered())
+
+    def __iter__(self):
+        return self.count_rows(self.cursor)
+
+    @staticmethod
+    def count_rows(rows):
+        step = current_step()
+        rows = iter(rows)
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            finally:
+                if step:
+                    step.db_wait += time.perf_counter() - start
+            if step:
+                step.rows_read += 1
+            yield row
+
+    def __enter__(self):
+        self.cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.cursor.__exit__(*exc_info)
+
+
+class MeteredConnection(object):
+    """Wraps a connection so that all of its cursors are metered"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def cursor(self, *args, **kwargs):
+        return MeteredCursor(self.connection.cursor(*args, **kwargs))
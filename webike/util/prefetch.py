@@ -0,0 +1,141 @@
+"""Read-ahead of query results, so that the DB streams the next rows while the current ones are processed
+
+A background thread executes the query on its own connection, as a connection can't be shared between threads, and
+hands the rows over in chunks through a bounded queue, so that at most `depth` chunks are held in memory ahead of the
+consumer. As the query runs on another connection, it only sees data that was already committed.
+The connections are taken from a pool, so that they are reused across queries. If the consumer stops before the whole
+result was read, the connection is closed instead of being returned, as closing a streaming cursor would first read
+the remaining rows.
+"""
+import queue
+import threading
+import time
+
+from pymysql.cursors import SSCursor
+
+from webike.util import DB
+from webike.util.metrics import current_step, counting, MeteredConnection, Step
+
+__author__ = "Niko Fink"
+
+# marks the end of the result in the queue
+END = object()
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def default_pool():
+    """The pool of connections opened using `DB.connect`, which is created on first use"""
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = DB.ConnectionPool(size=4, connect=DB.connect)
+        return pool
+
+
+class Failure(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class Prefetcher(threading.Thread):
+    """Thread streaming the result of `sql` chunk by chunk into `queue` until it is done or `stopped` is set
+
+    The statements of the thread are counted for `counter`, if given.
+    """
+
+    def __init__(self, pool, sql, args, cursor_class, chunk_size, depth, counter=None):
+        super().__init__(name="Prefetcher", daemon=True)
+        self.pool = pool
+        self.sql = sql
+        self.args = args
+        self.cursor_class = cursor_class
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.counter = counter
+
+    def run(self):
+        try:
+            connection = self.pool.get()
+        except Exception as e:
+            self.put(Failure(e))
+            return
+        complete = False
+        try:
+            with counting(self.counter):
+                cursor = MeteredConnection(connection).cursor(self.cursor_class)
+                cursor.execute(self.sql, self.args)
+                while not self.stopped.is_set():
+                    rows = cursor.fetchmany(self.chunk_size)
+                    if not rows:
+                        complete = True
+                        break
+                    if not self.put(rows):
+                        break
+            if complete:
+                # the result was read completely, so closing the cursor doesn't wait for any remaining rows
+                cursor.close()
+                connection.rollback()
+        except Exception as e:
+            complete = False
+            self.put(Failure(e))
+        finally:
+            if complete:
+                self.pool.put(connection)
+            else:
+                self.pool.discard(connection)
+        if complete:
+            self.put(END)
+
+    def put(self, item):
+        """Wait until the queue has room for the item and return True, or False if the consumer stopped meanwhile"""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+def prefetch_chunks(sql, args=None, cursor_class=SSCursor, chunk_size=10000, depth=4, pool=None):
+    """Yield the result of `sql` in lists of up to `chunk_size` rows, which are read ahead by a background thread
+
+    The thread uses its own connection from `pool`, which defaults to a pool of `DB.connect` connections, and is
+    stopped once the generator is closed, so wrap it in `contextlib.closing` if it might not be consumed completely.
+    The statements and rows of the thread are counted for the step measured when iterating once it is done, the time
+    spent waiting for the rows as its DB wait.
+    """
+    step = current_step()
+    counter = Step(step.recorder, step.stage, step.imei) if step else None
+    prefetcher = Prefetcher(pool or default_pool(), sql, args, cursor_class, chunk_size, depth, counter)
+    prefetcher.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            item = prefetcher.queue.get()
+            if step:
+                step.db_wait += time.perf_counter() - start
+            if item is END:
+                return
+            elif isinstance(item, Failure):
+                raise item.exception
+            yield item
+    finally:
+        prefetcher.stopped.set()
+        prefetcher.join()
+        if step:
+            step.round_trips += counter.round_trips
+            step.rows_read += counter.rows_read
+
+
+def prefetch_rows(sql, args=None, cursor_class=SSCursor, chunk_size=10000, depth=4, pool=None):
+    """Yield the rows of `sql` one by one, while the next chunks are read ahead as in `prefetch_chunks`"""
+    chunks = prefetch_chunks(sql, args, cursor_class, chunk_size, depth, pool)
+    try:
+        for chunk in chunks:
+            yield from chunk
+    finally:
+        chunks.close()
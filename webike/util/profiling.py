@@ -0,0 +1,135 @@
+"""Profiling of single preprocessing stages without changing their code
+
+Two profilers are available: the `sampler` periodically records the stack of the thread running the stage and writes
+it in the collapsed format read by flamegraph.pl and speedscope, while `cprofile` writes a deterministic profile that
+can be read with pstats or snakeviz. The summary of each profile splits the wall time of the stage into the time spent
+waiting for the DB, as measured by the metered connection of the stage, and the time spent in Python code, next to the
+CPU time of the thread. Without metered connection, the DB wait is estimated from the profile: for MySQL, it is the
+time spent reading from the server's socket, for SQLite the time spent in the sqlite3 library.
+"""
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from iss4e.util import BraceMessage as __
+from tabulate import tabulate
+
+from webike.util.metrics import current_step, thread_cpu_time
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+PROFILERS = ["sampler", "cprofile"]
+
+SOCKET_FILE = "socket.py"
+SQLITE_FILE = os.path.join("webike", "util", "sqlite.py")
+
+
+def is_db_wait(filename, function):
+    """Whether the innermost Python function of a stack is waiting for the DB"""
+    if filename.endswith(SOCKET_FILE):
+        return function in ("readinto", "recv_into", "recv")
+    return filename.endswith(SQLITE_FILE) or "sqlite3." in function
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "{}:{}".format(os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name)
+
+
+class StackSampler(threading.Thread):
+    """Samples the stack of the thread `thread_id` every `interval` seconds until stopped
+
+    Stacks waiting for the DB get an additional `[db wait]` frame. As the sampler needs the GIL to take a sample,
+    samples are more likely to hit code that releases the GIL, like the DB drivers, than pure Python code.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        super().__init__(name="StackSampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.db_samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+
+            leaf = frame
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame))
+                frame = frame.f_back
+            names.reverse()
+            if is_db_wait(leaf.f_code.co_filename, leaf.f_code.co_name):
+                names.append("[db wait]")
+                self.db_samples += 1
+            self.stacks[";".join(names)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def db_wait_share(self):
+        samples = sum(self.stacks.values())
+        return self.db_samples / samples if samples else 0
+
+    def write_collapsed(self, file):
+        with open(file, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("{} {}\n".format(stack, count))
+
+
+@contextlib.contextmanager
+def profile_stage(name, out_dir, profiler="sampler", interval=0.005):
+    """Profile the code run by this thread within the context as stage `name`, writing the results to `out_dir`"""
+    os.makedirs(out_dir, exist_ok=True)
+    base = os.path.join(out_dir, name)
+    step = current_step()
+    step_db_wait = step.db_wait if step else 0
+    start = time.perf_counter()
+    cpu_start = thread_cpu_time()
+    if profiler == "sampler":
+        sampler = StackSampler(threading.get_ident(), interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.write_collapsed(base + ".collapsed")
+            wall = time.perf_counter() - start
+            db_wait = step.db_wait - step_db_wait if step else wall * sampler.db_wait_share()
+            log_summary(name, base + ".collapsed", wall, db_wait, thread_cpu_time() - cpu_start)
+
+    elif profiler == "cprofile":
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(base + ".prof")
+            if step:
+                db_wait = step.db_wait - step_db_wait
+            else:
+                db_wait = sum(tottime for (filename, line, function), (cc, nc, tottime, cumtime, callers)
+                              in pstats.Stats(prof).stats.items() if is_db_wait(filename, function))
+            log_summary(name, base + ".prof", time.perf_counter() - start, db_wait, thread_cpu_time() - cpu_start)
+
+    else:
+        raise ValueError("Unknown profiler {!r}".format(profiler))
+
+
+def log_summary(name, file, wall, db_wait, cpu):
+    logger.info(__("Profile of stage {} written to {}:\n{}", name, file, tabulate(
+        [("wall", wall), ("db wait", db_wait), ("python", wall - db_wait), ("thread cpu", cpu)],
+        headers=("time", "seconds"), floatfmt=".2f")))
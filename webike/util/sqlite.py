@@ -0,0 +1,310 @@
+"""Embedded SQLite storage, so that the preprocessing stages and graphers can run offline
+
+The connections and cursors returned here behave like the PyMySQL ones used by the rest of the code: parameters are
+given as %s or %(name)s, DictCursor classes yield dicts and unbuffered reads are available via fetchall_unbuffered.
+The webike_sfink schema from schema/schema.sql lives in a second database file, which is attached under the same name,
+and the MySQL functions used in the queries are registered as user-defined functions.
+"""
+import logging
+import math
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime, date, timedelta
+from functools import lru_cache
+
+from iss4e.util import BraceMessage as __
+from pymysql.cursors import DictCursorMixin
+
+from webike.util.constants import IMEIS
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), "..", "..", "schema", "schema.sql")
+
+# columns of the per-unit tables that are used by the code, which are only created when they don't exist yet
+SAMPLE_TABLE = """CREATE TABLE IF NOT EXISTS imei{imei}
+(
+  Stamp          DATETIME PRIMARY KEY NOT NULL,
+  BatteryVoltage FLOAT,
+  ChargingCurr   FLOAT,
+  DischargeCurr  FLOAT,
+  TempBattery    FLOAT,
+  TempBox        FLOAT,
+  AtmosPress     FLOAT
+)"""
+TRIP_TABLE = """CREATE TABLE IF NOT EXISTS trip{imei}
+(
+  id         INTEGER PRIMARY KEY,
+  start_time DATETIME NOT NULL,
+  end_time   DATETIME NOT NULL,
+  distance   FLOAT
+)"""
+
+
+########################################################################################################################
+# Type conversion
+
+def parse_datetime(value):
+    """Parse `YYYY-MM-DD[ HH:MM:SS[.ffffff]]`, which is much faster by hand than using strptime"""
+    value = value.decode()
+    try:
+        if len(value) == 10:
+            return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+        return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                        int(value[11:13]), int(value[14:16]), int(value[17:19]), int(value[20:26].ljust(6, "0") or 0))
+    except ValueError as e:
+        raise ValueError("Invalid datetime {!r}".format(value)) from e
+
+
+# like PyMySQL, ignore the timezone of aware datetimes
+sqlite3.register_adapter(datetime, lambda value: value.replace(tzinfo=None).isoformat(" "))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+for type_name in ("DATETIME", "TIMESTAMP"):
+    sqlite3.register_converter(type_name, parse_datetime)
+sqlite3.register_converter("DATE", lambda value: parse_datetime(value).date())
+
+
+########################################################################################################################
+# MySQL functions
+
+def to_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return parse_datetime(str(value).encode())
+
+
+# like MySQL with the default session time zone, naive datetimes are in the local time zone of the system
+def unix_timestamp(value):
+    value = to_datetime(value)
+    if value is None:
+        return None
+    return int(time.mktime(value.timetuple()))
+
+
+def unix_now():
+    return int(time.time())
+
+
+def from_unixtime(value):
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value).isoformat(" ")
+
+
+def floor(value):
+    return None if value is None else math.floor(value)
+
+
+def year(value):
+    value = to_datetime(value)
+    return None if value is None else value.year
+
+
+def month(value):
+    value = to_datetime(value)
+    return None if value is None else value.month
+
+
+def now():
+    return datetime.now().replace(microsecond=0).isoformat(" ")
+
+
+def addtime(value, time):
+    value = to_datetime(value)
+    if value is None or time is None:
+        return None
+    hours, minutes, seconds = (int(part) for part in time.split(":"))
+    return (value + timedelta(hours=hours, minutes=minutes, seconds=seconds)).isoformat(" ")
+
+
+FUNCTIONS = [
+    ("UNIX_TIMESTAMP", 0, unix_now),
+    ("UNIX_TIMESTAMP", 1, unix_timestamp),
+    ("FROM_UNIXTIME", 1, from_unixtime),
+    ("FLOOR", 1, floor),
+    ("YEAR", 1, year),
+    ("MONTH", 1, month),
+    ("NOW", 0, now),
+    ("ADDTIME", 2, addtime),
+]
+
+
+########################################################################################################################
+# PyMySQL-compatible connection
+
+PARAM_RE = re.compile(r"%\((\w+)\)s|%s|%%")
+
+
+@lru_cache(maxsize=256)
+def translate_params(sql):
+    """Convert the `format` and `pyformat` parameters used by PyMySQL to the `qmark` and `named` style of sqlite3"""
+
+    def replace(match):
+        if match.group(1):
+            return ":" + match.group(1)
+        elif match.group(0) == "%s":
+            return "?"
+        else:
+            return "%"
+
+    return PARAM_RE.sub(replace, sql)
+
+
+def dict_factory(cursor, row):
+    return dict(zip([column[0] for column in cursor.description], row))
+
+
+class Cursor(object):
+    dialect = "sqlite"
+
+    def __init__(self, connection, as_dict=False):
+        self.connection = connection
+        self.cursor = connection.db.cursor()
+        if as_dict:
+            self.cursor.row_factory = dict_factory
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    def execute(self, sql, args=None):
+        if args is None:
+            self.cursor.execute(sql)
+        else:
+            self.cursor.execute(translate_params(sql), args)
+        return self.cursor.rowcount
+
+    def executemany(self, sql, args):
+        self.cursor.executemany(translate_params(sql), args)
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self.cursor.fetchmany(size or self.cursor.arraysize)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchall_unbuffered(self):
+        # fetch from within this generator, so that profiles attribute the time to the DB
+        yield from self.cursor
+
+    def __iter__(self):
+        return self.fetchall_unbuffered()
+
+    def close(self):
+        self.cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Connection(object):
+    dialect = "sqlite"
+
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self, cursor=None):
+        return Cursor(self, as_dict=bool(cursor) and issubclass(cursor, DictCursorMixin))
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def thread_id(self):
+        return id(self)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+########################################################################################################################
+# Setup
+
+def connect(path, sfink_path=None, create=True, timeout=600, imeis=None):
+    """Open the SQLite database at `path` with the webike_sfink database from `sfink_path` attached
+
+    `sfink_path` defaults to a file next to `path`. If `create` is set, missing tables are created, including the
+    sample and trip tables of the `imeis`, which default to the devices of the study, so new devices can be added by
+    listing them in the webike.sqlite config.
+    Concurrent writers wait up to `timeout` seconds for each other, while readers are never blocked.
+    """
+    if not sfink_path:
+        sfink_path = path if path == ":memory:" else os.path.splitext(path)[0] + "_sfink" + os.path.splitext(path)[1]
+    db = sqlite3.connect(path, timeout=timeout, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    for name, num_params, func in FUNCTIONS:
+        db.create_function(name, num_params, func)
+    db.execute("ATTACH DATABASE ? AS webike_sfink", (sfink_path,))
+    if path != ":memory:":
+        db.execute("PRAGMA main.journal_mode = WAL")
+        db.execute("PRAGMA webike_sfink.journal_mode = WAL")
+    connection = Connection(db)
+    if create:
+        create_tables(connection, imeis=imeis)
+    return connection
+
+
+def translate_statement(stmt):
+    """Translate a statement from schema.sql to SQLite, returns None if it has no SQLite equivalent"""
+    if stmt.upper().startswith("ALTER TABLE"):
+        # SQLite can't add foreign keys to existing tables
+        return None
+    stmt = re.sub(r"^CREATE TABLE (\w+)", r"CREATE TABLE IF NOT EXISTS webike_sfink.\1", stmt)
+    stmt = re.sub(r"^CREATE INDEX (\w+)", r"CREATE INDEX IF NOT EXISTS webike_sfink.\1", stmt)
+    stmt = re.sub(r"INT\(\d+\)", "INTEGER", stmt)
+    stmt = re.sub(r"TIMESTAMP\(\d+\)", "TIMESTAMP", stmt)
+    stmt = re.sub(r"DEFAULT '0000-00-00[^']*'", "", stmt)
+    stmt = stmt.replace("CONSTRAINT `PRIMARY` ", "")
+
+    # SQLite only auto-increments single-column integer primary keys
+    auto = re.search(r"^\s*(\w+)\s+INTEGER.*AUTO_INCREMENT,?$", stmt, re.MULTILINE)
+    if auto:
+        stmt = stmt.replace(auto.group(0), "  {} INTEGER PRIMARY KEY AUTOINCREMENT,".format(auto.group(1)))
+        stmt = re.sub(r",\s*PRIMARY KEY \([^)]*\)", "", stmt)
+    return stmt
+
+
+def create_tables(connection, schema_file=SCHEMA_FILE, imeis=None):
+    """Create the webike_sfink tables from schema.sql and the sample and trip tables of the `imeis`
+
+    The trip tables of the devices that already have a sample table are also created.
+    """
+    # DB imports this module to open SQLite connections
+    from webike.util import DB
+    with open(schema_file) as f:
+        statements = [stmt.strip() for stmt in f.read().split(";") if stmt.strip()]
+    with connection.cursor() as cursor:
+        for stmt in statements:
+            stmt = translate_statement(stmt)
+            if stmt:
+                cursor.execute(stmt)
+        for imei in sorted(set(DB.discover_imeis(connection)) | set(DB.check_imei(imei) for imei in imeis or IMEIS)):
+            cursor.execute(SAMPLE_TABLE.format(imei=imei))
+            cursor.execute(TRIP_TABLE.format(imei=imei))
+    connection.commit()
+    logger.debug(__("Created missing tables from {}", schema_file))
@@ -0,0 +1,130 @@
+import collections
+import contextlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from iss4e.util import BraceMessage as __
+
+from webike.util.metrics import measure, MeteredConnection
+from webike.util.profiling import profile_stage
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+# `func(connection)` does the work of the stage, `requires` lists the names of the stages whose results it reads.
+# The work of `per_imei` stages can be split by IMEI, their `func(connection, imeis)` only processes the given ones.
+Stage = collections.namedtuple('Stage', ['name', 'func', 'requires', 'per_imei'])
+
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class StageScheduler(object):
+    """Runs stages concurrently as soon as all stages they require are done
+
+    Each stage gets its own connection from `connect()`, which is committed once the stage is done, so that a failing
+    stage doesn't roll back the others. Stages requiring a failed stage are skipped.
+    If a MetricsRecorder is given as `metrics`, each stage is measured using a metered connection.
+    The stages named in `profile` are run within `profile_stage(name, profile_dir, profiler)`.
+    If a RunJournal is given as `journal`, the stages are run and committed unit by unit instead, skipping the units
+    that are already done in its run.
+    """
+
+    def __init__(self, stages, connect, max_workers=4, metrics=None, profile=(), profile_dir="tmp/profile",
+                 profiler="sampler", journal=None):
+        self.stages = collections.OrderedDict((stage.name, stage) for stage in stages)
+        self.connect = connect
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.profiler = profiler
+        self.journal = journal
+        for stage in stages:
+            for name in stage.requires:
+                if name not in self.stages:
+                    raise ValueError("Stage {} requires unknown stage {}".format(stage.name, name))
+
+    def select(self, names=None, with_requirements=False):
+        """Names of the stages to run in the order of their declaration, defaults to all stages"""
+        if not names:
+            return list(self.stages.keys())
+        for name in names:
+            if name not in self.stages:
+                raise ValueError("Unknown stage {}".format(name))
+
+        selected = set(names)
+        if with_requirements:
+            todo = list(names)
+            while todo:
+                for name in self.stages[todo.pop()].requires:
+                    if name not in selected:
+                        selected.add(name)
+                        todo.append(name)
+        return [name for name in self.stages if name in selected]
+
+    def run(self, names=None, with_requirements=False):
+        """Run the selected stages and return the state of each one
+
+        Requirements that are not selected are assumed to be already done.
+        """
+        selected = self.select(names, with_requirements)
+        pending = collections.OrderedDict((name, set(self.stages[name].requires) & set(selected)) for name in selected)
+        states = collections.OrderedDict()
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name in self.ready(pending, states):
+                    logger.info(__("Starting stage {}", name))
+                    running[executor.submit(self.run_stage, self.stages[name])] = name
+                if not running:
+                    if pending:
+                        raise ValueError("Stages {} have cyclic requirements".format(", ".join(sorted(pending))))
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception():
+                        logger.error(__("Stage {} failed", name), exc_info=future.exception())
+                        states[name] = FAILED
+                    else:
+                        logger.info(__("Finished stage {}", name))
+                        states[name] = DONE
+        return states
+
+    @staticmethod
+    def ready(pending, states):
+        """Remove the stages that can be started from `pending` and mark those that can't be run anymore as skipped"""
+        ready = []
+        changed = True
+        while changed:
+            changed = False
+            for name, requires in list(pending.items()):
+                failed = [req for req in requires if states.get(req) in (FAILED, SKIPPED)]
+                if failed:
+                    logger.warning(__("Skipping stage {} as required stage {} did not complete", name, failed[0]))
+                    states[name] = SKIPPED
+                    del pending[name]
+                    changed = True
+                elif all(states.get(req) == DONE for req in requires):
+                    ready.append(name)
+                    del pending[name]
+        return ready
+
+    def run_stage(self, stage):
+        with measure(stage.name, recorder=self.metrics) as step, self.profile_stage(stage), \
+                self.connect() as connection:
+            if self.journal:
+                self.journal.run_stage(stage, MeteredConnection(connection) if self.metrics else connection, step)
+            else:
+                stage.func(MeteredConnection(connection) if self.metrics else connection)
+                connection.commit()
+
+    def profile_stage(self, stage):
+        if stage.name in self.profile:
+            return profile_stage(stage.name, self.profile_dir, self.profiler)
+        else:
+            return contextlib.ExitStack()
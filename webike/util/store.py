@@ -0,0 +1,238 @@
+"""Local append-only copy of the samples and their SoC estimation, stored as one memory-mapped file per column
+
+The samples of each IMEI are stored in the directory `{path}/{imei}`, with each column of the `imei{imei}` table and
+of `webike_sfink.soc` written as raw NumPy array to `{column}.bin`. The sorted `Stamp` column serves as time index, so
+that the samples of a time range are found by binary search and returned as slices of the memory-mapped columns
+without reading or copying any other part of the files. `meta.json` records the number of valid rows, so that rows
+appended by an interrupted sync are ignored and overwritten by the next one.
+
+New samples are only appended after the last stored one. As SoC estimations are inserted after their samples, they
+are filled into the existing rows once the SoC counts of the DB and the store differ. Samples uploaded late with a
+stamp before the last stored one cause the store of the IMEI to be rebuilt.
+The store is enabled by setting `webike.store.path` in the config and is synced by the charge cycle detection,
+only one process may sync a store at a time.
+"""
+import collections
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import numpy as np
+from iss4e.util import BraceMessage as __
+from iss4e.util.config import load_config
+
+from webike.util import DB, kernels
+from webike.util.DB import DictCursor
+from webike.util.constants import STUDY_START
+from webike.util.fetch import fetch_columns, STAMP
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+META = "meta.json"
+SYNCED_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+COLUMNS = [('Stamp', STAMP)] + [(c, np.float64) for c in DB.SAMPLE_COLUMNS if c != 'Stamp'] + \
+          [(c, np.float64) for c in DB.SOC_COLUMNS]
+
+
+@lru_cache(maxsize=None)
+def get_store(path=None):
+    """The ColumnStore configured by `webike.store.path`, or None if no store is configured"""
+    path = path or load_config().get('webike.store.path', None)
+    return ColumnStore(path) if path else None
+
+
+def read_samples(connection, imei, begin, end, columns, soc_columns=(), **filters):
+    """Columns of the samples from `begin` to `end` as returned by `fetch_columns` for `DB.samples_sql`
+
+    The samples are read from the store if one is configured and was synced after `end`, otherwise from the DB.
+    """
+    store = get_store()
+    if store and store.covers(imei, end):
+        return store.samples(imei, begin, end, columns, soc_columns, **filters)
+    return fetch_columns(
+        connection,
+        DB.samples_sql(imei, columns, soc_columns, **filters),
+        [(c, STAMP if c == 'Stamp' else float) for c in columns + soc_columns],
+        args=(begin, end))
+
+
+class ColumnStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.maps = {}
+        self.locks = collections.defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+
+    def file(self, imei, name):
+        return os.path.join(self.path, DB.check_imei(imei), name)
+
+    def imei_lock(self, imei):
+        with self.lock:
+            return self.locks[imei]
+
+    def read_meta(self, imei):
+        try:
+            with open(self.file(imei, META)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'count': 0, 'soc_count': 0, 'synced': None}
+
+    def write_meta(self, imei, meta):
+        tmp = self.file(imei, META + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.file(imei, META))
+
+    ####################################################################################################################
+    # Reading
+
+    def open(self, imei):
+        """Memory-map all columns of the IMEI, reusing the maps of the last call if no rows were appended since"""
+        count = self.read_meta(imei)['count']
+        cached = self.maps.get(imei)
+        if cached and cached[0] == count:
+            return cached[1]
+        if count:
+            maps = dict((name, np.memmap(self.file(imei, name + ".bin"), dtype=dtype, mode='r', shape=(count,)))
+                        for name, dtype in COLUMNS)
+        else:
+            maps = dict((name, np.empty(0, dtype=dtype)) for name, dtype in COLUMNS)
+        self.maps[imei] = (count, maps)
+        return maps
+
+    def covers(self, imei, end):
+        """Whether the store of the IMEI was synced after `end`, so that it contains all samples until then"""
+        synced = self.read_meta(imei)['synced']
+        return synced is not None and end is not None and end <= datetime.strptime(synced, SYNCED_FORMAT)
+
+    def samples(self, imei, begin, end, columns, soc_columns=(), not_null=(), any_not_null=(), soc_join="LEFT OUTER"):
+        """Read the samples like `DB.samples_sql` with the same arguments, but from the store
+
+        Without filters, the returned columns are read-only slices of the memory-mapped files.
+        """
+        DB.check_columns(columns + soc_columns + not_null + any_not_null, DB.SAMPLE_COLUMNS + DB.SOC_COLUMNS)
+        maps = self.open(imei)
+        stamps = maps['Stamp']
+        lo = np.searchsorted(stamps, np.datetime64(begin, 'us'), side='left')
+        hi = np.searchsorted(stamps, np.datetime64(end, 'us'), side='right') if end else len(stamps)
+
+        mask = np.ones(hi - lo, dtype=bool)
+        for column in not_null:
+            mask &= ~kernels.missing(maps[column][lo:hi])
+        if any_not_null:
+            mask &= np.any([~np.isnan(maps[column][lo:hi]) for column in any_not_null], axis=0)
+        if soc_join == "INNER":
+            mask &= ~np.isnan(maps['soc_smooth'][lo:hi])
+        elif soc_join != "LEFT OUTER":
+            raise ValueError("Unknown join {!r}".format(soc_join))
+
+        if mask.all():
+            return dict((name, maps[name][lo:hi]) for name in columns + soc_columns)
+        return dict((name, maps[name][lo:hi][mask]) for name in columns + soc_columns)
+
+    def rows(self, imei, begin, end, columns, soc_columns=(), chunk_size=10000, **filters):
+        """Yield the samples like a DictCursor would, with datetime stamps and None for missing values"""
+        samples = self.samples(imei, begin, end, columns, soc_columns, **filters)
+        names = list(columns + soc_columns)
+        for start in range(0, len(samples['Stamp']), chunk_size):
+            chunk = []
+            for name in names:
+                values = samples[name][start:start + chunk_size]
+                if name == 'Stamp':
+                    chunk.append(values.astype(datetime).tolist())
+                else:
+                    chunk.append([None if v != v else v for v in values.tolist()])
+            for row in zip(*chunk):
+                yield dict(zip(names, row))
+
+    ####################################################################################################################
+    # Syncing
+
+    def sync(self, connection, imei):
+        """Append the new samples of the IMEI to the store and fill in the SoC estimations of the stored ones"""
+        with self.imei_lock(imei):
+            synced = datetime.now()
+            meta = self.read_meta(imei)
+            os.makedirs(os.path.dirname(self.file(imei, META)), exist_ok=True)
+            with connection.cursor(DictCursor) as cursor:
+                if meta['count'] and not self.check_unchanged(cursor, imei, meta['count']):
+                    logger.warning(__("Samples of {} were added before the last synced one, rebuilding the store",
+                                      imei))
+                    self.clear(imei)
+                    meta = self.read_meta(imei)
+                self.append(connection, imei, meta)
+                self.fill_soc(connection, cursor, imei, meta)
+            meta['synced'] = synced.strftime(SYNCED_FORMAT)
+            self.write_meta(imei, meta)
+            logger.info(__("Synced {:,} samples of {} to the store", meta['count'], imei))
+
+    def last_stamp(self, imei, count):
+        stamps = np.memmap(self.file(imei, "Stamp.bin"), dtype=STAMP, mode='r', shape=(count,))
+        return stamps[-1].astype(datetime)
+
+    def check_unchanged(self, cursor, imei, count):
+        """Whether the DB still contains exactly `count` samples up to the last synced one"""
+        cursor.execute(
+            "SELECT COUNT(Stamp) AS count FROM {} WHERE Stamp >= %s AND Stamp <= %s".format(DB.sample_table(imei)),
+            (STUDY_START, self.last_stamp(imei, count)))
+        return cursor.fetchone()['count'] == count
+
+    def clear(self, imei):
+        # remove instead of truncating the files, as readers could still have them mapped
+        for name, dtype in COLUMNS:
+            if os.path.exists(self.file(imei, name + ".bin")):
+                os.remove(self.file(imei, name + ".bin"))
+        if os.path.exists(self.file(imei, META)):
+            os.remove(self.file(imei, META))
+        self.maps.pop(imei, None)
+
+    def append(self, connection, imei, meta):
+        count = meta['count']
+        since = self.last_stamp(imei, count) + timedelta(microseconds=1) if count else STUDY_START
+        new = fetch_columns(
+            connection,
+            DB.samples_sql(imei, tuple(DB.SAMPLE_COLUMNS), tuple(DB.SOC_COLUMNS), until=False),
+            COLUMNS, args=(since,))
+        if not len(new['Stamp']):
+            return
+
+        for name, dtype in COLUMNS:
+            with open(self.file(imei, name + ".bin"), "a+b") as f:
+                # drop rows that were appended by an interrupted sync
+                f.truncate(count * np.dtype(dtype).itemsize)
+                f.write(np.ascontiguousarray(new[name], dtype=dtype).tobytes())
+        meta['count'] = count + len(new['Stamp'])
+        meta['soc_count'] += int(np.count_nonzero(~np.isnan(new['soc_smooth'])))
+        logger.info(__("Appended {:,} new samples of {} to the store", len(new['Stamp']), imei))
+
+    def fill_soc(self, connection, cursor, imei, meta):
+        count = meta['count']
+        cursor.execute("SELECT COUNT(time) AS count FROM webike_sfink.soc WHERE imei = %s AND time >= %s",
+                       (imei, STUDY_START))
+        if not count or cursor.fetchone()['count'] == meta['soc_count']:
+            return
+
+        # only samples with a valid voltage get a SoC estimation, the first one missing it is where we have to start
+        maps = dict((name, np.memmap(self.file(imei, name + ".bin"), dtype=dtype, mode='r+', shape=(count,)))
+                    for name, dtype in COLUMNS if name == 'Stamp' or name in DB.SOC_COLUMNS + ['BatteryVoltage'])
+        todo = np.flatnonzero(np.isnan(maps['soc_smooth']) & ~kernels.missing(maps['BatteryVoltage']))
+        if len(todo):
+            first = todo[0]
+            soc = fetch_columns(
+                connection,
+                "SELECT time, {} FROM webike_sfink.soc WHERE imei = %s AND time >= %s AND time <= %s ORDER BY time"
+                    .format(", ".join(DB.SOC_COLUMNS)),
+                [('time', STAMP)] + [(c, float) for c in DB.SOC_COLUMNS],
+                args=(imei, maps['Stamp'][first].astype(datetime), maps['Stamp'][-1].astype(datetime)))
+            idx = np.minimum(first + np.searchsorted(maps['Stamp'][first:], soc['time']), count - 1)
+            found = maps['Stamp'][idx] == soc['time']
+            for name in DB.SOC_COLUMNS:
+                maps[name][idx[found]] = soc[name][found]
+            for array in maps.values():
+                array.flush()
+            logger.info(__("Filled in {:,} SoC estimations of {} in the store", int(np.count_nonzero(found)), imei))
+        meta['soc_count'] = int(np.count_nonzero(~np.isnan(maps['soc_smooth'])))
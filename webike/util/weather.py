@@ -0,0 +1,68 @@
+"""Weather observations as NumPy columns, which can be joined onto samples using webike.util.asof
+
+The hourly observations from weather.gc.ca are read from `webike_sfink.weather`, the METAR reports from
+`webike_sfink.weather_metar_decoded`, which is filled by the weather_wu preprocessing stage and
+`webike import-metar --decode`.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from webike.util.asof import asof_join
+from webike.util.fetch import fetch_columns, STAMP
+
+__author__ = "Niko Fink"
+
+# source -> (table, time column, [(column, dtype)])
+SOURCES = {
+    'gc': ("webike_sfink.weather", "datetime", [
+        ('temp', float), ('dew_point', float), ('rel_hum', float), ('wind_dir', float), ('wind_speed', float),
+        ('visibility', float), ('stn_press', float), ('hmdx', float), ('wind_chill', float), ('weather', object)]),
+    'metar': ("webike_sfink.weather_metar_decoded", "stamp", [
+        ('temp', float), ('dewpt', float), ('wind_speed', float), ('vis', float), ('press', float),
+        ('weather_desc', object), ('weather_prec', object), ('weather_obsc', object), ('weather_othr', object)]),
+}
+# observations are hourly, so older ones are outdated
+DEFAULT_TOLERANCE = timedelta(hours=1)
+
+
+def select_columns(source, columns=None):
+    """(name, dtype) of the given columns of the source, defaults to all"""
+    table, time, available = SOURCES[source]
+    if columns is None:
+        return available
+    unknown = set(columns) - set(name for name, dtype in available)
+    if unknown:
+        raise ValueError("Unknown {} weather columns {}".format(source, ", ".join(sorted(unknown))))
+    return [(name, dtype) for name, dtype in available if name in columns]
+
+
+def read_weather(connection, source, begin, end, columns=None):
+    """Columns of the observations from `begin` to `end`, with their stamps as column 'time'"""
+    table, time, available = SOURCES[source]
+    selected = select_columns(source, columns)
+    return fetch_columns(
+        connection,
+        "SELECT {time}{columns} FROM {table} WHERE {time} >= %s AND {time} <= %s ORDER BY {time} ASC".format(
+            time=time, table=table, columns="".join(", " + name for name, dtype in selected)),
+        [('time', STAMP)] + selected, args=(begin, end))
+
+
+def join_weather(connection, stamps, source='gc', columns=None, tolerance=DEFAULT_TOLERANCE, direction='backward',
+                 prefix=None):
+    """Annotate the sorted stamps with the observation matched to each of them, see `asof_join`
+
+    The returned columns are named `{source}_{column}` unless another `prefix` is given, 'time' is the stamp of the
+    matched observation. Without `tolerance`, only observations within a day of the samples are matched.
+    """
+    stamps = np.asarray(stamps, dtype=STAMP)
+    if len(stamps):
+        # also read the observations just before and after the samples, which could be matched to them
+        margin = tolerance or timedelta(days=1)
+        weather = read_weather(connection, source, stamps[0].astype(datetime) - margin,
+                               stamps[-1].astype(datetime) + margin, columns)
+    else:
+        weather = dict((name, np.empty(0, dtype=dtype)) for name, dtype in
+                       [('time', STAMP)] + select_columns(source, columns))
+    return asof_join(stamps, weather, tolerance=tolerance, direction=direction,
+                     prefix=source + "_" if prefix is None else prefix)
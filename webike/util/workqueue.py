@@ -0,0 +1,208 @@
+"""Work queue sharing the units of a preprocessing run between worker processes, possibly running on several hosts
+
+A unit is one stage for one IMEI, or for all of them if the stage is not `per_imei`, in which case its IMEI is
+GLOBAL. All workers of a run enqueue the same units into webike_sfink.work_queue, where enqueueing units that already
+exist does nothing. Afterwards, each worker repeatedly claims a unit whose requirements are done by setting itself as
+owner with a lease, which it renews while running the unit. If a worker crashes, its lease expires and the unit is
+claimed by another worker, up to `max_attempts` times. Leases are compared using the clock of the DB, so that the
+clocks of the hosts don't matter. As all stages only process the data that is new to them, a unit that is run again
+after losing its lease only repeats the work that wasn't committed yet.
+"""
+import collections
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from iss4e.util import BraceMessage as __
+
+from webike.util.DB import DictCursor, on_duplicate_update
+from webike.util.metrics import measure, MeteredConnection
+from webike.util.stages import DONE, FAILED, SKIPPED
+
+__author__ = "Niko Fink"
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+# IMEI of the units of stages that are not run per IMEI
+GLOBAL = ""
+
+
+class WorkQueue(object):
+    """Claims and runs the units of `run` from the work queue until all of them are done, failed or skipped
+
+    `stages` are the Stages the units belong to, `connect()` opens the connections used for the queue and for running
+    the units. If a MetricsRecorder is given as `metrics`, each unit is measured using a metered connection.
+    """
+
+    def __init__(self, stages, connect, run, owner=None, lease=600, max_attempts=3, poll_interval=10, metrics=None):
+        self.stages = collections.OrderedDict((stage.name, stage) for stage in stages)
+        self.connect = connect
+        self.run = run
+        self.owner = owner or "{}:{}".format(socket.gethostname(), os.getpid())
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.metrics = metrics
+
+    def enqueue(self, names, imeis):
+        """Add the units of the named stages for the given IMEIs, unless they already exist"""
+        units = [(self.run, name, imei, PENDING)
+                 for name in names for imei in (imeis if self.stages[name].per_imei else [GLOBAL])]
+        with self.connect() as connection:
+            with connection.cursor() as cursor:
+                added = cursor.executemany(
+                    "INSERT INTO webike_sfink.work_queue (run, stage, imei, state, attempts) "
+                    "VALUES (%s, %s, %s, %s, 0) " + on_duplicate_update(connection, ('run', 'stage', 'imei')),
+                    units)
+            connection.commit()
+        logger.info(__("Enqueued {} new units of run {}, {} units in total", added, self.run, len(units)))
+
+    def run_workers(self, names, imeis, max_workers=1):
+        """Enqueue the units and work on them using `max_workers` threads, returns the final units of the run"""
+        self.enqueue(names, imeis)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.work, "{}/{}".format(self.owner, nr)) for nr in range(max_workers)]
+        for future in futures:
+            future.result()
+        with self.connect() as connection, connection.cursor(DictCursor) as cursor:
+            return self.load(cursor)
+
+    def work(self, owner):
+        """Claim and run units as `owner` until no unit of the run is pending or running anymore"""
+        with self.connect() as connection:
+            while True:
+                unit = self.claim(connection, owner)
+                if unit:
+                    self.run_unit(unit, owner)
+                elif self.finished(connection):
+                    return
+                else:
+                    # wait for the units other workers are running
+                    time.sleep(self.poll_interval)
+
+    ####################################################################################################################
+    # Queue state
+
+    def load(self, cursor):
+        cursor.execute(
+            "SELECT stage, imei, state, owner, attempts, lease_until < UNIX_TIMESTAMP() AS expired "
+            "FROM webike_sfink.work_queue WHERE run = %s",
+            (self.run,))
+        return collections.OrderedDict(((unit['stage'], unit['imei']), unit) for unit in cursor.fetchall()
+                                       if unit['stage'] in self.stages)
+
+    def requirements(self, units, stage, imei):
+        """The enqueued units that have to be done before the unit can be run, the others are assumed to be done"""
+        required = []
+        for name in self.stages[stage].requires:
+            if self.stages[name].per_imei and imei != GLOBAL:
+                required.append(units.get((name, imei)))
+            else:
+                required.extend(unit for key, unit in units.items() if key[0] == name)
+        return [unit for unit in required if unit]
+
+    def finished(self, connection):
+        with connection.cursor(DictCursor) as cursor:
+            units = self.load(cursor)
+        connection.commit()
+        return not any(unit['state'] in (PENDING, RUNNING) for unit in units.values())
+
+    ####################################################################################################################
+    # Claiming and running units
+
+    def claim(self, connection, owner):
+        """Claim a unit whose requirements are done, returns its (stage, imei) or None if none can be claimed now"""
+        with connection.cursor(DictCursor) as cursor:
+            units = self.load(cursor)
+            candidates = []
+            for key, unit in units.items():
+                if not (unit['state'] == PENDING or (unit['state'] == RUNNING and unit['expired'])):
+                    continue
+                required = self.requirements(units, *key)
+                if any(req['state'] in (FAILED, SKIPPED) for req in required):
+                    logger.warning(__("Skipping {} of {} as a required unit did not complete", *key))
+                    self.update(cursor, key, "state = %s", (SKIPPED,), "state = %s", (PENDING,))
+                elif all(req['state'] == DONE for req in required):
+                    candidates.append(unit)
+            connection.commit()
+
+            # spread the workers over the IMEIs of each stage, so that they rarely try to claim the same unit
+            random.shuffle(candidates)
+            names = list(self.stages.keys())
+            candidates.sort(key=lambda unit: names.index(unit['stage']))
+            for unit in candidates:
+                key = (unit['stage'], unit['imei'])
+                if unit['state'] == RUNNING:
+                    logger.warning(__("Lease of {} on {} of {} expired", unit['owner'], *key))
+                    if unit['attempts'] >= self.max_attempts:
+                        self.update(cursor, key, "state = %s, lease_until = NULL", (FAILED,),
+                                    "state = %s AND attempts = %s", (RUNNING, unit['attempts']))
+                        connection.commit()
+                        continue
+
+                # only succeeds if no other worker claimed the unit since it was loaded
+                claimed = self.update(
+                    cursor, key,
+                    "state = %s, owner = %s, lease_until = UNIX_TIMESTAMP() + %s, attempts = attempts + 1",
+                    (RUNNING, owner, self.lease),
+                    "state = %s AND attempts = %s AND (state = %s OR lease_until < UNIX_TIMESTAMP())",
+                    (unit['state'], unit['attempts'], PENDING))
+                connection.commit()
+                if claimed:
+                    logger.info(__("Claimed {} of {} as {}", key[0], key[1] or "all IMEIs", owner))
+                    return key
+        return None
+
+    def update(self, cursor, key, assignments, args, condition, condition_args):
+        """Update the unit if it matches `condition` and return whether it did"""
+        return cursor.execute(
+            "UPDATE webike_sfink.work_queue SET {}, updated = NOW() "
+            "WHERE run = %s AND stage = %s AND imei = %s AND {}".format(assignments, condition),
+            tuple(args) + (self.run,) + tuple(key) + tuple(condition_args)) == 1
+
+    def run_unit(self, key, owner):
+        stage = self.stages[key[0]]
+        stopped = threading.Event()
+        renewer = threading.Thread(target=self.renew, args=(key, owner, stopped), name="LeaseRenewer", daemon=True)
+        renewer.start()
+        try:
+            with measure(stage.name, recorder=self.metrics), self.connect() as connection:
+                metered = MeteredConnection(connection) if self.metrics else connection
+                if stage.per_imei:
+                    stage.func(metered, imeis=[key[1]])
+                else:
+                    stage.func(metered)
+                connection.commit()
+            state, retry = DONE, DONE
+        except Exception:
+            logger.error(__("{} of {} failed", key[0], key[1] or "all IMEIs"), exc_info=True)
+            state, retry = FAILED, PENDING
+        finally:
+            stopped.set()
+            renewer.join()
+
+        with self.connect() as connection, connection.cursor() as cursor:
+            # failed units are retried by the next worker claiming them, until they failed `max_attempts` times
+            finished = self.update(
+                cursor, key, "state = CASE WHEN attempts < %s THEN %s ELSE %s END, lease_until = NULL",
+                (self.max_attempts, retry, state), "owner = %s AND state = %s", (owner, RUNNING))
+            connection.commit()
+        if not finished:
+            logger.warning(__("Lost the lease on {} of {} before finishing it", *key))
+
+    def renew(self, key, owner, stopped):
+        """Renew the lease on the unit every third of the lease time until `stopped` is set"""
+        with self.connect() as connection:
+            while not stopped.wait(self.lease / 3):
+                with connection.cursor() as cursor:
+                    renewed = self.update(cursor, key, "lease_until = UNIX_TIMESTAMP() + %s", (self.lease,),
+                                          "owner = %s AND state = %s", (owner, RUNNING))
+                connection.commit()
+                if not renewed:
+                    logger.warning(__("Lost the lease on {} of {} while running it", *key))
+                    return